@@ -15,10 +15,13 @@ import sys
 
 from textwrap import dedent
 
+import cache
 import compiler
 import configure_buck
 import fetch
+import fetchers
 import formatting
+import stats
 import use_system
 from helpers import BuckitException
 
@@ -66,7 +69,11 @@ def add_fetch_args(parent_args, subparser):
     description = (
         "Fetch source for a package, and configure .buckconfig, "
         ".buckconfig.local, and BUCK files for third-party package "
-        "managers"
+        "managers. Downloads that stall for longer than {} seconds are "
+        "retried. That can be changed with the {} environment "
+        "variable".format(
+            fetchers.CachedFetcher.DOWNLOAD_TIMEOUT,
+            fetchers.DOWNLOAD_TIMEOUT_ENVVAR)
     )
     parser = subparser.add_parser(
         "fetch",
@@ -135,11 +142,35 @@ def add_fetch_args(parent_args, subparser):
     parser.add_argument(
         "--package",
         action=EnvDefault,
-        required=True,
+        required=False,
         envvar="npm_package_name",
         help=(
             "The package to configure. Otherwise, pulled from the "
-            "npm_package_name environment variable"
+            "npm_package_name environment variable. Required unless --all "
+            "is specified"
+        )
+    )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        default=False,
+        dest="all_packages",
+        help=(
+            "Fetch every package in the project that is fetched by buckit, "
+            "instead of just --package"
+        )
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        action=EnvDefault,
+        required=True,
+        default=8,
+        envvar="BUCKIT_FETCH_JOBS",
+        help=(
+            "The number of packages to download at once when --all is "
+            "specified. Can be set with the BUCKIT_FETCH_JOBS environment "
+            "variable"
         )
     )
     parser.add_argument(
@@ -148,6 +179,41 @@ def add_fetch_args(parent_args, subparser):
         default=False,
         help=("Whether to force a fetch of the source")
     )
+    parser.add_argument(
+        "--report",
+        action=EnvDefault,
+        required=False,
+        default=None,
+        envvar="BUCKIT_FETCH_REPORT",
+        help=(
+            "Where to write a json report with the time spent, bytes "
+            "downloaded and cache results for each package. Can be set with "
+            "the BUCKIT_FETCH_REPORT environment variable. Runs that share "
+            "the report are combined if they run at the same time, or have "
+            "the same {} environment variable. Otherwise the report is "
+            "replaced".format(stats.SESSION_ENVVAR)
+        )
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        default=False,
+        help="Whether to print a table of fetch statistics at the end",
+    )
+    parser.add_argument(
+        "--mirror",
+        action=EnvDefault,
+        required=False,
+        default=None,
+        envvar="BUCKIT_MIRROR",
+        dest="mirror_path",
+        help=(
+            "A local directory, or a tar archive of one, with copies of git "
+            "repositories and tarballs. If set, git and tarball sources are "
+            "only fetched from it, never from the network. Can be set with "
+            "the BUCKIT_MIRROR environment variable"
+        )
+    )
 
 
 def add_buckconfig_args(parent_args, subparser):
@@ -222,6 +288,42 @@ def add_system_args(parent_args, subparser):
     parser.set_defaults(use_system_for_all=None)
 
 
+def add_cache_args(parent_args, subparser):
+    description = (
+        "Manages the download cache that is shared between projects. gc "
+        "evicts the least recently used sources and git mirrors until the "
+        "cache fits in --max-size. Sources that are being fetched are not "
+        "evicted"
+    )
+    parser = subparser.add_parser(
+        "cache",
+        help="Manage buckit's download cache",
+        description=description,
+    )
+
+    for args in parent_args:
+        parser.add_argument(args.pop("name"), **args)
+
+    parser.add_argument(
+        "cache_action",
+        choices=["gc"],
+        help="The operation to run on the cache",
+    )
+    parser.add_argument(
+        "--max-size",
+        action=EnvDefault,
+        required=True,
+        default="20G",
+        envvar=cache.MAX_SIZE_ENVVAR,
+        help=(
+            "The size to shrink the cache to, e.g. 500M or 20G. Can be set "
+            "with the {} environment variable, which also makes fetches "
+            "garbage collect the cache after they finish".format(
+                cache.MAX_SIZE_ENVVAR)
+        )
+    )
+
+
 def parse_args(argv):
     description = dedent(
         """
@@ -247,6 +349,7 @@ def parse_args(argv):
     ]
     subparser = parser.add_subparsers(dest="selected_action")
     add_buckconfig_args(copy.deepcopy(parent_options), subparser)
+    add_cache_args(copy.deepcopy(parent_options), subparser)
     add_compiler_args(copy.deepcopy(parent_options), subparser)
     add_fetch_args(copy.deepcopy(parent_options), subparser)
     add_system_args(copy.deepcopy(parent_options), subparser)
@@ -279,20 +382,49 @@ def main(argv):
 
     if args.selected_action == 'buckconfig':
         should_configure_buck = True
+    elif args.selected_action == 'cache':
+        ret = cache.garbage_collect_command(args.max_size)
+    elif args.selected_action == 'fetch' and args.all_packages:
+        try:
+            ret = fetch.fetch_all_packages(
+                project_root=project_root,
+                node_modules=args.node_modules,
+                use_python2=args.use_python2,
+                python2_virtualenv=args.python2_virtualenv,
+                python2_virtualenv_root=args.python2_virtualenv_root,
+                use_python3=args.use_python3,
+                python3_virtualenv=args.python3_virtualenv,
+                python3_virtualenv_root=args.python3_virtualenv_root,
+                virtualenv_use_proxy_vars=args.virtualenv_use_proxy_vars,
+                force=args.force,
+                jobs=args.jobs,
+                mirror_path=args.mirror_path,
+            )
+        finally:
+            # Failed fetches are the ones that the report is most useful for
+            fetch.report_stats(args.report, args.summary)
+        if ret == 0:
+            should_configure_buck = True
     elif args.selected_action == 'fetch':
-        ret = fetch.fetch_package(
-            project_root=project_root,
-            node_modules=args.node_modules,
-            package=args.package,
-            use_python2=args.use_python2,
-            python2_virtualenv=args.python2_virtualenv,
-            python2_virtualenv_root=args.python2_virtualenv_root,
-            use_python3=args.use_python3,
-            python3_virtualenv=args.python3_virtualenv,
-            python3_virtualenv_root=args.python3_virtualenv_root,
-            virtualenv_use_proxy_vars=args.virtualenv_use_proxy_vars,
-            force=args.force,
-        )
+        if not args.package:
+            parser.error("fetch requires either --package or --all")
+        try:
+            ret = fetch.fetch_package(
+                project_root=project_root,
+                node_modules=args.node_modules,
+                package=args.package,
+                use_python2=args.use_python2,
+                python2_virtualenv=args.python2_virtualenv,
+                python2_virtualenv_root=args.python2_virtualenv_root,
+                use_python3=args.use_python3,
+                python3_virtualenv=args.python3_virtualenv,
+                python3_virtualenv_root=args.python3_virtualenv_root,
+                virtualenv_use_proxy_vars=args.virtualenv_use_proxy_vars,
+                force=args.force,
+                mirror_path=args.mirror_path,
+            )
+        finally:
+            fetch.report_stats(args.report, args.summary)
         if ret == 0:
             should_configure_buck = True
     elif args.selected_action == 'compiler':
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+import materializers
+from helpers import BuckitException
+
+STORE_DIR = 'buckit-store'
+GIT_MIRRORS_DIR = 'buckit-git-mirrors'
+PARTIAL_DIR = 'buckit-partial'
+MAX_SIZE_ENVVAR = 'BUCKIT_CACHE_MAX_SIZE'
+INDEX_PREFIX = 'buckit-fetch-'
+
+
+def get_cache_root():
+    """
+    Gets the directory that fetched sources are cached in, creating it if
+    it does not exist. This lives inside of yarn's cache directory
+    """
+    yarn_cache = os.path.join(os.path.expanduser('~'), '.cache', 'yarn')
+    if not os.path.exists(yarn_cache):
+        yarn_cache = os.path.join(os.path.expanduser('~'), '.yarn-cache')
+    # Several fetchers may be running at once with `fetch --all`
+    os.makedirs(yarn_cache, exist_ok=True)
+    return yarn_cache
+
+
+def get_index_path(cache_root, package_name, version):
+    """
+    Gets the path of the entry that maps a package name and version to a
+    directory in the content addressed store
+    """
+    clean_package_name = package_name.replace('/', '_').replace('\\', '_')
+    clean_version = version.replace('/', '_').replace('\\', '_')
+    return os.path.join(
+        cache_root,
+        '{}{}-{}'.format(INDEX_PREFIX, clean_package_name, clean_version)
+    )
+
+
+def get_store_path(cache_root, key):
+    """
+    Gets the path of a tree in the content addressed store
+
+    Arguments:
+        cache_root - The root of the cache from get_cache_root()
+        key - The content key of the tree. e.g. sha256-<digest of tarball>
+              or git-commit-<commit>[-<digest of submodule commits>]
+    """
+    return os.path.join(cache_root, STORE_DIR, key)
+
+
+def get_git_mirror_path(cache_root, url):
+    """
+    Gets the path to the bare mirror of a git repository in the cache
+    """
+    url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    clean_name = os.path.basename(url.rstrip('/'))
+    if clean_name.endswith('.git'):
+        clean_name = clean_name[:-len('.git')]
+    return os.path.join(
+        cache_root, GIT_MIRRORS_DIR, '{}-{}.git'.format(clean_name, url_hash)
+    )
+
+
+def get_partial_path(cache_root, key):
+    """
+    Gets the path that an interrupted download of a tree with the given
+    content key is saved to. Progress is recorded in a journal next to it
+    """
+    partial_dir = os.path.join(cache_root, PARTIAL_DIR)
+    os.makedirs(partial_dir, exist_ok=True)
+    return os.path.join(partial_dir, key + '.part')
+
+
+def read_journal(partial_path):
+    """
+    Reads the journal for a partial download
+
+    Returns:
+        The dictionary that was written with write_journal, or an empty
+        dictionary if there is no usable journal
+    """
+    try:
+        with open(partial_path + '.journal', 'r') as fin:
+            return json.loads(fin.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def write_journal(partial_path, journal):
+    """
+    Atomically replaces the journal for a partial download
+    """
+    journal_path = partial_path + '.journal'
+    tmp_path = '{}.{}.tmp'.format(journal_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as fout:
+        fout.write(json.dumps(journal))
+    os.replace(tmp_path, journal_path)
+
+
+def remove_partial(partial_path):
+    """
+    Removes a partial download and its journal, if they exist
+    """
+    for path in (partial_path, partial_path + '.journal'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def lookup(cache_root, index_path, key=None):
+    """
+    Finds a tree in the cache, first by the package's index entry, and then
+    by the content key if it is known before fetching
+
+    Returns:
+        The path to the cached tree, or None if it is not cached
+    """
+    if os.path.isdir(index_path):
+        return os.path.realpath(index_path)
+    if key:
+        store_path = get_store_path(cache_root, key)
+        if os.path.isdir(store_path):
+            return store_path
+    return None
+
+
+def make_read_only(path):
+    """
+    Removes write permissions from all files underneath path. Directories
+    are left alone so that trees can still be deleted
+    """
+    for root, _, files in os.walk(path):
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            if os.path.islink(file_path):
+                continue
+            mode = os.lstat(file_path).st_mode
+            os.chmod(file_path, mode & ~materializers.WRITE_BITS)
+
+
+def publish(cache_root, tree, key):
+    """
+    Moves a freshly fetched tree into the content addressed store. If
+    another fetch already published the same content, that copy is kept
+
+    Arguments:
+        cache_root - The root of the cache from get_cache_root()
+        tree - The fetched tree. Must be on the same filesystem as cache_root
+        key - The content key of the tree
+
+    Returns:
+        The path to the tree inside of the store
+    """
+    store_path = get_store_path(cache_root, key)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    if os.path.exists(store_path):
+        logging.debug("%s is already in the store at %s", key, store_path)
+        return store_path
+
+    make_read_only(tree)
+    try:
+        os.rename(tree, store_path)
+    except OSError as e:
+        # Somebody else published the same content after we checked
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        logging.debug("%s was published concurrently", key)
+    else:
+        logging.debug("Published %s to %s", key, store_path)
+    return store_path
+
+
+def link_index(index_path, store_path):
+    """
+    Points a package's index entry at a tree in the store. Trees from
+    older versions of buckit that live directly at the index path are left
+    alone
+    """
+    if os.path.isdir(index_path) and not os.path.islink(index_path):
+        return
+    target = os.path.relpath(store_path, os.path.dirname(index_path))
+    if os.path.islink(index_path) and os.readlink(index_path) == target:
+        return
+    tmp_link = '{}.{}.tmp'.format(index_path, uuid.uuid4().hex)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, index_path)
+
+
+@contextlib.contextmanager
+def entry_lock(path, shared=True, blocking=True):
+    """
+    Locks an entry in the cache (a store tree, or a git mirror) via a lock
+    file next to it. Fetchers hold a shared lock while they read an entry,
+    and garbage collection takes an exclusive one before evicting it
+
+    Arguments:
+        path - The path to the entry
+        shared - Whether to take a shared lock instead of an exclusive one
+        blocking - Whether to wait for the lock. If False and the lock is
+                   held elsewhere, False is yielded instead of True
+    """
+    flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    if not blocking:
+        flags |= fcntl.LOCK_NB
+    with open(path + '.lock', 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def populate_lock(path, package_name):
+    """
+    Takes the lock that makes sure that only one process at a time downloads
+    a given entry into the cache. If another process already holds it, this
+    waits for that fetch to finish, after which the caller should look the
+    package up in the cache again instead of downloading it
+
+    Arguments:
+        path - The store path from get_store_path() if the content key is
+               known before fetching, so that packages with the same
+               content are only downloaded once. Otherwise the index path
+               for the package from get_index_path()
+        package_name - The name of the package. Used in logging
+    """
+    # Entries from older versions of buckit live at the index path, so use
+    # a different lock than entry_lock() does for them
+    lock_path = path + '.populate'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with entry_lock(lock_path, shared=False, blocking=False) as locked:
+        if locked:
+            yield
+            return
+    logging.info(
+        "{bold}Waiting for another fetch of %s to finish{clear}", package_name
+    )
+    with entry_lock(lock_path, shared=False):
+        yield
+
+
+def get_tree_size(path):
+    """
+    Gets the number of bytes used by files underneath path. Files that are
+    hardlinked more than once inside of path are only counted once
+    """
+    seen = set()
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_size
+    return size
+
+
+def read_entry_info(path):
+    """
+    Reads the size and last use time of an entry in the cache. These are
+    recorded when entries are used, or computed for entries that predate
+    that
+
+    Returns:
+        A dictionary with 'size' in bytes and 'last_used' in seconds since
+        the epoch
+    """
+    try:
+        with open(path + '.meta', 'r') as fin:
+            info = json.loads(fin.read())
+        if 'size' in info and 'last_used' in info:
+            return info
+    except (IOError, ValueError):
+        pass
+    return touch(path, last_used=os.stat(path).st_mtime)
+
+
+def touch(path, last_used=None, update_size=False):
+    """
+    Records that an entry in the cache was just used
+
+    Arguments:
+        path - The path to the entry
+        last_used - If provided, the use time to record instead of now
+        update_size - Whether to recompute the size of an entry that has
+                      changed, like a git mirror that was just fetched into
+
+    Returns:
+        The recorded information. See read_entry_info()
+    """
+    info = {}
+    if not update_size:
+        try:
+            with open(path + '.meta', 'r') as fin:
+                info = json.loads(fin.read())
+        except (IOError, ValueError):
+            pass
+    if 'size' not in info:
+        info['size'] = get_tree_size(path)
+    info['last_used'] = time.time() if last_used is None else last_used
+
+    meta_path = path + '.meta'
+    tmp_path = '{}.{}.tmp'.format(meta_path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as fout:
+        fout.write(json.dumps(info))
+    os.replace(tmp_path, meta_path)
+    return info
+
+
+def get_entries(cache_root):
+    """
+    Gets all entries in the cache that can be evicted: trees in the store,
+    git mirrors, and trees that older versions of buckit stored directly at
+    their index path
+    """
+    entries = []
+    for directory in (STORE_DIR, GIT_MIRRORS_DIR):
+        directory = os.path.join(cache_root, directory)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                entries.append(path)
+    for name in os.listdir(cache_root):
+        path = os.path.join(cache_root, name)
+        if (name.startswith(INDEX_PREFIX) and os.path.isdir(path) and
+                not os.path.islink(path)):
+            entries.append(path)
+    return entries
+
+
+def get_partial_entries(cache_root):
+    """
+    Gets all partial downloads in the cache. Downloads that are abandoned
+    are never resumed, so these are evicted like any other entry
+
+    Returns:
+        The paths that were passed to get_partial_path() for the downloads
+    """
+    partial_dir = os.path.join(cache_root, PARTIAL_DIR)
+    if not os.path.isdir(partial_dir):
+        return []
+    partials = set()
+    for name in os.listdir(partial_dir):
+        if name.endswith('.part.journal'):
+            name = name[:-len('.journal')]
+        if name.endswith('.part'):
+            partials.add(os.path.join(partial_dir, name))
+    return sorted(partials)
+
+
+def read_partial_info(partial_path):
+    """
+    Reads the size and last use time of a partial download and its journal,
+    like read_entry_info() does for other entries. A partial download is in
+    use for as long as it is written to, so its modification time is used
+    """
+    info = {'size': 0, 'last_used': 0}
+    for path in (partial_path, partial_path + '.journal'):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        info['size'] += st.st_size
+        info['last_used'] = max(info['last_used'], st.st_mtime)
+    return info
+
+
+def parse_size(size):
+    """
+    Parses a size like 1024, 500M or 20G into a number of bytes
+    """
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', size, re.I)
+    if not match:
+        raise BuckitException("Could not parse size '{}'", size)
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}TiB'.format(size)
+
+
+def evict(path):
+    """
+    Removes an entry from the cache. The caller must hold an exclusive
+    entry_lock() on it
+    """
+    # Move it out of the way first, so that nobody sees a half deleted tree
+    doomed = '{}.{}.evicting'.format(path, uuid.uuid4().hex)
+    os.rename(path, doomed)
+    shutil.rmtree(doomed)
+    if os.path.exists(path + '.meta'):
+        os.remove(path + '.meta')
+
+
+def remove_lock_files(path):
+    """
+    Removes the lock files of an entry that is no longer in the cache. The
+    caller must hold an exclusive entry_lock() on it, if it has one. The
+    populate_lock() is only removed if nobody is holding it
+    """
+    populate_lock_path = path + '.populate.lock'
+    if os.path.exists(populate_lock_path):
+        with entry_lock(
+            path + '.populate', shared=False, blocking=False
+        ) as locked:
+            if locked:
+                os.remove(populate_lock_path)
+    if os.path.exists(path + '.lock'):
+        os.remove(path + '.lock')
+
+
+def remove_dangling_indexes(cache_root):
+    for name in os.listdir(cache_root):
+        path = os.path.join(cache_root, name)
+        if (name.startswith(INDEX_PREFIX) and os.path.islink(path) and
+                not os.path.exists(path)):
+            logging.debug("Removing dangling index %s", path)
+            os.remove(path)
+            remove_lock_files(path)
+
+
+def garbage_collect(cache_root, max_size):
+    """
+    Evicts the least recently used entries from the cache until it is no
+    bigger than max_size. Entries that are in use by a fetcher are skipped.
+    Partial downloads count toward the size too, and are evicted along with
+    their journals
+
+    Arguments:
+        cache_root - The root of the cache from get_cache_root()
+        max_size - The size budget for the cache, in bytes
+
+    Returns:
+        A tuple of (number of entries evicted, bytes freed, bytes remaining)
+    """
+    entries = [
+        (path, read_entry_info(path), False)
+        for path in get_entries(cache_root)
+    ] + [
+        (path, read_partial_info(path), True)
+        for path in get_partial_entries(cache_root)
+    ]
+    entries.sort(key=lambda entry: entry[1]['last_used'])
+    total = sum(info['size'] for _, info, _ in entries)
+    evicted = 0
+    freed = 0
+    for path, info, is_partial in entries:
+        if total <= max_size:
+            break
+        # Fetchers lock partial downloads with the same lock file while they
+        # write to them
+        with entry_lock(path, shared=False, blocking=False) as locked:
+            if not locked or not (is_partial or os.path.isdir(path)):
+                logging.debug("%s is in use, not evicting it", path)
+                continue
+            logging.info(
+                "Evicting %s (%s) from the cache", path,
+                format_size(info['size'])
+            )
+            if is_partial:
+                remove_partial(path)
+            else:
+                evict(path)
+            remove_lock_files(path)
+        total -= info['size']
+        freed += info['size']
+        evicted += 1
+    remove_dangling_indexes(cache_root)
+    return evicted, freed, total
+
+
+def maybe_garbage_collect(cache_root):
+    """
+    Garbage collects the cache if a budget was set in the environment with
+    BUCKIT_CACHE_MAX_SIZE
+    """
+    max_size = os.environ.get(MAX_SIZE_ENVVAR)
+    if not max_size:
+        return
+    evicted, freed, total = garbage_collect(cache_root, parse_size(max_size))
+    if evicted:
+        logging.info(
+            "Evicted %s cache entries (%s), cache is now %s", evicted,
+            format_size(freed), format_size(total)
+        )
+
+
+def garbage_collect_command(max_size):
+    """
+    Runs `buckit cache gc`
+    """
+    cache_root = get_cache_root()
+    evicted, freed, total = garbage_collect(cache_root, parse_size(max_size))
+    logging.info(
+        "{bold}Evicted %s cache entries (%s) from %s, cache is now %s{clear}",
+        evicted, format_size(freed), cache_root, format_size(total)
+    )
+    return 0
+
+
+def materialize(store_path, destination):
+    """
+    Creates destination as a copy of a tree in the store. Files are
+    reflinked or hardlinked where possible, so that checkouts on a host share
+    data on disk, and only copied as a last resort
+
+    Arguments:
+        store_path - The path to the tree in the store
+        destination - The directory to create. It must not exist
+
+    Returns:
+        A Counter of materialization strategy to the number of files that
+        were created with it
+    """
+    return materializers.materialize_tree(store_path, destination)
@@ -7,13 +7,17 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
+import hashlib
 import logging
 import os
 import subprocess
 import platform
 
+from concurrent.futures import ThreadPoolExecutor
+
 from constants import BUCKCONFIG_LOCAL
 from configure_buck import update_config
+from project_state import ProjectState
 
 
 def get_current_platform_flavor():
@@ -124,16 +128,22 @@ def detect_cxx():
     return None
 
 
-def detect_c_standard(compiler_cmd):
-    versions = [
-        '-std=gnu11',
-        '-std=c11',
-        '-std=gnu99',
-        '-std=c99',
-    ]
-    for version in versions:
+def detect_standard(compiler_cmd, language, versions):
+    """
+    Finds the first of versions that compiler_cmd supports. All versions are
+    tried at once
+
+    Arguments:
+        compiler_cmd - The compiler to check
+        language - The language to pass to -x, e.g. c or c++
+        versions - The -std= flags to try, in order of preference
+
+    Returns:
+        The first supported flag in versions, or None
+    """
+    def check(version):
         logging.debug("Checking %s support for -std=%s", compiler_cmd, version)
-        cmd = [compiler_cmd, version, '-x', 'c', '-']
+        cmd = [compiler_cmd, version, '-fsyntax-only', '-x', language, '-']
         proc = subprocess.Popen(
             cmd,
             stdin=subprocess.PIPE,
@@ -148,12 +158,27 @@ def detect_c_standard(compiler_cmd):
                 "Got return code %s, output: %s. trying next", proc.returncode,
                 stdout
             )
-        else:
-            return version
+            return False
+        return True
 
+    with ThreadPoolExecutor(max_workers=len(versions)) as executor:
+        supported = list(executor.map(check, versions))
+    for version, is_supported in zip(versions, supported):
+        if is_supported:
+            return version
     return None
 
 
+def detect_c_standard(compiler_cmd):
+    versions = [
+        '-std=gnu11',
+        '-std=c11',
+        '-std=gnu99',
+        '-std=c99',
+    ]
+    return detect_standard(compiler_cmd, 'c', versions)
+
+
 def detect_cxx_standard(compiler_cmd):
     versions = [
         # '-std=gnu++1z',
@@ -165,27 +190,69 @@ def detect_cxx_standard(compiler_cmd):
         '-std=gnu++11',
         '-std=c++11',
     ]
-    for version in versions:
-        logging.debug("Checking %s support for -std=%s", compiler_cmd, version)
-        cmd = [compiler_cmd, version, '-x', 'c++', '-']
-        proc = subprocess.Popen(
-            cmd,
-            stdin=subprocess.PIPE,
+    return detect_standard(compiler_cmd, 'c++', versions)
+
+
+def get_version_fingerprint(command):
+    """
+    Gets a hash of what `command --version` prints
+
+    Arguments:
+        command - The compiler or interpreter to run
+
+    Returns:
+        The sha1 of the combined stdout and stderr, or None if command could
+        not be run
+    """
+    try:
+        proc = subprocess.run(
+            [command, '--version'],
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT
-        )
-        stdout, stderr = proc.communicate(
-            'int main() { return 0; }'.encode('utf-8')
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            timeout=30,
         )
-        if proc.returncode != 0:
-            logging.debug(
-                "Got return code %s, output: %s. trying next", proc.returncode,
-                stdout
-            )
-        else:
-            return version
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return hashlib.sha1(proc.stdout).hexdigest()
 
-    return None
+
+def cached_detect(state, name, command, detect):
+    """
+    Runs detect(command), reusing the result from an earlier run if the
+    binary that command resolves to has not changed since then
+
+    Shims like pyenv's or ccache's can switch the real compiler without
+    touching the binary on PATH, so the output of `command --version` is
+    part of what has to stay the same for the cached result to be used
+
+    Arguments:
+        state - The ProjectState to cache results in
+        name - The name of what is being detected, e.g. cxx_standard
+        command - The compiler or interpreter to run
+        detect - A function that takes command and returns a json
+                 serializable result
+    """
+    binary = which(command, get_canonical=True) if command else None
+    if not binary:
+        return detect(command)
+    st = os.stat(binary)
+    key = 'toolchain.{}.{}'.format(name, command)
+    context = {
+        'binary': binary,
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'CC': os.environ.get('CC'),
+        'CXX': os.environ.get('CXX'),
+        'version': get_version_fingerprint(command),
+    }
+    cached = state.get(key, context)
+    if cached is not None:
+        logging.debug("Using cached %s for %s", name, binary)
+        return cached['result']
+    result = detect(command)
+    state.set(key, {'result': result}, {}, context)
+    return result
 
 
 def configure_compiler(project_root):
@@ -204,13 +271,16 @@ def configure_compiler(project_root):
         logging.warn("Could not find clang or g++ in PATH")
         return 0
 
-    c_standard = detect_c_standard(cc)
+    state = ProjectState(project_root)
+    c_standard = cached_detect(state, 'c_standard', cc, detect_c_standard)
     if c_standard:
         cflags = [c_standard]
     else:
         cflags = []
 
-    cxx_standard = detect_cxx_standard(cxx)
+    cxx_standard = cached_detect(
+        state, 'cxx_standard', cxx, detect_cxx_standard
+    )
     if cxx_standard:
         cxxflags = [cxx_standard]
     else:
@@ -218,10 +288,18 @@ def configure_compiler(project_root):
 
     py2 = detect_py2()
     py3 = detect_py3()
-    py2_include = detect_python_include(py2)
-    py2_libs = detect_python_libs(py2)
-    py3_include = detect_python_include(py3)
-    py3_libs = detect_python_libs(py3)
+    py2_include = py2_libs = py3_include = py3_libs = None
+    if py2:
+        py2_include = cached_detect(
+            state, 'python_include', py2, detect_python_include
+        )
+        py2_libs = cached_detect(state, 'python_libs', py2, detect_python_libs)
+    if py3:
+        py3_include = cached_detect(
+            state, 'python_include', py3, detect_python_include
+        )
+        py3_libs = cached_detect(state, 'python_libs', py3, detect_python_libs)
+    state.save()
 
     to_set = {
         'cxx': {
@@ -14,18 +14,25 @@ import io
 import json
 import logging
 import os
+import shutil
 import threading
+import uuid
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import compiler
-from constants import PACKAGE_JSON, BUCKCONFIG, BUCKCONFIG_LOCAL
+from constants import PACKAGE_JSON, BUCKCONFIG, BUCKCONFIG_LOCAL, YARN_LOCK
 from helpers import BuckitException
+from project_state import ProjectState, get_signature, get_signatures
 
 PackageInfo = namedtuple(
     'PackageInfo',
     ['name', 'cell_name', 'cell_alias', 'absolute_path', 'includes_info']
 )
 IncludesInfo = namedtuple('IncludesInfo', ['path', 'whitelist_functions'])
+PackageGraph = namedtuple(
+    'PackageGraph', ['paths', 'root_deps', 'jsons', 'dependencies']
+)
 
 BUCKCONFIG_HEADER = r'''
 # This configuration file was updated by buckit. Manual changes
@@ -36,9 +43,16 @@ BUCKCONFIG_HEADER = r'''
 '''
 
 
+# How many cells' .buckconfig.local files are written at once
+CONFIG_WRITE_JOBS = 8
+
 __file_lock_counts = defaultdict(int)
 __mutex = threading.RLock()
 
+# Path to ((mtime, size), parsed json) for read_package_json()
+__package_json_cache = {}
+__package_json_lock = threading.Lock()
+
 
 @contextlib.contextmanager
 def __lockfile(project_root):
@@ -130,11 +144,36 @@ def __update_config(
                              to remove from the config. This is applied after
                              updates provided in `new_properties`
     """
-    merge = merge or {}
+    config = __read_config(buckconfig)
+    logging.debug("Updating file at %s", buckconfig)
+    __set_config_values(
+        config, new_properties, override, merge, removed_properties
+    )
+    __write_config(buckconfig, config)
+
+
+def __read_config(buckconfig):
+    """
+    Parses a .buckconfig style file, or returns an empty config if it does
+    not exist
+    """
     config = configparser.ConfigParser()
     if os.path.exists(buckconfig):
         config.read(buckconfig)
-    logging.debug("Updating file at %s", buckconfig)
+    return config
+
+
+def __set_config_values(
+        config,
+        new_properties,
+        override=False,
+        merge=None,
+        removed_properties=None):
+    """
+    Applies the changes that __update_config() describes to an already
+    parsed config, without writing it out
+    """
+    merge = merge or {}
     for section, kvs in new_properties.items():
         if not config.has_section(section):
             config.add_section(section)
@@ -171,10 +210,73 @@ def __update_config(
                 for key in keys:
                     config.remove_option(section, key)
 
-    with open(buckconfig, 'w') as fout:
-        fout.write(BUCKCONFIG_HEADER)
-        config.write(fout)
+
+def __write_config(buckconfig, config):
+    """
+    Writes a parsed config out to buckconfig if that changes its contents.
+    Buck treats any modification of a config file as a config change and
+    throws away its parser cache, so unchanged files are left alone. The
+    file is replaced atomically, so buck never sees a partially written file.
+    A symlinked buckconfig stays a symlink, as its target is what gets
+    replaced, and the replaced file keeps its permissions
+
+    Returns:
+        True if the file was written, False if it was already up to date
+    """
+    buckconfig = os.path.realpath(buckconfig)
+    contents = io.StringIO()
+    contents.write(BUCKCONFIG_HEADER)
+    config.write(contents)
+    contents = contents.getvalue()
+    try:
+        with open(buckconfig, 'r') as fin:
+            if fin.read() == contents:
+                logging.debug("%s is unchanged, not writing it", buckconfig)
+                return False
+    except FileNotFoundError:
+        pass
+
+    tmp_path = '{}.{}.tmp'.format(buckconfig, uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'w') as fout:
+            fout.write(contents)
+        if os.path.exists(buckconfig):
+            shutil.copymode(buckconfig, tmp_path)
+        os.replace(tmp_path, buckconfig)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     logging.debug("Updated file at %s", buckconfig)
+    return True
+
+
+def read_package_json(json_path):
+    """
+    Parses a package.json file. Results are cached by path and only reparsed
+    when the file's modification time or size change, so this is cheap to
+    call repeatedly for the same file
+
+    Arguments:
+        json_path - The path to the package.json file
+
+    Returns:
+        The parsed json, or None if json_path does not exist. The result is
+        shared between callers, and must not be modified
+    """
+    try:
+        st = os.stat(json_path)
+    except FileNotFoundError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    with __package_json_lock:
+        cached = __package_json_cache.get(json_path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(json_path, 'r') as fin:
+        js = json.loads(fin.read())
+    with __package_json_lock:
+        __package_json_cache[json_path] = (key, js)
+    return js
 
 
 def parse_package_info(package_path):
@@ -191,31 +293,32 @@ def parse_package_info(package_path):
     package_path = os.path.abspath(package_path)
     json_path = os.path.join(package_path, PACKAGE_JSON)
     try:
-        with open(json_path, 'r') as fin:
-            js = json.loads(fin.read())
-            buckit = js.get('buckit', {})
-            cell_name = buckit.get('cell_name', js['name'])
-            includes = buckit.get('includes', None)
-            if includes:
-                includes_info = IncludesInfo(
-                    includes.get('path', None),
-                    includes.get('whitelist_functions', [])
-                )
-                if not isinstance(includes_info.path, str):
-                    raise BuckitException(
-                        "buckit.includes in {} should be a string", json_path)
-                if not isinstance(includes_info.whitelist_functions, list):
-                    raise BuckitException(
-                        "buckit.whitelist_functions in {} should be a list",
-                        json_path)
-            else:
-                includes_info = None
-
-            return PackageInfo(
-                js["name"],
-                cell_name.split('/')[-1],
-                'yarn|{}'.format(js["name"]), package_path, includes_info
+        js = read_package_json(json_path)
+        if js is None:
+            raise IOError('{} does not exist'.format(json_path))
+        buckit = js.get('buckit', {})
+        cell_name = buckit.get('cell_name', js['name'])
+        includes = buckit.get('includes', None)
+        if includes:
+            includes_info = IncludesInfo(
+                includes.get('path', None),
+                includes.get('whitelist_functions', [])
             )
+            if not isinstance(includes_info.path, str):
+                raise BuckitException(
+                    "buckit.includes in {} should be a string", json_path)
+            if not isinstance(includes_info.whitelist_functions, list):
+                raise BuckitException(
+                    "buckit.whitelist_functions in {} should be a list",
+                    json_path)
+        else:
+            includes_info = None
+
+        return PackageInfo(
+            js["name"],
+            cell_name.split('/')[-1],
+            'yarn|{}'.format(js["name"]), package_path, includes_info
+        )
     except Exception as e:
         raise BuckitException(
             "Could not read property 'buckit.name' or 'name' from "
@@ -278,11 +381,11 @@ def find_project_root(start_path, node_modules=None):
     return package_path
 
 
-def __update_root_buckconfig(project_root, package_info, is_root_dep):
+def __update_root_buckconfig(config, package_info, is_root_dep):
     """
-    Updates the root .buckconfig with `cell=alias` in the repositories section
+    Updates the parsed root .buckconfig with `cell=alias` in the
+    repositories section
     """
-    buckconfig = os.path.join(project_root, BUCKCONFIG)
     repos = 'repositories'
     project = 'project'
     buildfile = 'buildfile'
@@ -309,33 +412,134 @@ def __update_root_buckconfig(project_root, package_info, is_root_dep):
         )
         to_set[buildfile]['includes'] = new_includes
 
-    __update_config(
-        buckconfig, to_set, merge={'{}.{}'.format(project, whitelist_key): ','}
+    __set_config_values(
+        config, to_set, merge={'{}.{}'.format(project, whitelist_key): ','}
     )
 
 
-def __update_root_buckconfig_local(project_root, package_info):
+def __update_root_buckconfig_local(config, project_root, package_info):
     """
-    Updates the root .buckconfig with `alias=path_relative_to_root` in the
-    repository_aliases section
+    Updates the parsed root .buckconfig.local with
+    `alias=path_relative_to_root` in the repository_aliases section
     """
-    buckconfig_local = os.path.join(project_root, BUCKCONFIG_LOCAL)
     relative_path = os.path.relpath(package_info.absolute_path, project_root)
 
-    logging.debug("Updating root buckconfig.local at %s", buckconfig_local)
+    logging.debug(
+        "Updating root buckconfig.local for %s", package_info.cell_alias
+    )
 
     to_set = {
         'repository_aliases': {package_info.cell_alias: relative_path},
         'log': {'buckconfig_local_warning_enabled': 'false'},
     }
-    __update_config(buckconfig_local, to_set)
+    __set_config_values(config, to_set)
+
+
+def __find_override_sections(config, platform, cells):
+    """
+    Finds the platform override sections in the root .buckconfig.local
+
+    Arguments:
+        config - The parsed root .buckconfig.local
+        platform - The current platform flavor
+        cells - The cells that .buckconfig.local files will be written for
+
+    Returns:
+        A list of (section, base section, cell) in the order that they appear
+        in config. cell is None for overrides that apply to all cells
+    """
+    general_override = '#buckit-' + platform
+    package_overrides = [
+        ('#buckit-{}-{}'.format(cell, platform), cell) for cell in cells
+    ]
+    overrides = []
+    for section in config.sections():
+        for package_override, cell in package_overrides:
+            if section.endswith(package_override):
+                overrides.append(
+                    (section, section[:-len(package_override)], cell)
+                )
+        if section.endswith(general_override):
+            overrides.append(
+                (section, section[:-len(general_override)], None)
+            )
+    return overrides
+
+
+def __update_package_buckconfig_local(
+    project_root, buckconfig_local, config_string, section, package_path,
+    cell, platform, overrides
+):
+    """
+    Writes the .buckconfig.local for a single cell. See
+    __update_packages_buckconfig_local()
+
+    Returns:
+        True if the file was changed
+    """
+    package_buckconfig_local = os.path.join(package_path, BUCKCONFIG_LOCAL)
+    package_config = configparser.ConfigParser()
+    package_config.read_string(config_string)
+
+    logging.debug("Updating .buckconfig.local at %s", package_buckconfig_local)
+
+    for cell_alias, root_relative_path in package_config.items(section):
+        relative_path = os.path.relpath(
+            os.path.abspath(os.path.join(project_root, root_relative_path)),
+            os.path.abspath(package_path)
+        )
+        package_config.set(section, cell_alias, relative_path)
+
+    # If a section ends in #buckit-<platform> or #buckit-<cell>-<platform>
+    # copy that section into <section>#platform instead. This lets us
+    # override specific sections for third party or single cells, but
+    # does not make us change all of the other platform sections, which
+    # would be the case if we set the default_platform (e.g. setting a
+    # cxx platform would mean we would have to set python sections up
+    # as well)
+    if cell:
+        package_override = '#buckit-{}-{}'.format(cell, platform)
+        for src_section, base, override_cell in overrides:
+            if override_cell is None:
+                package_section = '{}#{}'.format(base, package_override)
+                if package_config.has_section(package_section):
+                    continue
+            elif override_cell != cell:
+                continue
+
+            dest_section = '{}#{}'.format(base, platform)
+
+            logging.debug(
+                'Overwriting section %s in %s with %s from %s',
+                dest_section, package_buckconfig_local, src_section,
+                buckconfig_local)
+
+            package_config.remove_section(dest_section)
+            package_config.add_section(dest_section)
+
+            for k, v in package_config.items(src_section):
+                package_config.set(dest_section, k, v)
+            package_config.remove_section(src_section)
+
+    if not __write_config(package_buckconfig_local, package_config):
+        return False
+    logging.debug(
+        "{bold}Updated .buckconfig.local at %s{clear}",
+        package_buckconfig_local
+    )
+    return True
 
 
 def __update_packages_buckconfig_local(project_root):
     """
     Updates all .buckconfig.local files in all directories specified in
     the root's repository_aliases section. This copies the root
-    .buckconfig.local, and makes all of the paths relative to the cell
+    .buckconfig.local, and makes all of the paths relative to the cell.
+    Cells are independent, so their files are written concurrently
+
+    Returns:
+        A tuple of (the paths to all cells' .buckconfig.local files, the
+        paths of cells that were skipped because they do not exist yet)
     """
     buckconfig_root = os.path.join(project_root, BUCKCONFIG)
     root_config = configparser.ConfigParser()
@@ -356,134 +560,136 @@ def __update_packages_buckconfig_local(project_root):
     config = configparser.ConfigParser()
     if not os.path.exists(buckconfig_local):
         logging.debug('.buckconfig at %s does not exist', buckconfig_local)
-        return
+        return [], []
     config.read(buckconfig_local)
     if not config.has_section(section):
         logging.debug('[%s] was not found in %s', section, buckconfig_local)
-        return
+        return [], []
 
     config_string = io.StringIO()
     config.write(config_string)
+    config_string = config_string.getvalue()
 
+    # For all cells, make sure they have a copy of the .buckconfig.local.
+    # Update its paths to have proper relative paths, rather than the ones
+    # copied from the root
+    cells = []
+    missing_cells = []
     for alias, package_path in config.items(section):
-        # For all cells, make sure they have a copy of the .buckconfig.local.
-        # Update its paths to have proper relative paths, rather than the ones
-        # copied from the root
         package_path = os.path.join(project_root, package_path)
         if not os.path.exists(package_path):
             logging.debug("Package path %s does not exist", package_path)
+            missing_cells.append(package_path)
             continue
+        cells.append((package_path, root_repositories.get(alias)))
 
-        package_buckconfig_local = os.path.join(package_path, BUCKCONFIG_LOCAL)
-        package_config = configparser.ConfigParser()
-        config_string.seek(0)
-        package_config.read_file(config_string)
-
-        logging.debug(
-            "Updating .buckconfig.local at %s", package_buckconfig_local
-        )
-
-        for cell_alias, root_relative_path in package_config.items(section):
-            relative_path = os.path.relpath(
-                os.path.abspath(os.path.join(project_root, root_relative_path)),
-                os.path.abspath(package_path)
-            )
-            package_config.set(section, cell_alias, relative_path)
-
-        # If a section ends in #buckit-<platform> or #buckit-<cell>-<platform>
-        # copy that section into <section>#platform instead. This lets us
-        # override specific sections for third party or single cells, but
-        # does not make us change all of the other platform sections, which
-        # would be the case if we set the default_platform (e.g. setting a
-        # cxx platform would mean we would have to set python sections up
-        # as well)
-        cell = root_repositories.get(alias)
-        if cell:
-            platform = compiler.get_current_platform_flavor()
-            general_override = '#buckit-' + platform
-            package_override = '#buckit-{}-{}'.format(cell, platform)
-            for src_section in list(package_config.sections()):
-                if src_section.endswith(package_override):
-                    base = src_section[:-len(package_override)]
-                elif src_section.endswith(general_override):
-                    base = src_section[:-len(general_override)]
-                    package_section = '{}#{}'.format(base, package_override)
-                    if package_config.has_section(package_section):
-                        continue
-                else:
-                    continue
-
-                dest_section = '{}#{}'.format(base, platform)
-
-                logging.debug(
-                    'Overwriting section %s in %s with %s from %s',
-                    dest_section, package_buckconfig_local, src_section,
-                    buckconfig_local)
-
-                package_config.remove_section(dest_section)
-                package_config.add_section(dest_section)
+    platform = compiler.get_current_platform_flavor()
+    overrides = __find_override_sections(
+        config, platform, set(cell for _, cell in cells if cell)
+    )
 
-                for k, v in package_config.items(src_section):
-                    package_config.set(dest_section, k, v)
-                package_config.remove_section(src_section)
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(CONFIG_WRITE_JOBS, len(cells)))
+    ) as executor:
+        futures = [
+            executor.submit(
+                __update_package_buckconfig_local, project_root,
+                buckconfig_local, config_string, section, package_path, cell,
+                platform, overrides
+            ) for package_path, cell in cells
+        ]
+        updated = sum(1 for future in futures if future.result())
+
+    logging.info(
+        "{bold}Updated %s of %s .buckconfig.local files in cells{clear}",
+        updated, len(cells)
+    )
+    return [
+        os.path.join(package_path, BUCKCONFIG_LOCAL)
+        for package_path, _ in cells
+    ], missing_cells
 
-        with open(package_buckconfig_local, 'w') as fout:
-            fout.write(BUCKCONFIG_HEADER)
-            package_config.write(fout)
-            fout.flush()
 
-        logging.debug(
-            "{bold}Updated .buckconfig.local at %s{clear}",
-            package_buckconfig_local
-        )
+def __get_graph_context(node_modules):
+    """
+    Gets everything other than files that the root package's dependency
+    graph depends on. See ProjectState.get()
+    """
+    return {
+        'node_modules': node_modules,
+        'npm_package_name': os.environ.get('npm_package_name') or '',
+    }
 
 
-def find_package_paths(
-    project_root,
-    node_modules,
-    package_name='',
-    already_found=None
+def build_dependency_graph(
+    project_root, node_modules, package_name='', state=None
 ):
     """
-    Find all the packages in a given project root, return information about
-    each of those packages.
+    Finds all the packages that a package transitively depends on. Each
+    package.json is read once, no matter how many packages depend on it.
+
+    The graph for the root package is stored in the project's state file,
+    and reused until one of the package.json files or yarn.lock changes.
+    Their signatures are taken before they are read, so that an edit that
+    races with this is noticed on the next run
 
     Arguments:
         project_root - The root path of the main project
         node_modules - The name of the node_modules directory in project_root
         package_name - The name of the package underneath node_modules, or
                        empty if the root package.json should be examined
-        already_found - A list of package names that have already been
-                        investigated. Used for cycle detection
+        state - If provided, the ProjectState to use for the root package.
+                The caller is responsible for saving it
 
-    Returns a tuple of (
-        dictionary of package names to paths,
-        set of all of root's direct dependencies,
-        dictionary of package names to original parsed json
-    )
+    Returns:
+        A PackageGraph. paths, jsons and dependencies only contain packages
+        whose package.json could be found
     """
-    already_found = already_found or []
-    jsons = {}
-    if package_name:
-        # Look for cells that have compiled artifacts first
-        package_root = os.path.join(project_root, node_modules, package_name)
-        package_json = os.path.join(package_root, PACKAGE_JSON)
-    else:
-        package_json = os.path.join(project_root, PACKAGE_JSON)
-
-    if os.path.exists(package_json):
-        with open(package_json, 'r') as fin:
-            js = json.loads(fin.read())
-    elif package_name:
-        logging.debug(
-            "Could not find a json file at %s for package %s", package_json,
-            package_name)
-        return {}, set(), jsons
-    else:
-        js = {}
+    save_state = False
+    if not package_name:
+        if state is None:
+            state = ProjectState(project_root)
+            save_state = True
+        cached = state.get('graph', __get_graph_context(node_modules))
+        if cached is not None:
+            logging.debug("Using the cached dependency graph")
+            if save_state:
+                state.save()
+            return PackageGraph(
+                cached['paths'], set(cached['root_deps']), cached['jsons'],
+                cached['dependencies']
+            )
+
+    def get_package_root(name):
+        if name:
+            return os.path.join(project_root, node_modules, name)
+        return project_root
 
     paths = {}
+    jsons = {}
+    dependencies = {}
     root_deps = set()
+    # The signatures of yarn.lock and every package.json that was looked at,
+    # including missing ones
+    inputs = {}
+    if not package_name:
+        yarn_lock = os.path.join(project_root, YARN_LOCK)
+        inputs[yarn_lock] = get_signature(yarn_lock)
+
+    def read_json(json_path):
+        if not package_name:
+            inputs[json_path] = get_signature(json_path)
+        return read_package_json(json_path)
+
+    package_json = os.path.join(get_package_root(package_name), PACKAGE_JSON)
+    js = read_json(package_json)
+    if js is None:
+        if package_name:
+            logging.debug(
+                "Could not find a json file at %s for package %s",
+                package_json, package_name)
+            return PackageGraph(paths, root_deps, jsons, dependencies)
+        js = {}
 
     # When a package is first added with yarn add, it will not be present
     # in package.json in the project root. It will, however, be mentioned in
@@ -493,31 +699,86 @@ def find_package_paths(
     # look at all of the root dependencies. Also note that yarn run buckit X
     # will populate npm_package_name ,but with a blank string, so we do a
     # truthy check
-    env_deps = {
-        os.environ['npm_package_name']: os.environ.get('npm_package_version', '*')
-    } if not package_name and os.environ.get('npm_package_name') else {}
-    js_deps = js.get('dependencies', {}).copy()
-    js_deps.update(env_deps)
-
-    for dep in js_deps:
-        if dep in already_found:
-            raise BuckitException(
-                'Found a cycle when finding dependencies: {}',
-                ' -> '.join(already_found))
-        already_found.append(dep)
-        dep_paths, ignore, dep_jsons = find_package_paths(
-            project_root, node_modules, dep, already_found
-        )
-        paths.update(dep_paths)
-        jsons.update(dep_jsons)
-        if not package_name:
-            root_deps.add(dep)
-        del already_found[-1]
+    deps = list(js.get('dependencies', {}))
+    if not package_name:
+        env_package = os.environ.get('npm_package_name')
+        if env_package and env_package not in deps:
+            deps.append(env_package)
+        root_deps.update(deps)
+    else:
+        paths[package_name] = get_package_root(package_name)
+        jsons[package_name] = js
+    dependencies[package_name] = deps
+
+    # Packages that have been fully explored are skipped when they are
+    # reached again. Packages on the current path are tracked in a set, as
+    # reaching one of them again means that there is a cycle
+    resolved = set([package_name])
+    chain = []
+    in_chain = set()
+
+    def visit(name):
+        for dep in dependencies[name]:
+            if dep in in_chain:
+                raise BuckitException(
+                    'Found a cycle when finding dependencies: {}',
+                    ' -> '.join(chain + [dep]))
+            if dep in resolved:
+                continue
+            resolved.add(dep)
+            dep_json = os.path.join(get_package_root(dep), PACKAGE_JSON)
+            dep_js = read_json(dep_json)
+            if dep_js is None:
+                logging.debug(
+                    "Could not find a json file at %s for package %s",
+                    dep_json, dep)
+                continue
+            paths[dep] = get_package_root(dep)
+            jsons[dep] = dep_js
+            dependencies[dep] = list(dep_js.get('dependencies', {}))
+            chain.append(dep)
+            in_chain.add(dep)
+            visit(dep)
+            in_chain.remove(dep)
+            chain.pop()
 
     if package_name:
-        paths[package_name] = package_root
-        jsons[package_name] = js
-    return paths, root_deps, jsons
+        chain.append(package_name)
+        in_chain.add(package_name)
+    visit(package_name)
+    graph = PackageGraph(paths, root_deps, jsons, dependencies)
+
+    if not package_name:
+        value = graph._asdict()
+        value['root_deps'] = sorted(root_deps)
+        state.set(
+            'graph', value, inputs, __get_graph_context(node_modules)
+        )
+        state.remove('configs')
+        if save_state:
+            state.save()
+    return graph
+
+
+def find_package_paths(project_root, node_modules, package_name=''):
+    """
+    Find all the packages in a given project root, return information about
+    each of those packages.
+
+    Arguments:
+        project_root - The root path of the main project
+        node_modules - The name of the node_modules directory in project_root
+        package_name - The name of the package underneath node_modules, or
+                       empty if the root package.json should be examined
+
+    Returns a tuple of (
+        dictionary of package names to paths,
+        set of all of root's direct dependencies,
+        dictionary of package names to original parsed json
+    )
+    """
+    graph = build_dependency_graph(project_root, node_modules, package_name)
+    return graph.paths, graph.root_deps, graph.jsons
 
 
 def configure_buck_for_all_packages(project_root, node_modules):
@@ -533,15 +794,42 @@ def configure_buck_for_all_packages(project_root, node_modules):
         node_modules - The name of the node_modules directory in project_root
     """
     with __lockfile(project_root):
-        package_paths, root_deps, jsons = find_package_paths(
-            project_root, node_modules
-        )
-
+        state = ProjectState(project_root)
+        graph = build_dependency_graph(project_root, node_modules, state=state)
+        package_paths = graph.paths
+        root_deps = graph.root_deps
+
+        # If no package.json and none of the configs that were written last
+        # time changed, there is nothing to do
+        context = __get_graph_context(node_modules)
+        if state.get('configs', context) is not None:
+            logging.info("{bold}Buck configuration is up to date{clear}")
+            state.save()
+            return 0
+
+        # Parse and write each root config once, rather than once per package
+        buckconfig = os.path.join(project_root, BUCKCONFIG)
+        buckconfig_local = os.path.join(project_root, BUCKCONFIG_LOCAL)
+        config = __read_config(buckconfig)
+        config_local = __read_config(buckconfig_local)
         for package_name, package_path in package_paths.items():
-            configure_buck_for_package(
-                project_root, package_name, package_path, root_deps, False
+            __configure_package(
+                config, config_local, project_root, package_name,
+                package_path, root_deps
             )
-        __update_packages_buckconfig_local(project_root)
+        __write_config(buckconfig, config)
+        __write_config(buckconfig_local, config_local)
+        cell_configs, missing_cells = __update_packages_buckconfig_local(
+            project_root
+        )
+        outputs = [buckconfig, buckconfig_local] + cell_configs
+
+        # Cells that do not exist yet need their config once they do
+        inputs = dict(state.data['graph']['inputs'])
+        inputs.update(get_signatures(outputs))
+        inputs.update((cell, None) for cell in missing_cells)
+        state.set('configs', outputs, inputs, context)
+        state.save()
 
     return 0
 
@@ -572,12 +860,31 @@ def configure_buck_for_package(
                                          in the project
     """
     with __lockfile(project_root):
-        package_path = package_path.rstrip('/')
-        package_info = parse_package_info(package_path)
-        __update_root_buckconfig(
-            project_root, package_info, package_name in root_deps
+        buckconfig = os.path.join(project_root, BUCKCONFIG)
+        buckconfig_local = os.path.join(project_root, BUCKCONFIG_LOCAL)
+        config = __read_config(buckconfig)
+        config_local = __read_config(buckconfig_local)
+        __configure_package(
+            config, config_local, project_root, package_name, package_path,
+            root_deps
         )
-        __update_root_buckconfig_local(project_root, package_info)
+        __write_config(buckconfig, config)
+        __write_config(buckconfig_local, config_local)
         if update_all_package_buckconfigs:
             __update_packages_buckconfig_local(project_root)
     return 0
+
+
+def __configure_package(
+    config, config_local, project_root, package_name, package_path, root_deps
+):
+    """
+    Updates the parsed root .buckconfig and .buckconfig.local to use a given
+    package. See configure_buck_for_package()
+    """
+    package_path = package_path.rstrip('/')
+    package_info = parse_package_info(package_path)
+    __update_root_buckconfig(
+        config, package_info, package_name in root_deps
+    )
+    __update_root_buckconfig_local(config_local, project_root, package_info)
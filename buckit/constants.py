@@ -11,3 +11,4 @@ PACKAGE_JSON = 'package.json'
 BUCKCONFIG = '.buckconfig'
 BUCKCONFIG_LOCAL = '.buckconfig.local'
 BUCKFILE = 'BUCK'
+YARN_LOCK = 'yarn.lock'
@@ -1,13 +1,22 @@
-import json
 import os
 import logging
 import shlex
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from collections import namedtuple
 
+import cache
+from configure_buck import find_package_paths, read_package_json
 from constants import PACKAGE_JSON
 from helpers import BuckitException
-from fetchers import PipFetcher, HttpTarballFetcher, GitFetcher
+from mirror import get_mirror
+from stats import fetch_stats
+from fetchers import (
+    CachedFetcher, PipFetcher, HttpTarballFetcher, GitFetcher,
+    batch_fetch_pip_packages
+)
 
 PythonSettings = namedtuple(
     'PythonSettings', [
@@ -34,11 +43,26 @@ def get_package_root(node_modules, package):
     return os.path.join(node_modules, package)
 
 
-def get_fetcher_from_repository(package_name, package_root, python_settings):
-    package_json = os.path.join(package_root, PACKAGE_JSON)
+def get_fetcher_from_repository(
+    package_name, package_root, python_settings, mirror=None
+):
+    """
+    Creates the fetcher for a package from its package.json
+
+    Arguments:
+        package_name - The name of the package
+        package_root - The directory that contains the package.json
+        python_settings - A PythonSettings object for pip packages
+        mirror - If provided, a LocalMirror that git and tarball sources are
+                 fetched from instead of the network
 
-    with open(package_json, 'r') as fin:
-        js = json.loads(fin.read())
+    Returns:
+        A tuple of (fetcher, destination directory)
+    """
+    package_json = os.path.join(package_root, PACKAGE_JSON)
+    js = read_package_json(package_json)
+    if js is None:
+        raise BuckitException("Could not find {}", package_json)
 
     short_name = js.get('name').split('/')[-1]
 
@@ -68,24 +92,26 @@ def get_fetcher_from_repository(package_name, package_root, python_settings):
         )
     elif repo_type == "git":
         dest_dir = os.path.join(package_root, short_name)
+        url = repository.get("url", "")
         return (
             GitFetcher(
                 package_name,
                 package_json,
-                repository.get("url", ""),
+                url,
                 repository.get("commit", None),
                 repository.get("tag", None),
+                mirror=mirror,
             ), dest_dir
         )
     elif repo_type == "tarball":
         dest_dir = os.path.join(package_root, short_name)
+        url = repository.get("url", "")
+        sha256 = repository.get("sha256", "")
+        if mirror:
+            url = mirror.tarball_url(url, sha256)
         return (
-            HttpTarballFetcher(
-                package_name,
-                package_json,
-                repository.get("url", ""),
-                repository.get("sha256", ""),
-            ), dest_dir
+            HttpTarballFetcher(package_name, package_json, url, sha256),
+            dest_dir
         )
     else:
         raise BuckitException(
@@ -93,14 +119,14 @@ def get_fetcher_from_repository(package_name, package_root, python_settings):
             package_json)
 
 
-def fetch_package(
-    project_root, node_modules, package, use_python2, python2_virtualenv,
-    python2_virtualenv_root, use_python3, python3_virtualenv,
-    python3_virtualenv_root, virtualenv_use_proxy_vars, force
+def get_python_settings(
+    project_root, use_python2, python2_virtualenv, python2_virtualenv_root,
+    use_python3, python3_virtualenv, python3_virtualenv_root
 ):
-    node_modules = os.path.realpath(os.path.join(project_root, node_modules))
-    package_root = get_package_root(node_modules, package)
-
+    """
+    Builds a PythonSettings object, making virtualenv roots absolute relative
+    to the project root
+    """
     if not os.path.isabs(python2_virtualenv_root):
         python2_virtualenv_root = os.path.join(
             project_root, python2_virtualenv_root
@@ -110,7 +136,7 @@ def fetch_package(
             project_root, python3_virtualenv_root
         )
 
-    python_settings = PythonSettings(
+    return PythonSettings(
         use_python2,
         use_python3,
         shlex.split(python2_virtualenv),
@@ -118,22 +144,209 @@ def fetch_package(
         shlex.split(python3_virtualenv),
         python3_virtualenv_root,
     )
+
+
+def run_fetcher(project_root, fetcher, dest_dir, force, use_proxy):
+    """
+    Runs a single fetcher if the destination needs to be (re)fetched
+    """
+    if fetcher.should_fetch(dest_dir, force):
+        fetch_stats.record(fetcher.package_name, type=fetcher.TYPE)
+        try:
+            with fetch_stats.timed(fetcher.package_name, 'total'):
+                fetcher.fetch(
+                    project_root,
+                    dest_dir,
+                    use_proxy=use_proxy.get(type(fetcher), True))
+        except Exception as e:
+            fetch_stats.record(fetcher.package_name, error=str(e))
+            raise
+    else:
+        logging.info(
+            "{bold}Destination directory %s already exists, not fetching. "
+            "Use --force to force a fetch of the source{clear}", dest_dir
+        )
+
+
+def fetch_package(
+    project_root, node_modules, package, use_python2, python2_virtualenv,
+    python2_virtualenv_root, use_python3, python3_virtualenv,
+    python3_virtualenv_root, virtualenv_use_proxy_vars, force,
+    mirror_path=None
+):
+    node_modules = os.path.realpath(os.path.join(project_root, node_modules))
+    package_root = get_package_root(node_modules, package)
+
+    python_settings = get_python_settings(
+        project_root,
+        use_python2,
+        python2_virtualenv,
+        python2_virtualenv_root,
+        use_python3,
+        python3_virtualenv,
+        python3_virtualenv_root,
+    )
     fetcher, dest_dir = get_fetcher_from_repository(
-        package, package_root, python_settings
+        package, package_root, python_settings, get_mirror(mirror_path)
     )
 
     use_proxy = {
         PipFetcher: virtualenv_use_proxy_vars,
     }
 
-    if fetcher.should_fetch(dest_dir, force):
-        fetcher.fetch(
-            project_root,
-            dest_dir,
-            use_proxy=use_proxy.get(type(fetcher), True))
-    else:
+    run_fetcher(project_root, fetcher, dest_dir, force, use_proxy)
+    if isinstance(fetcher, CachedFetcher):
+        cache.maybe_garbage_collect(cache.get_cache_root())
+    return 0
+
+
+def is_fetched_package(js):
+    """
+    Whether a package's parsed package.json says that its source is fetched
+    by buckit when yarn installs it
+    """
+    postinstall = js.get('scripts', {}).get('postinstall', '')
+    return 'repository' in js and 'buckit fetch' in postinstall
+
+
+def fetch_pip_packages(pip_fetchers, force, use_proxy):
+    """
+    Installs all pip packages that need to be fetched with one pip run per
+    virtualenv
+
+    Arguments:
+        pip_fetchers - A list of (package name, PipFetcher, destination)
+        force - Whether to fetch packages that have already been fetched
+        use_proxy - A dictionary of fetcher type to whether proxy variables
+                    should be used
+
+    Returns:
+        A list of the names of packages that could not be fetched
+    """
+    to_fetch = [
+        (package, fetcher, dest_dir)
+        for package, fetcher, dest_dir in pip_fetchers
+        if fetcher.should_fetch(dest_dir, force)
+    ]
+    if not to_fetch:
+        return []
+    packages = [package for package, _, _ in to_fetch]
+    logging.info("{bold}Installing pip packages %s{clear}", ', '.join(packages))
+    start = time.time()
+    for package in packages:
+        fetch_stats.record(package, type=PipFetcher.TYPE)
+    try:
+        batch_fetch_pip_packages(
+            [(fetcher, dest_dir) for _, fetcher, dest_dir in to_fetch],
+            use_proxy.get(PipFetcher, True),
+        )
+    except Exception as e:
+        logging.error(
+            "{red}Installing pip packages failed after %.1fs: %s{clear}",
+            time.time() - start, e
+        )
+        for package in packages:
+            fetch_stats.record(package, error=str(e))
+        return packages
+    finally:
+        # The packages were installed together, so they share the time
+        for package in packages:
+            fetch_stats.add_time(package, 'total', time.time() - start)
+    logging.info(
+        "{bold}Installed %s pip package(s) in %.1fs{clear}", len(packages),
+        time.time() - start
+    )
+    return []
+
+
+def report_stats(report_path, summary):
+    """
+    Writes out the statistics collected while fetching
+
+    Arguments:
+        report_path - If provided, where to write a json report to
+        summary - Whether to log a summary table
+    """
+    if report_path:
+        fetch_stats.write_report(report_path)
+    if summary:
+        fetch_stats.log_summary()
+
+
+def fetch_all_packages(
+    project_root, node_modules, use_python2, python2_virtualenv,
+    python2_virtualenv_root, use_python3, python3_virtualenv,
+    python3_virtualenv_root, virtualenv_use_proxy_vars, force, jobs,
+    mirror_path=None
+):
+    """
+    Fetches every package in the project that is fetched by buckit, running
+    git and tarball downloads on a pool of `jobs` workers.
+
+    Pip packages are installed together with a single pip run per
+    virtualenv while the downloads are running
+    """
+    package_paths, _, jsons = find_package_paths(project_root, node_modules)
+    python_settings = get_python_settings(
+        project_root,
+        use_python2,
+        python2_virtualenv,
+        python2_virtualenv_root,
+        use_python3,
+        python3_virtualenv,
+        python3_virtualenv_root,
+    )
+    use_proxy = {
+        PipFetcher: virtualenv_use_proxy_vars,
+    }
+    mirror = get_mirror(mirror_path)
+
+    cached_fetchers = []
+    pip_fetchers = []
+    for package in sorted(package_paths):
+        if not is_fetched_package(jsons[package]):
+            logging.debug("Package %s is not fetched by buckit", package)
+            continue
+        fetcher, dest_dir = get_fetcher_from_repository(
+            package, package_paths[package], python_settings, mirror
+        )
+        if isinstance(fetcher, PipFetcher):
+            pip_fetchers.append((package, fetcher, dest_dir))
+        else:
+            cached_fetchers.append((package, fetcher, dest_dir))
+
+    def fetch_one(package, fetcher, dest_dir):
+        logging.info("{bold}Fetching %s{clear}", package)
+        start = time.time()
+        try:
+            run_fetcher(project_root, fetcher, dest_dir, force, use_proxy)
+        except Exception as e:
+            logging.error(
+                "{red}Fetching %s failed after %.1fs: %s{clear}", package,
+                time.time() - start, e
+            )
+            return package
         logging.info(
-            "{bold}Destination directory %s already exists, not fetching. "
-            "Use --force to force a fetch of the source{clear}", dest_dir
+            "{bold}Fetched %s in %.1fs{clear}", package, time.time() - start
+        )
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            executor.submit(fetch_one, *args) for args in cached_fetchers
+        ]
+        failed = fetch_pip_packages(pip_fetchers, force, use_proxy)
+        failed.extend(
+            package for package in (f.result() for f in futures) if package
+        )
+    # Only walk the cache once all of the workers are done populating it
+    if cached_fetchers:
+        cache.maybe_garbage_collect(cache.get_cache_root())
+
+    if failed:
+        logging.error(
+            "{red}Could not fetch %s package(s): %s{clear}", len(failed),
+            ', '.join(sorted(failed))
         )
+        return 1
     return 0
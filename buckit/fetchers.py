@@ -7,22 +7,35 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
+import csv
+import errno
 import glob
 import hashlib
+import http.client
+import json
 import logging
 import os
 import platform
+import re
 import shlex
 import shutil
+import socket
 import subprocess
+import tarfile
 import tempfile
+import urllib.error
+import urllib.request
+import zlib
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import cache
 from configure_buck import find_project_root, update_config
 from constants import BUCKFILE, BUCKCONFIG
-from formatting import readable_check_call
-from helpers import BuckitException
+from formatting import readable_check_call, readable_check_output
+from helpers import BuckitException, open_with_lock, with_retries
+from stats import fetch_stats
 from textwrap import indent, dedent
 
 PipPythonSettings = namedtuple(
@@ -36,7 +49,184 @@ PipPythonSettings = namedtuple(
 )
 
 
+# Overrides CachedFetcher.DOWNLOAD_TIMEOUT
+DOWNLOAD_TIMEOUT_ENVVAR = 'BUCKIT_DOWNLOAD_TIMEOUT'
+RETRYABLE_URL_ERRORS = (
+    urllib.error.URLError,
+    http.client.HTTPException,
+    ConnectionError,
+    socket.timeout,
+)
+
+
+class HashingReader:
+    """
+    Wraps a file-like object, and hashes all data as it is read
+    """
+
+    def __init__(self, fileobj, file_hash):
+        self.fileobj = fileobj
+        self.file_hash = file_hash
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.file_hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.file_hash.hexdigest()
+
+
+class ResumableDownload:
+    """
+    A file-like object that downloads a url, saving everything that it reads
+    to a partial file in the cache. How much of that file is good is recorded
+    in a journal, so that a later attempt replays the saved data and only
+    requests the rest of the file with an HTTP Range request. Dropped
+    connections are reopened the same way, with exponential backoff
+    """
+    JOURNAL_INTERVAL = 4 * 1024 * 1024
+    SKIP_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, opener, url, partial_path, attempts, delay, timeout):
+        """
+        Arguments:
+            timeout - How many seconds to wait for the server to connect or
+                      send more data before the connection is reopened
+        """
+        self.opener = opener
+        self.url = url
+        self.partial_path = partial_path
+        self.attempts = attempts
+        self.delay = delay
+        self.timeout = timeout
+        self.response = None
+        self.bytes_downloaded = 0
+
+        journal = cache.read_journal(partial_path)
+        saved = journal.get('bytes', 0) if journal.get('url') == url else 0
+        if saved:
+            logging.info(
+                "{bold}Resuming download of %s after %s bytes{clear}", url,
+                saved
+            )
+        # Only trust what the journal says was completely written
+        open(partial_path, 'ab').close()
+        self.partial = open(partial_path, 'r+b')
+        self.partial.truncate(saved)
+        self.saved = saved
+        self.offset = 0
+        self.journaled = saved
+
+    def read(self, size=-1):
+        if self.offset < self.saved:
+            # Replay data from an earlier attempt
+            remaining = self.saved - self.offset
+            data = self.partial.read(
+                remaining if size < 0 else min(size, remaining)
+            )
+            self.offset += len(data)
+            return data
+
+        data = with_retries(
+            lambda: self.read_url(size),
+            'downloading {}'.format(self.url),
+            self.attempts,
+            self.delay,
+            retry_on=RETRYABLE_URL_ERRORS,
+        )
+        self.partial.write(data)
+        self.bytes_downloaded += len(data)
+        self.offset += len(data)
+        self.saved = self.offset
+        if not data or self.offset - self.journaled >= self.JOURNAL_INTERVAL:
+            self.write_journal()
+        return data
+
+    def read_url(self, size):
+        try:
+            if self.response is None:
+                self.response = self.open_url()
+            data = self.response.read(size)
+            # http.client quietly returns nothing if the connection drops
+            # before the advertised length was sent
+            remaining = getattr(self.response, 'length', None)
+            if not data and size != 0 and remaining:
+                raise http.client.IncompleteRead(data, remaining)
+            return data
+        except Exception as e:
+            self.close_response()
+            if isinstance(e, urllib.error.HTTPError):
+                if e.code == 416 and self.offset:
+                    # An earlier attempt saved the whole file, but was
+                    # interrupted before it was done with it
+                    return b''
+                if e.code < 500 and e.code != 429:
+                    raise BuckitException(
+                        'Could not download {}: {}', self.url, e)
+            raise
+
+    def open_url(self):
+        request = urllib.request.Request(self.url)
+        if self.offset:
+            request.add_header('Range', 'bytes={}-'.format(self.offset))
+        response = self.opener.open(request, timeout=self.timeout)
+        if self.offset and response.getcode() != 206:
+            # The server ignored our range, so skip what we already have
+            remaining = self.offset
+            while remaining:
+                data = response.read(min(remaining, self.SKIP_BUFFER_SIZE))
+                if not data:
+                    raise IOError(
+                        'Got a shorter file than before from {}'.format(
+                            self.url))
+                remaining -= len(data)
+        return response
+
+    def write_journal(self):
+        self.partial.flush()
+        cache.write_journal(
+            self.partial_path, {'url': self.url, 'bytes': self.saved}
+        )
+        self.journaled = self.saved
+
+    def close_response(self):
+        if self.response is not None:
+            try:
+                self.response.close()
+            except Exception:
+                pass
+            self.response = None
+
+    def close(self):
+        self.close_response()
+        if self.saved != self.journaled:
+            self.write_journal()
+        self.partial.close()
+
+
+def extract_tar(tar, destination):
+    """
+    Extracts an open tarfile to destination, refusing members that would
+    end up outside of destination where this python supports it
+    """
+    if hasattr(tarfile, 'tar_filter'):
+        tar.extractall(destination, filter='tar')
+    else:
+        tar.extractall(destination)
+
+
 class CachedFetcher:
+    # The kind of source, used in fetch reports
+    TYPE = None
+    # How many times network operations are tried, and how long to wait
+    # after the first failure. The wait doubles after each failure
+    DOWNLOAD_ATTEMPTS = 5
+    RETRY_DELAY = 2.0
+    # How many seconds a download may stall before it is retried
+    DOWNLOAD_TIMEOUT = 60.0
 
     def should_fetch(self, destination, force):
         src_dest = os.path.join(destination, 'src')
@@ -45,56 +235,160 @@ class CachedFetcher:
     def populate_cache(self, destination, use_proxy):
         raise BuckitException('Not implemented')
 
+    def get_download_timeout(self):
+        timeout = os.environ.get(DOWNLOAD_TIMEOUT_ENVVAR)
+        if not timeout:
+            return self.DOWNLOAD_TIMEOUT
+        try:
+            return float(timeout)
+        except ValueError:
+            raise BuckitException(
+                "{} should be a number of seconds, got '{}'",
+                DOWNLOAD_TIMEOUT_ENVVAR, timeout)
+
+    def content_key(self, tree=None):
+        """
+        Gets the key that the fetched source is stored under in the content
+        addressed store.
+
+        Arguments:
+            tree - If provided, the path to the freshly populated source. If
+                   not provided, the key should be returned if it can be known
+                   before fetching, otherwise None
+        """
+        raise BuckitException('Not implemented')
+
     def fetch(self, project_root, destination, use_proxy):
         destination = os.path.join(destination, 'src')
         if os.path.isdir(destination):
             return
 
         # Make sure that our parent dir exists
-        if not os.path.exists(os.path.split(destination)[0]):
-            os.makedirs(os.path.split(destination)[0], 0o0755)
-
-        yarn_cache = os.path.join(os.path.expanduser('~'), '.cache', 'yarn')
-        if not os.path.exists(yarn_cache):
-            yarn_cache = os.path.join(os.path.expanduser('~'), '.yarn-cache')
-        if not os.path.exists(yarn_cache):
-            os.makedirs(yarn_cache)
-
-        clean_package_name = self.package_name.replace('/',
-                                                       '_').replace('\\', '_')
-        clean_version = self.version().replace('/', '_').replace('\\', '_')
-        cache_dir_name = 'buckit-fetch-{}-{}'.format(
-            clean_package_name, clean_version
+        os.makedirs(os.path.split(destination)[0], 0o0755, exist_ok=True)
+
+        cache_root = cache.get_cache_root()
+        index_path = cache.get_index_path(
+            cache_root, self.package_name, self.version()
         )
-        cache_dir = os.path.join(yarn_cache, cache_dir_name)
-        if not os.path.exists(cache_dir):
-            logging.debug(
-                "{bold}Downloading %s to cache directory at %s{clear}",
-                self.package_name, cache_dir
+        fetch_stats.record(self.package_name, cache='hit')
+        key = self.content_key()
+        store_path = cache.lookup(cache_root, index_path, key)
+        if store_path is None or not self.materialize_entry(
+            cache_root, index_path, store_path, destination
+        ):
+            # Lock the content if we know it up front, so that packages
+            # that share it do not both download it
+            lock_path = (
+                cache.get_store_path(cache_root, key) if key else index_path
             )
-            self.populate_cache(cache_dir, use_proxy)
+            with cache.populate_lock(lock_path, self.package_name):
+                # Another process may have fetched it while we waited
+                store_path = cache.lookup(cache_root, index_path, key)
+                if store_path is None:
+                    fetch_stats.record(self.package_name, cache='miss')
+                    with fetch_stats.timed(self.package_name, 'populate'):
+                        store_path = self.populate_store(
+                            cache_root, use_proxy
+                        )
+                    cache.link_index(index_path, store_path)
+            # Another process may have garbage collected the entry between
+            # publishing and locking it, so only try once more
+            if not self.materialize_entry(
+                cache_root, index_path, store_path, destination
+            ):
+                raise BuckitException(
+                    "Cache entry {} for {} was evicted while fetching it",
+                    store_path, self.package_name)
 
-        tmp_destination = tempfile.mkdtemp(dir=os.path.split(destination)[0])
-        logging.debug(
-            "{bold}Cached download at %s exists, copying to %s{clear}",
-            cache_dir, tmp_destination
-        )
-        # Dir needs to not exist for copytree, but we want mkdtemp for guaranteed
-        # unique temp dir next to destination
-        tmp_subdir = os.path.join(
-            tmp_destination, os.path.split(destination)[1]
-        )
+    def populate_store(self, cache_root, use_proxy):
+        """
+        Downloads the source into the store
+
+        Returns:
+            The path to the entry in the store
+        """
+        tmp_dir = tempfile.mkdtemp(dir=cache_root)
         try:
-            shutil.copytree(cache_dir, tmp_subdir, symlinks=True)
-            shutil.move(tmp_subdir, destination)
+            tree = os.path.join(tmp_dir, 'src')
+            logging.debug(
+                "{bold}Downloading %s to %s{clear}", self.package_name, tree
+            )
+            self.populate_cache(tree, use_proxy)
+            if not os.path.exists(tree):
+                # populate_cache() found the content already in the store
+                fetch_stats.record(self.package_name, cache='hit')
+                return cache.get_store_path(cache_root, self.content_key())
+            return cache.publish(cache_root, tree, self.content_key(tree))
         finally:
-            if os.path.exists(tmp_destination):
-                shutil.rmtree(tmp_destination)
+            shutil.rmtree(tmp_dir)
+
+    def materialize_entry(self, cache_root, index_path, store_path,
+                          destination):
+        """
+        Creates destination from an entry in the store. The entry is locked
+        while it is being read so that it cannot be garbage collected
+
+        Returns:
+            True if destination was created, False if the entry had been
+            evicted from the cache before it could be locked
+        """
+        with cache.entry_lock(store_path, shared=True):
+            if not os.path.isdir(store_path):
+                return False
+            cache.touch(store_path)
+            cache.link_index(index_path, store_path)
+
+            tmp_destination = tempfile.mkdtemp(
+                dir=os.path.split(destination)[0]
+            )
+            logging.debug(
+                "{bold}Cached download at %s exists, copying to %s{clear}",
+                store_path, tmp_destination
+            )
+            # Dir needs to not exist for copytree, but we want mkdtemp for
+            # guaranteed unique temp dir next to destination
+            tmp_subdir = os.path.join(
+                tmp_destination, os.path.split(destination)[1]
+            )
+            try:
+                with fetch_stats.timed(self.package_name, 'materialize'):
+                    report = cache.materialize(store_path, tmp_subdir)
+                fetch_stats.record(
+                    self.package_name, materialized_files=dict(report)
+                )
+                logging.info(
+                    "Materialized %s from %s (%s)", self.package_name,
+                    store_path, ', '.join(
+                        '{}: {}'.format(name, count)
+                        for name, count in sorted(report.items())
+                    ) or 'no files'
+                )
+                try:
+                    os.rename(tmp_subdir, destination)
+                except OSError as e:
+                    # Another fetch of the same package won the race. Keep
+                    # its checkout rather than moving ours inside of it
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                    logging.info(
+                        "{bold}%s was fetched to %s concurrently{clear}",
+                        self.package_name, destination
+                    )
+            finally:
+                if os.path.exists(tmp_destination):
+                    shutil.rmtree(tmp_destination)
+        return True
 
 
 class GitFetcher(CachedFetcher):
+    TYPE = 'git'
 
-    def __init__(self, package_name, json_file, url, commit, tag):
+    def __init__(self, package_name, json_file, url, commit, tag, mirror=None):
+        """
+        Arguments:
+            mirror - If provided, a LocalMirror that the repository and all
+                     of its submodules are cloned from instead of the network
+        """
         if bool(commit) == bool(tag):
             raise BuckitException(
                 "{}: Either the commit, or the tag must be specified",
@@ -102,12 +396,240 @@ class GitFetcher(CachedFetcher):
 
         self.package_name = package_name
         self.url = url
+        self.mirror = mirror
+        # Where to clone the repository from
+        self.source = mirror.git_source(url) if mirror else url
         self.commit = commit
         self.tag = tag
 
     def version(self):
         return self.commit or self.tag
 
+    def content_key(self, tree=None):
+        # Tags can move, and abbreviated commits are only known once they
+        # are checked out, so use the full commit. The tree hash is not
+        # enough, as the entry includes .git, and with it the history of the
+        # commit. That does not cover what is checked out in nested
+        # submodules, so add the commits of all submodules, if there are any
+        if tree is None:
+            return None
+        commit = readable_check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            'getting commit hash',
+            cwd=tree
+        ).strip()
+        status = readable_check_output(
+            ['git', 'submodule', 'status', '--recursive'],
+            'getting submodule commits',
+            cwd=tree
+        )
+        # Each line is a state flag, the commit, the path, and then a
+        # description of the commit that depends on which refs were fetched
+        submodules = [
+            ' '.join([line[0]] + line[1:].split(' ', 2)[:2])
+            for line in status.splitlines() if line
+        ]
+        if not submodules:
+            return 'git-commit-{}'.format(commit)
+        submodules_hash = hashlib.sha256(
+            '\n'.join(submodules).encode('utf-8')
+        ).hexdigest()
+        return 'git-commit-{}-{}'.format(commit, submodules_hash)
+
+    def mirror_has_commit(self, mirror):
+        return subprocess.call(
+            ['git', 'cat-file', '-e', '{}^{{commit}}'.format(self.commit)],
+            cwd=mirror,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ) == 0
+
+    def clone_from_mirror(self, out_dir, env):
+        """
+        Makes sure that there is a bare mirror of self.url in the cache that
+        contains self.commit, creating or updating it if need be, and clones
+        it into out_dir. The mirror is locked throughout so that it cannot be
+        garbage collected while it is being cloned
+        """
+        mirror = cache.get_git_mirror_path(
+            cache.get_cache_root(), self.source
+        )
+        os.makedirs(os.path.dirname(mirror), exist_ok=True)
+        with open_with_lock(mirror + '.lock', 'w'):
+            if not os.path.exists(mirror):
+                # Unlike `git clone --mirror`, this leaves the mirror in
+                # place if the first fetch fails, so that anything that was
+                # fetched is kept for the next attempt
+                readable_check_call(
+                    ['git', 'init', '--bare', mirror], 'creating mirror'
+                )
+                readable_check_call(
+                    ['git', 'remote', 'add', '--mirror=fetch', 'origin',
+                     self.source],
+                    'configuring mirror',
+                    cwd=mirror
+                )
+            if not self.mirror_has_commit(mirror):
+                size = cache.read_entry_info(mirror)['size']
+                with_retries(
+                    lambda: readable_check_call(
+                        ['git', 'remote', 'update', '--prune'],
+                        'updating mirror',
+                        cwd=mirror,
+                        env=env
+                    ),
+                    'updating mirror of {}'.format(self.url),
+                    self.DOWNLOAD_ATTEMPTS,
+                    self.RETRY_DELAY,
+                    retry_on=(subprocess.CalledProcessError, ),
+                )
+                new_size = cache.touch(mirror, update_size=True)['size']
+                fetch_stats.add_bytes(
+                    self.package_name, max(0, new_size - size)
+                )
+            else:
+                logging.debug("Mirror at %s has %s", mirror, self.commit)
+                cache.touch(mirror)
+            readable_check_call(
+                ['git', 'clone', '--no-checkout', mirror, out_dir],
+                'cloning repo from mirror',
+                env=env
+            )
+
+    def get_submodule_config(self, repo_dir, key, config_file=None):
+        """
+        Gets a setting of all submodules of a repository
+
+        Arguments:
+            repo_dir - The repository
+            key - The setting to get, like 'url' or 'path'
+            config_file - If provided, the file to read settings from
+                          relative to repo_dir, like '.gitmodules'. Otherwise
+                          the repository's own config is used
+
+        Returns:
+            A dictionary of submodule name to the value of the setting
+        """
+        command = ['git', 'config']
+        if config_file:
+            if not os.path.exists(os.path.join(repo_dir, config_file)):
+                return {}
+            command.extend(['-f', config_file])
+        command.extend(
+            ['--get-regexp', r'^submodule\..*\.{}$'.format(re.escape(key))]
+        )
+        result = subprocess.run(
+            command, cwd=repo_dir, stdout=subprocess.PIPE
+        )
+        # git exits with 1 if nothing matched
+        if result.returncode == 1:
+            return {}
+        if result.returncode != 0:
+            raise BuckitException(
+                "Could not read submodule config in {}", repo_dir)
+        output = result.stdout.decode('utf-8')
+        prefix, suffix = 'submodule.', '.' + key
+        settings = {}
+        for line in output.splitlines():
+            name, value = line.split(' ', 1)
+            settings[name[len(prefix):-len(suffix)]] = value
+        return settings
+
+    def update_submodules_from_mirror(self, repo_dir, env, repo_url=None):
+        """
+        Checks out the submodules of repo_dir recursively, cloning each of
+        them from self.mirror instead of from its url, so that nothing is
+        fetched over the network. The origin of each submodule is set to its
+        real url afterwards, so that relative urls of nested submodules are
+        resolved like git would have
+
+        Arguments:
+            repo_dir - The checkout to update
+            repo_url - The real url of repo_dir, defaults to self.url
+        """
+        readable_check_call(
+            ['git', 'submodule', 'init'],
+            'initializing submodules',
+            cwd=repo_dir,
+            env=env
+        )
+        # `submodule init` has resolved relative urls against origin
+        urls = self.get_submodule_config(repo_dir, 'url')
+        paths = self.get_submodule_config(repo_dir, 'path', '.gitmodules')
+        for name, url in sorted(urls.items()):
+            try:
+                source = self.mirror.git_source(url)
+            except BuckitException as e:
+                raise BuckitException(
+                    "Submodule {} ({}) of {} is not in the mirror: {}", name,
+                    url, repo_url or self.url, e)
+            readable_check_call(
+                ['git', 'config', 'submodule.{}.url'.format(name), source],
+                'pointing submodule at mirror',
+                cwd=repo_dir
+            )
+        # Newer versions of git refuse to clone submodules from local paths
+        # unless they are told to
+        readable_check_call(
+            ['git', '-c', 'protocol.file.allow=always', 'submodule',
+             'update'],
+            'checking out submodules from mirror',
+            cwd=repo_dir,
+            env=env
+        )
+        for name, url in sorted(urls.items()):
+            if name not in paths:
+                continue
+            submodule_dir = os.path.join(repo_dir, paths[name])
+            readable_check_call(
+                ['git', 'remote', 'set-url', 'origin', url],
+                'setting origin url',
+                cwd=submodule_dir
+            )
+            self.update_submodules_from_mirror(submodule_dir, env, url)
+
+    def clone_tag(self, out_dir, env):
+        if self.mirror:
+            self.clone_tag_from_mirror(out_dir, env)
+            return
+        if platform.system() == 'Darwin':
+            # For now short circuit shallow submodules on osx
+            # because things are terrible there.
+            shallow_submodules = []
+        else:
+            shallow_submodules = ['--shallow-submodules']
+
+        # A failed clone may leave a partial checkout behind
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        readable_check_call(
+            [
+                'git',
+                'clone',
+                '--branch',
+                self.tag,
+                '--depth',
+                '1',
+                '--recursive',
+            ] + shallow_submodules + [self.source, out_dir], 'cloning repo',
+            env=env
+        )
+
+    def clone_tag_from_mirror(self, out_dir, env):
+        if os.path.exists(out_dir):
+            shutil.rmtree(out_dir)
+        readable_check_call(
+            ['git', 'clone', '--branch', self.tag, self.source, out_dir],
+            'cloning repo from mirror',
+            env=env
+        )
+        readable_check_call(
+            ['git', 'remote', 'set-url', 'origin', self.url],
+            'setting origin url',
+            cwd=out_dir
+        )
+        self.update_submodules_from_mirror(out_dir, env)
+
     def populate_cache(self, destination, use_proxy):
         env = dict(os.environ)
         if not use_proxy:
@@ -120,34 +642,50 @@ class GitFetcher(CachedFetcher):
         try:
             if self.commit:
                 # Github and the like don't seem to let you do git fetch <sha>
-                # so we have to do a heavy weight clone
+                # so we keep a full mirror of the repo in the cache, and only
+                # transfer new objects into it when the commit changes
+                self.clone_from_mirror(out_dir, env)
+                # Make sure relative submodule urls resolve against the
+                # real remote, not the mirror
                 readable_check_call(
-                    ['git', 'clone', '--recursive', self.url, out_dir],
-                    'cloning repo'
+                    ['git', 'remote', 'set-url', 'origin', self.url],
+                    'setting origin url',
+                    cwd=out_dir
                 )
                 readable_check_call(
                     ['git', 'checkout', self.commit],
                     'checking out specific commit',
                     cwd=out_dir
                 )
-            else:
-                if platform.system() == 'Darwin':
-                    # For now short circuit shallow submodules on osx
-                    # because things are terrible there.
-                    shallow_submodules = []
+                if self.mirror:
+                    self.update_submodules_from_mirror(out_dir, env)
                 else:
-                    shallow_submodules = ['--shallow-submodules']
-
-                readable_check_call(
-                    [
-                        'git',
-                        'clone',
-                        '--branch',
-                        self.tag,
-                        '--depth',
-                        '1',
-                        '--recursive',
-                    ] + shallow_submodules + [self.url, out_dir], 'cloning repo'
+                    # Submodules that were already cloned are kept when
+                    # this is retried
+                    with_retries(
+                        lambda: readable_check_call(
+                            ['git', 'submodule', 'update', '--init',
+                             '--recursive'],
+                            'checking out submodules',
+                            cwd=out_dir,
+                            env=env
+                        ),
+                        'checking out submodules of {}'.format(self.url),
+                        self.DOWNLOAD_ATTEMPTS,
+                        self.RETRY_DELAY,
+                        retry_on=(subprocess.CalledProcessError, ),
+                    )
+            else:
+                with_retries(
+                    lambda: self.clone_tag(out_dir, env),
+                    'cloning {}'.format(self.url),
+                    self.DOWNLOAD_ATTEMPTS,
+                    self.RETRY_DELAY,
+                    retry_on=(subprocess.CalledProcessError, ),
+                )
+                fetch_stats.add_bytes(
+                    self.package_name,
+                    cache.get_tree_size(os.path.join(out_dir, '.git'))
                 )
             logging.info(
                 "Checked out %s to %s, moving it to %s", self.url, out_dir,
@@ -159,6 +697,7 @@ class GitFetcher(CachedFetcher):
 
 
 class HttpTarballFetcher(CachedFetcher):
+    TYPE = 'tarball'
     HASH_BUFFER_SIZE = 64 * 1024
 
     def __init__(self, package_name, json_file, url, sha256):
@@ -169,47 +708,94 @@ class HttpTarballFetcher(CachedFetcher):
     def version(self):
         return self.sha256
 
-    def populate_cache(self, destination, use_proxy):
-        env = dict(os.environ)
+    def content_key(self, tree=None):
+        return 'sha256-{}'.format(self.sha256)
+
+    def get_opener(self, use_proxy):
+        """
+        Gets a urllib opener for self.url. Supports anything urllib does,
+        including local file:// urls
+        """
+        handlers = []
         if not use_proxy:
-            for var in ('https_proxy', 'http_proxy'):
-                if var in env:
-                    del env[var]
+            handlers.append(urllib.request.ProxyHandler({}))
+        return urllib.request.build_opener(*handlers)
+
+    def populate_cache(self, destination, use_proxy):
+        cache_root = cache.get_cache_root()
+        partial_path = cache.get_partial_path(cache_root, self.content_key())
         tmp_dir = tempfile.mkdtemp(dir=os.path.split(destination)[0])
-        tmp_file = os.path.join(tmp_dir, 'output_file')
+        extract_dir = os.path.join(tmp_dir, 'extracted')
         try:
-            readable_check_call(
-                ['curl', self.url, '-L', '-o', tmp_file],
-                'fetching {}'.format(self.url)
-            )
-            self.check_hash(tmp_file)
-            readable_check_call(
-                ['tar', 'xf', tmp_file, '-C', tmp_dir],
-                'extracting {}'.format(tmp_file)
-            )
-            os.remove(tmp_file)
-            main_dir = glob.glob(os.path.join(tmp_dir, '*'))[0]
+            with open_with_lock(partial_path + '.lock', 'w'):
+                # Another fetch of the same content may have published it
+                # while we waited. Leave destination alone in that case
+                store_path = cache.get_store_path(
+                    cache_root, self.content_key()
+                )
+                if os.path.isdir(store_path):
+                    logging.info(
+                        "%s was downloaded to %s concurrently",
+                        self.url, store_path
+                    )
+                    return
+                self.download_and_extract(
+                    use_proxy, partial_path, extract_dir
+                )
+            main_dir = glob.glob(os.path.join(extract_dir, '*'))[0]
             logging.info("{bold}Moving %s to %s", main_dir, destination)
             shutil.move(main_dir, destination)
         finally:
             shutil.rmtree(tmp_dir)
 
-    def check_hash(self, filename):
-        file_hash = hashlib.sha256()
-        with open(filename, 'rb') as fin:
-            while True:
-                data = fin.read(self.HASH_BUFFER_SIZE)
-                if not data:
-                    break
-                file_hash.update(data)
+    def download_and_extract(self, use_proxy, partial_path, extract_dir):
+        # Hash and extract the tarball as it is downloaded, rather than
+        # writing it to disk and reading it back twice. Nothing is moved
+        # into the cache until the hash has been checked. The raw bytes are
+        # kept in a partial file until then so that an interrupted download
+        # can be resumed
+        logging.info("{bold}Fetching and extracting %s{clear}", self.url)
+        download = ResumableDownload(
+            self.get_opener(use_proxy),
+            self.url,
+            partial_path,
+            self.DOWNLOAD_ATTEMPTS,
+            self.RETRY_DELAY,
+            self.get_download_timeout(),
+        )
+        corrupt = False
+        try:
+            reader = HashingReader(download, hashlib.sha256())
+            with tarfile.open(fileobj=reader, mode='r|*') as tar:
+                extract_tar(tar, extract_dir)
+            # Make sure trailing padding is included in the hash
+            while reader.read(self.HASH_BUFFER_SIZE):
+                pass
+        except (tarfile.TarError, EOFError, zlib.error, BuckitException):
+            # The saved data is bad, or the server will not send the rest of
+            # it. Start from scratch next time
+            corrupt = True
+            raise
+        finally:
+            download.close()
+            fetch_stats.add_bytes(self.package_name, download.bytes_downloaded)
+            if corrupt:
+                cache.remove_partial(partial_path)
+        try:
+            self.check_hash(reader.hexdigest())
+        finally:
+            cache.remove_partial(partial_path)
 
-        if file_hash.hexdigest() != self.sha256:
+    def check_hash(self, digest):
+        if digest != self.sha256:
             raise BuckitException(
                 'SHA256 of downloaded file didn\'t match! Expected {}, got {}',
-                self.sha256, file_hash.hexdigest())
+                self.sha256, digest)
 
 
 class PipFetcher:
+    TYPE = 'pip'
+    FINGERPRINT_FILE = '.buckit-fingerprint'
 
     def __init__(
         self, package_name, json_file, pip2_package, pip2_version, pip3_package,
@@ -238,6 +824,8 @@ class PipFetcher:
             )
         self.python2_files = {"srcs": {}, "bins": {}}
         self.python3_files = {"srcs": {}, "bins": {}}
+        # The version that pip installed, by prefix_subdir, if known
+        self.installed_versions = {}
 
         if not main_rule:
             raise BuckitException(
@@ -248,29 +836,57 @@ class PipFetcher:
         return not os.path.exists(buckfile) or force
 
     def fetch(self, project_root, destination, use_proxy):
-        env = dict(os.environ)
-        if not use_proxy:
-            for var in ('https_proxy', 'http_proxy'):
-                if var in env:
-                    del env[var]
+        env = get_pip_env(use_proxy)
+
+        # The virtualenvs are independent, so install into them at once
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            if self.python2:
+                python2_files = executor.submit(
+                    self.install_and_get_files,
+                    self.python2,
+                    'pip',
+                    env,
+                )
+            if self.python3:
+                python3_files = executor.submit(
+                    self.install_and_get_files, self.python3, 'pip', env
+                )
+            if self.python2:
+                self.python2_files = python2_files.result()
+            if self.python3:
+                self.python3_files = python3_files.result()
+        self.write_build_files(destination)
 
+    def write_build_files(self, destination):
+        """
+        Links the virtualenvs into destination, and writes out the BUCK file
+        and .buckconfig settings for files that have already been installed
+        into self.python2_files and self.python3_files
+        """
         if not os.path.exists(destination):
             os.makedirs(destination)
 
         if self.python2:
-            self.python2_files = self.install_and_get_files(
-                self.python2,
-                'pip',
-                env,
-            )
             self.setup_install_prefix(self.python2, destination)
         if self.python3:
-            self.python3_files = self.install_and_get_files(
-                self.python3, 'pip', env
-            )
             self.setup_install_prefix(self.python3, destination)
 
+        # Rewriting BUCK or .buckconfig makes buck throw away its parser
+        # cache, so don't touch them if nothing that goes into them changed
         buckfile = os.path.join(destination, BUCKFILE)
+        fingerprint_file = os.path.join(destination, self.FINGERPRINT_FILE)
+        fingerprint = self.fingerprint(destination)
+        if os.path.exists(buckfile) and os.path.exists(fingerprint_file):
+            with open(fingerprint_file, 'r') as fin:
+                if fin.read().strip() == fingerprint:
+                    logging.info(
+                        "{bold}%s is unchanged, not regenerating %s{clear}",
+                        self.package_name, buckfile
+                    )
+                    return
+        if os.path.exists(fingerprint_file):
+            os.remove(fingerprint_file)
+
         with open(buckfile, 'w') as fout:
             fout.write('\n'.join(self.buckfile()))
         if self.python2 or self.python3:
@@ -292,6 +908,49 @@ class PipFetcher:
             buckconfig = os.path.join(project_root, BUCKCONFIG)
             update_config(project_root, buckconfig, read_only_props)
 
+        # Only written once everything else succeeded
+        with open(fingerprint_file, 'w') as fout:
+            fout.write(fingerprint)
+
+    def fingerprint(self, destination):
+        """
+        Gets a hash of everything that goes into the generated BUCK file and
+        .buckconfig settings: the installed versions, the virtualenv
+        interpreters, and the installed files
+        """
+        parts = {
+            'package': self.package_name,
+            'destination': os.path.realpath(destination),
+            'main_rule': self.main_rule,
+            'buck_deps': self.buck_deps,
+        }
+        for key, settings, files in (
+            ('py2', self.python2, self.python2_files),
+            ('py3', self.python3, self.python3_files),
+        ):
+            if not settings:
+                continue
+            # TODO: Windows
+            interpreter = os.path.join(
+                settings.virtualenv_root, 'bin', 'python'
+            )
+            parts[key] = {
+                'pip_package': settings.pip_package,
+                'version': self.installed_versions.get(
+                    settings.prefix_subdir
+                ) or read_installed_version(
+                    find_site_packages(settings.virtualenv_root),
+                    settings.pip_package
+                ),
+                'interpreter': os.path.realpath(interpreter),
+                'files': hashlib.sha256(
+                    json.dumps(files, sort_keys=True).encode('utf-8')
+                ).hexdigest(),
+            }
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True).encode('utf-8')
+        ).hexdigest()
+
     def buckfile(self):
         ret = []
 
@@ -438,59 +1097,9 @@ class PipFetcher:
         return {"srcs": files, "bins": bins}
 
     def install_and_get_files(self, python_settings, pip_command, env):
-        # TODO: Windows
-        activate_path = os.path.join(
-            python_settings.virtualenv_root, 'bin', 'activate'
-        )
-        if (not os.path.exists(python_settings.virtualenv_root) or
-                not os.path.exists(activate_path)):
-            logging.info(
-                "Virtualenv at %s does not exist, creating",
-                python_settings.virtualenv_root
-            )
-            readable_check_call(
-                python_settings.virtualenv_command +
-                [python_settings.virtualenv_root],
-                "installing python virtual env",
-                env=env,
-            )
-
-        package = shlex.quote(
-            python_settings.pip_package + (python_settings.pip_version or '')
-        )
-        command = (
-            "source bin/activate && {pip} install -I {package} && "
-            "{pip} show -f {package}"
-        ).format(
-            pip=pip_command, package=package
-        )
-        logging.info(
-            "Installing %s via pip with %s in %s", package, command,
-            python_settings.virtualenv_root
-        )
-        proc = subprocess.Popen(
-            args=command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            cwd=python_settings.virtualenv_root,
-            shell=True,
-            env=env,
-        )
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            logging.error(
-                "{red}Error installing into virtualenv:{clear}\n"
-                "stdout: %sstderr: %s\nReturn code %s\n", stdout, stderr,
-                proc.returncode
-            )
-            raise BuckitException(
-                "Could not install virtualenv at {}",
-                python_settings.virtualenv_root)
-
-        stdout = stdout.decode('utf-8')
-
-        return self.parse_pip_output(python_settings, stdout)
+        return install_pip_packages(
+            [(self, python_settings)], pip_command, env
+        )[0]
 
     def setup_install_prefix(self, python_settings, destination):
         platform_install_prefix = os.path.join(
@@ -516,3 +1125,380 @@ class PipFetcher:
                 relative_install_prefix,
                 platform_install_prefix,
             )
+
+
+def get_pip_env(use_proxy):
+    env = dict(os.environ)
+    if not use_proxy:
+        for var in ('https_proxy', 'http_proxy'):
+            if var in env:
+                del env[var]
+    return env
+
+
+def canonical_pip_name(name):
+    """
+    Normalizes a pip requirement or project name so that it can be compared
+    against the Name: field that pip reports
+    """
+    name = re.split(r'[\[<>=!~;\s]', name.strip(), 1)[0]
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def ensure_virtualenv(python_settings, env):
+    # TODO: Windows
+    activate_path = os.path.join(
+        python_settings.virtualenv_root, 'bin', 'activate'
+    )
+    if (not os.path.exists(python_settings.virtualenv_root) or
+            not os.path.exists(activate_path)):
+        logging.info(
+            "Virtualenv at %s does not exist, creating",
+            python_settings.virtualenv_root
+        )
+        readable_check_call(
+            python_settings.virtualenv_command +
+            [python_settings.virtualenv_root],
+            "installing python virtual env",
+            env=env,
+        )
+
+
+def install_pip_packages(to_install, pip_command, env):
+    """
+    Installs several packages into a single virtualenv with one pip run, and
+    gets the files that were installed for each of them
+
+    Arguments:
+        to_install - A list of (PipFetcher, PipPythonSettings) tuples. All
+                     settings must have the same virtualenv
+        pip_command - The pip command to run inside of the virtualenv
+        env - The environment to run pip in
+
+    Returns:
+        A list of {"srcs": ..., "bins": ...} dictionaries, in the same order
+        as to_install
+    """
+    python_settings = to_install[0][1]
+    # Other fetchers may be installing into the same virtualenv
+    lock_path = python_settings.virtualenv_root.rstrip(os.sep) + '.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open_with_lock(lock_path, 'w'):
+        return _install_pip_packages(to_install, pip_command, env)
+
+
+def _install_pip_packages(to_install, pip_command, env):
+    python_settings = to_install[0][1]
+    ensure_virtualenv(python_settings, env)
+
+    packages = [
+        shlex.quote(settings.pip_package + (settings.pip_version or ''))
+        for _, settings in to_install
+    ]
+    logging.info(
+        "Installing %s via pip in %s", ', '.join(packages),
+        python_settings.virtualenv_root
+    )
+    installed_versions = parse_installed_versions(
+        run_in_virtualenv(
+            python_settings,
+            "{pip} install -I {packages}".format(
+                pip=pip_command, packages=' '.join(packages)
+            ),
+            env,
+        )
+    )
+
+    # Read the file lists straight from the installed metadata. Only fall
+    # back to scraping `pip show -f` for packages we couldn't find it for
+    site_packages = find_site_packages(python_settings.virtualenv_root)
+    ret = []
+    missing = []
+    for fetcher, settings in to_install:
+        version = installed_versions.get(
+            canonical_pip_name(settings.pip_package)
+        )
+        if version is None and (settings.pip_version or '').startswith('=='):
+            version = settings.pip_version[2:].strip()
+        fetcher.installed_versions[settings.prefix_subdir] = version
+        installed = read_installed_files(
+            site_packages, settings.pip_package, version
+        )
+        if installed is None:
+            missing.append(settings.pip_package)
+            ret.append(None)
+            continue
+        location, paths = installed
+        found_files = [path for path in paths if path.endswith('.py')]
+        found_bins = [
+            path for path in paths
+            if not path.endswith('.py') and 'bin' in path.split(os.sep)
+        ]
+        ret.append(
+            fetcher.transform_pip_output(
+                settings, location, found_files, found_bins
+            )
+        )
+    if not missing:
+        return ret
+
+    logging.debug(
+        "Could not find installed metadata for %s, using pip show", missing
+    )
+    stdout = run_in_virtualenv(
+        python_settings,
+        "{pip} show -f {names}".format(
+            pip=pip_command,
+            names=' '.join(shlex.quote(name) for name in missing),
+        ),
+        env,
+    )
+
+    # `pip show` separates each package's information with ---
+    sections = {}
+    for section in re.split(r'^---$', stdout, flags=re.MULTILINE):
+        match = re.search(r'^Name:\s*(\S+)', section, flags=re.MULTILINE)
+        if match:
+            sections[canonical_pip_name(match.group(1))] = section
+
+    for i, (fetcher, settings) in enumerate(to_install):
+        if ret[i] is not None:
+            continue
+        section = sections.get(canonical_pip_name(settings.pip_package))
+        if section is None:
+            raise BuckitException(
+                "pip did not report any files for {} in {}",
+                settings.pip_package, settings.virtualenv_root)
+        ret[i] = fetcher.parse_pip_output(settings, section)
+    return ret
+
+
+def run_in_virtualenv(python_settings, command, env):
+    """
+    Runs a shell command with a virtualenv activated
+
+    Returns:
+        The decoded stdout of the command
+    """
+    command = "source bin/activate && " + command
+    logging.debug(
+        "Running %s in %s", command, python_settings.virtualenv_root
+    )
+    proc = subprocess.Popen(
+        args=command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.PIPE,
+        cwd=python_settings.virtualenv_root,
+        shell=True,
+        env=env,
+    )
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        logging.error(
+            "{red}Error installing into virtualenv:{clear}\n"
+            "stdout: %sstderr: %s\nReturn code %s\n", stdout, stderr,
+            proc.returncode
+        )
+        raise BuckitException(
+            "Could not install virtualenv at {}",
+            python_settings.virtualenv_root)
+
+    return stdout.decode('utf-8')
+
+
+def find_site_packages(virtualenv_root):
+    """
+    Gets the site-packages directories inside of a virtualenv
+    """
+    # TODO: Windows
+    return sorted(
+        glob.glob(
+            os.path.join(virtualenv_root, 'lib', 'python*', 'site-packages')
+        )
+    )
+
+
+def parse_installed_versions(pip_output):
+    """
+    Gets the versions that `pip install` reported installing
+
+    Returns:
+        A dictionary of canonical package name to version
+    """
+    versions = {}
+    for line in pip_output.splitlines():
+        if not line.startswith('Successfully installed '):
+            continue
+        for installed in line.split()[2:]:
+            name, _, version = installed.rpartition('-')
+            if name:
+                versions[canonical_pip_name(name)] = version
+    return versions
+
+
+def normalize_version(version):
+    return version.strip().lower().replace('_', '-')
+
+
+def find_installed_metadata(site_packages, pip_package, version=None):
+    """
+    Finds the .dist-info or .egg-info directory for an installed package.
+    Upgrades can leave the metadata of older versions behind, so this fails
+    rather than guessing if several directories match
+
+    Arguments:
+        site_packages - The site-packages directories from find_site_packages
+        pip_package - The name of the package
+        version - If provided, the version that was installed. Metadata for
+                  other versions is ignored
+
+    Returns:
+        The path to the metadata directory, or None if it couldn't be found
+    """
+    name = canonical_pip_name(pip_package)
+    found = []
+    for directory in site_packages:
+        for entry in sorted(os.listdir(directory)):
+            base, ext = os.path.splitext(entry)
+            if ext not in ('.dist-info', '.egg-info'):
+                continue
+            # Like foo_bar-1.0.dist-info or foo_bar-1.0-py3.6.egg-info
+            parts = base.split('-')
+            if canonical_pip_name(parts[0]) != name:
+                continue
+            path = os.path.join(directory, entry)
+            if version is not None:
+                versions = parts[1:2] + [read_metadata_version(path) or '']
+                if normalize_version(version) not in map(
+                    normalize_version, versions
+                ):
+                    continue
+            found.append(path)
+    if len(found) > 1:
+        raise BuckitException(
+            "Found metadata for several installs of {}{}: {}. Remove the "
+            "stale ones from the virtualenv", pip_package,
+            '' if version is None else ' ' + version, ', '.join(found))
+    return found[0] if found else None
+
+
+def read_installed_version(site_packages, pip_package):
+    """
+    Reads the version of an installed package from its metadata
+
+    Returns:
+        The version string, or None if it couldn't be found
+    """
+    metadata = find_installed_metadata(site_packages, pip_package)
+    if metadata is None:
+        return None
+    return read_metadata_version(metadata)
+
+
+def read_metadata_version(metadata):
+    """
+    Reads the version out of a .dist-info or .egg-info directory
+
+    Returns:
+        The version string, or None if it couldn't be found
+    """
+    for filename in ('METADATA', 'PKG-INFO'):
+        path = os.path.join(metadata, filename)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', errors='replace') as fin:
+            for line in fin:
+                if line.startswith('Version:'):
+                    return line.split(':', 1)[1].strip()
+                if not line.strip():
+                    # End of the headers
+                    break
+    return None
+
+
+def read_installed_files(site_packages, pip_package, version=None):
+    """
+    Reads the files that were installed for a package out of its RECORD
+    (wheels) or installed-files.txt (eggs), without calling out to pip
+
+    Arguments:
+        site_packages - The site-packages directories from find_site_packages
+        pip_package - The name of the package
+        version - If provided, the version that was installed
+
+    Returns:
+        A tuple of (site-packages directory, list of normalized paths relative
+        to it), or None if the metadata couldn't be found
+    """
+    metadata = find_installed_metadata(site_packages, pip_package, version)
+    if metadata is None:
+        return None
+    location = os.path.dirname(metadata)
+
+    paths = []
+    record = os.path.join(metadata, 'RECORD')
+    installed_files = os.path.join(metadata, 'installed-files.txt')
+    if os.path.exists(record):
+        with open(record, 'r', newline='') as fin:
+            for row in csv.reader(fin):
+                if row:
+                    paths.append(os.path.normpath(row[0]))
+    elif os.path.exists(installed_files):
+        # These are relative to the .egg-info directory
+        with open(installed_files, 'r') as fin:
+            for line in fin:
+                line = line.strip()
+                if line:
+                    paths.append(
+                        os.path.relpath(
+                            os.path.normpath(os.path.join(metadata, line)),
+                            location
+                        )
+                    )
+    else:
+        return None
+    return location, paths
+
+
+def batch_fetch_pip_packages(to_fetch, use_proxy):
+    """
+    Fetches many PipFetchers at once, installing all of their packages with
+    a single pip run per virtualenv rather than one per package and python
+    version
+
+    Arguments:
+        to_fetch - A list of (PipFetcher, destination) tuples
+        use_proxy - Whether proxy environment variables should be used
+    """
+    env = get_pip_env(use_proxy)
+    by_virtualenv = OrderedDict()
+    for fetcher, _ in to_fetch:
+        for attr, settings in (
+            ('python2_files', fetcher.python2),
+            ('python3_files', fetcher.python3),
+        ):
+            if settings:
+                by_virtualenv.setdefault(settings.virtualenv_root, []).append(
+                    (fetcher, attr, settings)
+                )
+
+    # Each virtualenv is independent, so install into all of them at once
+    with ThreadPoolExecutor(max_workers=max(1, len(by_virtualenv))) as executor:
+        futures = [
+            (
+                entries,
+                executor.submit(
+                    install_pip_packages,
+                    [(fetcher, settings) for fetcher, _, settings in entries],
+                    'pip',
+                    env,
+                )
+            ) for entries in by_virtualenv.values()
+        ]
+        for entries, future in futures:
+            for (fetcher, attr, _), files in zip(entries, future.result()):
+                setattr(fetcher, attr, files)
+
+    for fetcher, destination in to_fetch:
+        fetcher.write_build_files(destination)
@@ -1,6 +1,7 @@
 from contextlib import contextmanager
 import errno
 import fcntl
+import logging
 import time
 
 
@@ -32,3 +33,28 @@ def open_with_lock(filename, mode):
         fcntl.flock(f.fileno(), fcntl.LOCK_UN)
     except Exception:
         pass
+
+
+def with_retries(func, description, attempts, delay, retry_on=(Exception,)):
+    """
+    Calls func until it succeeds, up to `attempts` times, doubling the
+    delay between each attempt. The last error is re-raised
+
+    Arguments:
+        func - The function to call. Takes no arguments
+        description - What func is doing. Used in logging
+        attempts - The maximum number of times to call func
+        delay - The number of seconds to wait after the first failure
+        retry_on - A tuple of exception types that should be retried
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == attempts:
+                raise
+            logging.warning(
+                "{yellow}Attempt %s of %s at %s failed: %s. Retrying in "
+                "%.1fs{clear}", attempt, attempts, description, e, delay)
+            time.sleep(delay)
+            delay *= 2
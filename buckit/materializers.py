@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import errno
+import fcntl
+import logging
+import os
+import platform
+import shutil
+import stat
+
+from collections import Counter
+
+WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors that mean that a strategy can't work on this filesystem at all
+UNSUPPORTED_ERRNOS = (
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EPERM,
+    errno.ENOSYS,
+)
+
+
+class MaterializeUnsupported(Exception):
+    """
+    Raised by a materializer when it cannot be used for the current tree,
+    e.g. because the filesystem does not support reflinks
+    """
+    pass
+
+
+def _make_user_writable(path):
+    mode = os.lstat(path).st_mode
+    os.chmod(path, mode | stat.S_IWUSR)
+
+
+class Materializer:
+    """
+    A strategy for creating one file in a checkout from a file in the cache
+    """
+    name = None
+
+    def is_supported(self):
+        return True
+
+    def materialize_file(self, src, dst):
+        """
+        Creates dst from src
+
+        Returns:
+            True if dst was created, False if this strategy does not apply
+            to src, but might apply to other files
+        Raises:
+            MaterializeUnsupported if this strategy should not be tried again
+            for this tree
+        """
+        raise NotImplementedError()
+
+
+class ReflinkMaterializer(Materializer):
+    """
+    Creates copy-on-write clones of files on filesystems like btrfs and xfs.
+    These cost no data copying, and are safe to modify
+    """
+    name = 'reflink'
+
+    def is_supported(self):
+        return platform.system() == 'Linux'
+
+    def materialize_file(self, src, dst):
+        try:
+            with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError as e:
+            if os.path.exists(dst):
+                os.remove(dst)
+            if e.errno in UNSUPPORTED_ERRNOS:
+                raise MaterializeUnsupported(str(e))
+            raise
+        shutil.copystat(src, dst)
+        _make_user_writable(dst)
+        return True
+
+
+class HardlinkMaterializer(Materializer):
+    """
+    Hardlinks files into the checkout. Only read-only files are linked so
+    that the checkout cannot modify the cache through the link by accident
+    """
+    name = 'hardlink'
+
+    def materialize_file(self, src, dst):
+        if os.stat(src).st_mode & WRITE_BITS:
+            return False
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            if e.errno in UNSUPPORTED_ERRNOS + (errno.EMLINK,):
+                raise MaterializeUnsupported(str(e))
+            raise
+        return True
+
+
+class CopyMaterializer(Materializer):
+    """
+    Copies the file's data. Always works, but costs O(bytes)
+    """
+    name = 'copy'
+
+    def materialize_file(self, src, dst):
+        shutil.copy2(src, dst)
+        _make_user_writable(dst)
+        return True
+
+
+def get_default_materializers():
+    """
+    Gets the materializers to try in order of preference
+    """
+    return [
+        ReflinkMaterializer(),
+        HardlinkMaterializer(),
+        CopyMaterializer(),
+    ]
+
+
+def materialize_tree(src, dst, materializers=None):
+    """
+    Creates dst as a copy of the tree at src, creating each file with the
+    first materializer that works for it. Symlinks are preserved
+
+    Arguments:
+        src - The tree to copy
+        dst - The directory to create. It must not exist
+        materializers - A list of Materializer objects to try in order. If
+                        not provided, get_default_materializers() is used
+
+    Returns:
+        A Counter of materializer name to the number of files it created
+    """
+    if materializers is None:
+        materializers = get_default_materializers()
+    candidates = [m for m in materializers if m.is_supported()]
+    report = Counter()
+
+    def materialize_file(file_src, file_dst):
+        for materializer in list(candidates):
+            try:
+                if materializer.materialize_file(file_src, file_dst):
+                    report[materializer.name] += 1
+                    return file_dst
+            except MaterializeUnsupported as e:
+                logging.debug(
+                    "Not using %s to materialize %s: %s", materializer.name,
+                    dst, e
+                )
+                candidates.remove(materializer)
+        raise OSError(
+            errno.ENOTSUP,
+            'No materializer could create {} from {}'.format(
+                file_dst, file_src)
+        )
+
+    shutil.copytree(src, dst, symlinks=True, copy_function=materialize_file)
+    return report
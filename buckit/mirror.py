@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import urllib.parse
+import urllib.request
+
+import cache
+from helpers import BuckitException, open_with_lock
+
+TARBALLS_DIR = 'tarballs'
+GIT_DIR = 'git'
+EXTRACTED_DIR = 'buckit-mirrors'
+
+
+class LocalMirror:
+    """
+    A local copy of the sources of packages, so that they can be fetched on
+    machines without network access. Sources are looked up in the mirror
+    instead of at their repository.url, and it is an error for a source to
+    be missing.
+
+    The mirror is either a directory, or a tar archive of one, laid out as:
+
+        tarballs/<sha256>[.tar.gz etc]
+        tarballs/<last component of the url>
+        git/<host>/<path of the url>[.bundle|.git]
+        git/<last component of the url>[.bundle|.git]
+
+    Git repositories are either bundles made with
+    `git bundle create <name>.bundle --all`, or bare clones
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.exists(self.path):
+            raise BuckitException("Mirror {} does not exist", self.path)
+        self.root = None
+
+    def get_root(self):
+        """
+        Gets the directory that the mirror's contents are in, extracting the
+        mirror into the cache first if it is an archive
+        """
+        if self.root is None:
+            if os.path.isdir(self.path):
+                self.root = self.path
+            else:
+                self.root = self.extract()
+        return self.root
+
+    def extract(self):
+        st = os.stat(self.path)
+        key = hashlib.sha1(
+            '{}:{}:{}'.format(self.path, st.st_size,
+                              st.st_mtime).encode('utf-8')
+        ).hexdigest()[:12]
+        extracted_dir = os.path.join(cache.get_cache_root(), EXTRACTED_DIR)
+        os.makedirs(extracted_dir, exist_ok=True)
+        root = os.path.join(
+            extracted_dir, '{}-{}'.format(os.path.basename(self.path), key)
+        )
+        with open_with_lock(root + '.lock', 'w'):
+            if os.path.isdir(root):
+                return root
+            logging.info(
+                "{bold}Extracting mirror %s to %s{clear}", self.path, root
+            )
+            tmp_dir = tempfile.mkdtemp(dir=extracted_dir)
+            try:
+                with tarfile.open(self.path, 'r:*') as tar:
+                    if hasattr(tarfile, 'tar_filter'):
+                        tar.extractall(tmp_dir, filter='tar')
+                    else:
+                        tar.extractall(tmp_dir)
+                # Allow the archive to contain the mirror directory itself
+                contents = os.listdir(tmp_dir)
+                if (len(contents) == 1 and
+                        contents[0] not in (TARBALLS_DIR, GIT_DIR)):
+                    os.rename(os.path.join(tmp_dir, contents[0]), root)
+                else:
+                    os.rename(tmp_dir, root)
+            finally:
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+        return root
+
+    def get_candidates(self, url):
+        """
+        Gets the names that a url may be stored under, most specific first
+        """
+        parsed = urllib.parse.urlparse(url)
+        if not parsed.scheme and ':' in url and '@' in url.split(':')[0]:
+            # scp style git urls, like git@github.com:facebook/buckit.git
+            host, path = url.split('@', 1)[1].split(':', 1)
+        else:
+            host, path = parsed.hostname or '', parsed.path
+        path = path.strip('/')
+        candidates = []
+        if host and path:
+            candidates.append(os.path.join(host, path))
+        if path:
+            candidates.append(os.path.basename(path))
+        return candidates
+
+    def tarball_url(self, url, sha256):
+        """
+        Gets a file:// url for the copy of a tarball in the mirror
+
+        Arguments:
+            url - The original url of the tarball
+            sha256 - The expected hash of the tarball
+
+        Returns:
+            A file:// url that can be fetched like the original url
+        """
+        tarballs = os.path.join(self.get_root(), TARBALLS_DIR)
+        paths = [os.path.join(tarballs, sha256)]
+        paths.extend(sorted(glob.glob(
+            os.path.join(tarballs, glob.escape(sha256) + '.*')
+        )))
+        paths.append(os.path.join(tarballs, os.path.basename(
+            urllib.parse.urlparse(url).path
+        )))
+        for path in paths:
+            if os.path.isfile(path):
+                logging.debug("Using %s from mirror for %s", path, url)
+                return 'file://' + urllib.request.pathname2url(path)
+        raise BuckitException(
+            "Could not find {} in mirror {}. Looked for {}", url, self.path,
+            ', '.join(paths))
+
+    def git_source(self, url):
+        """
+        Gets the path to the git bundle or bare repository for a git url in
+        the mirror. It can be used anywhere that the url can
+        """
+        git_dir = os.path.join(self.get_root(), GIT_DIR)
+        paths = []
+        for candidate in self.get_candidates(url):
+            if candidate.endswith('.git'):
+                candidate = candidate[:-len('.git')]
+            for suffix in ('.bundle', '.git', ''):
+                paths.append(os.path.join(git_dir, candidate + suffix))
+        for path in paths:
+            if os.path.exists(path):
+                logging.debug("Using %s from mirror for %s", path, url)
+                return path
+        raise BuckitException(
+            "Could not find {} in mirror {}. Looked for {}", url, self.path,
+            ', '.join(paths))
+
+
+def get_mirror(path):
+    """
+    Gets the LocalMirror at path, or None if path is empty
+    """
+    if not path:
+        return None
+    return LocalMirror(path)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import hashlib
+import json
+import logging
+import os
+import uuid
+
+from helpers import open_with_lock
+
+STATE_FILE = '.buckit-state.json'
+# Bump this when the format of the state file changes
+STATE_VERSION = 1
+
+
+def get_signature(path):
+    """
+    Gets the signature that is used to tell whether a file changed
+
+    Returns:
+        A list of [mtime in ns, size, sha256 of the contents], or None if the
+        file does not exist
+    """
+    try:
+        st = os.stat(path)
+        with open(path, 'rb') as fin:
+            digest = hashlib.sha256(fin.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size, digest]
+
+
+def get_signatures(paths):
+    """
+    Gets the get_signature() of each of paths, as a dictionary of path to
+    signature. See ProjectState.set()
+    """
+    return {path: get_signature(path) for path in paths}
+
+
+class ProjectState:
+    """
+    Results of earlier buckit runs that are persisted in the project root,
+    along with the signatures of the files that they were computed from.
+    A result is only used if none of those files have changed, so that
+    buckit does not need to re-read every package.json and rewrite every
+    config on each run
+
+    Results are stored under a key, and each key has its own set of files
+    that it depends on. Several buckit processes may use the state at once,
+    so only the keys that this process changed are written back
+    """
+
+    def __init__(self, project_root):
+        self.path = os.path.join(project_root, STATE_FILE)
+        self.data = self.read()
+        # Keys that were set, removed or refreshed since the last save()
+        self.changed = set()
+
+    def read(self):
+        """
+        Reads the state file, or returns empty state if there is no usable
+        one
+        """
+        try:
+            with open(self.path, 'r') as fin:
+                data = json.loads(fin.read())
+            if data.get('version') == STATE_VERSION:
+                return data
+            logging.debug("Ignoring old state file at %s", self.path)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.debug("Could not parse state file at %s: %s", self.path, e)
+        return {}
+
+    def is_unchanged(self, signatures):
+        """
+        Whether none of the files in signatures changed. A file whose
+        mtime or size changed but whose contents did not counts as
+        unchanged, and its new signature is recorded in signatures
+
+        Arguments:
+            signatures - A dictionary of path to get_signature() result
+        """
+        for path, signature in signatures.items():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                if signature is None:
+                    continue
+                logging.debug("%s was removed", path)
+                return False
+            if signature is None:
+                logging.debug("%s was created", path)
+                return False
+            if [st.st_mtime_ns, st.st_size] == signature[:2]:
+                continue
+            new_signature = get_signature(path)
+            if new_signature is None or new_signature[2] != signature[2]:
+                logging.debug("%s changed", path)
+                return False
+            signatures[path] = new_signature
+        return True
+
+    def get(self, key, context=None):
+        """
+        Gets a result, if the files that it depends on have not changed
+
+        Arguments:
+            key - The name of the result
+            context - If provided, any json serializable value that the
+                      result depends on other than files, like the
+                      environment. The result is only returned if this is
+                      equal to the context that it was stored with
+
+        Returns:
+            The stored value, or None
+        """
+        entry = self.data.get(key)
+        if not entry or entry.get('context') != context:
+            return None
+        inputs = dict(entry['inputs'])
+        if not self.is_unchanged(inputs):
+            return None
+        if inputs != entry['inputs']:
+            entry['inputs'] = inputs
+            self.changed.add(key)
+        return entry['value']
+
+    def set(self, key, value, inputs, context=None):
+        """
+        Stores a result
+
+        Arguments:
+            key - The name of the result
+            value - Any json serializable value
+            inputs - A dictionary of path to get_signature() result for
+                     the files that value was computed from, or depends on
+                     in some other way. Signatures must be taken before the
+                     files are read, so that a file that changes while value
+                     is computed invalidates it. A path that did not exist
+                     is recorded as None, and the value becomes invalid if
+                     it is created. That may also be a directory
+            context - See get()
+        """
+        self.data[key] = {
+            'context': context,
+            'inputs': dict(inputs),
+            'value': value,
+        }
+        self.changed.add(key)
+
+    def remove(self, key):
+        if key in self.data:
+            del self.data[key]
+            self.changed.add(key)
+
+    def save(self):
+        """
+        Writes the keys that changed back to the project root. Keys that
+        other processes wrote in the meantime are kept
+        """
+        if not self.changed:
+            return
+        try:
+            with open_with_lock(self.path + '.lock', 'w'):
+                data = self.read()
+                for key in self.changed:
+                    if key in self.data:
+                        data[key] = self.data[key]
+                    else:
+                        data.pop(key, None)
+                data['version'] = STATE_VERSION
+                tmp_path = '{}.{}.tmp'.format(self.path, uuid.uuid4().hex)
+                try:
+                    with open(tmp_path, 'w') as fout:
+                        json.dump(data, fout, sort_keys=True)
+                    os.replace(tmp_path, self.path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+        except OSError as e:
+            # The state is only an optimization
+            logging.debug("Could not write state file %s: %s", self.path, e)
+        self.changed = set()
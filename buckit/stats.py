@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import copy
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import cache
+from helpers import open_with_lock
+
+# Timed phases of a fetch, in the order that they happen. Tarballs are
+# hashed while they are downloaded, so that is part of populate
+PHASES = ['populate', 'materialize', 'total']
+# Runs with the same value for this are combined in one report
+SESSION_ENVVAR = 'BUCKIT_FETCH_SESSION'
+
+
+class FetchStats:
+    """
+    Collects per package timings, transfer sizes and cache results for a
+    run of buckit, so that slow bootstraps can be attributed to the
+    network, extraction or copying. Safe to use from multiple threads
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = os.environ.get(SESSION_ENVVAR) or None
+        self.started = time.time()
+        self.packages = OrderedDict()
+
+    def get_package(self, package):
+        # Must be called with self.lock held
+        if package not in self.packages:
+            self.packages[package] = OrderedDict([
+                ('type', None),
+                ('cache', None),
+                ('bytes_downloaded', 0),
+                ('materialized_files', {}),
+                ('seconds', OrderedDict()),
+            ])
+        return self.packages[package]
+
+    def record(self, package, **fields):
+        """
+        Sets fields, like type or cache, for a package
+        """
+        with self.lock:
+            self.get_package(package).update(fields)
+
+    def add_bytes(self, package, count):
+        with self.lock:
+            self.get_package(package)['bytes_downloaded'] += count
+
+    def add_time(self, package, phase, seconds):
+        with self.lock:
+            times = self.get_package(package)['seconds']
+            times[phase] = times.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, package, phase):
+        """
+        Adds the time spent inside of the with block to phase for package,
+        whether or not the block raises
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(package, phase, time.time() - start)
+
+    def report(self):
+        """
+        Gets all recorded statistics as a dictionary that can be serialized
+        to json
+        """
+        with self.lock:
+            packages = copy.deepcopy(self.packages)
+        finished = time.time()
+        return OrderedDict([
+            ('session', self.session),
+            ('started', self.started),
+            ('finished', finished),
+            ('wall_seconds', finished - self.started),
+            ('packages', packages),
+        ])
+
+    def write_report(self, path):
+        """
+        Adds report() to the json report at path. yarn runs a separate
+        buckit process for each package, often several at once, and they
+        all write to the same report. So the report is locked while it is
+        updated, and the packages from other runs in the same session are
+        kept. See is_same_session()
+        """
+        path = os.path.abspath(path)
+        report = self.report()
+        with open_with_lock(path + '.lock', 'w'):
+            try:
+                with open(path, 'r') as fin:
+                    old = json.load(fin)
+                if is_same_session(old, report):
+                    report = merge_reports(old, report)
+                else:
+                    logging.debug(
+                        "Replacing fetch report %s from an earlier run", path
+                    )
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logging.warning(
+                    "{yellow}Replacing unreadable fetch report %s: %s{clear}",
+                    path, e
+                )
+            tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+            try:
+                with open(tmp_path, 'w') as fout:
+                    json.dump(report, fout, indent=2)
+                    fout.write('\n')
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        logging.info("{bold}Wrote fetch report to %s{clear}", path)
+
+    def log_summary(self):
+        """
+        Logs a table with a row per package, slowest first
+        """
+        report = self.report()
+        packages = sorted(
+            report['packages'].items(),
+            key=lambda item: item[1]['seconds'].get('total', 0.0),
+            reverse=True,
+        )
+        if not packages:
+            return
+        width = max(len('package'), max(len(name) for name, _ in packages))
+        row = '{:<%d}  {:<7}  {:<5}  {:>10}' % width
+        row += '  {:>15}' * len(PHASES)
+        lines = [
+            row.format(
+                'package', 'type', 'cache', 'downloaded',
+                *[phase + ' (s)' for phase in PHASES]
+            )
+        ]
+        for name, info in packages:
+            lines.append(
+                row.format(
+                    name, info['type'] or '-', info['cache'] or '-',
+                    cache.format_size(info['bytes_downloaded']), *[
+                        '{:.2f}'.format(info['seconds'][phase])
+                        if phase in info['seconds'] else '-'
+                        for phase in PHASES
+                    ]
+                )
+            )
+        logging.info(
+            "{bold}Fetch summary (%.1fs total):{clear}\n%s",
+            report['wall_seconds'], '\n'.join(lines)
+        )
+
+
+def is_same_session(old, new):
+    """
+    Whether two FetchStats.report() results belong to the same session, and
+    should be combined. Runs are in the same session if they were given the
+    same BUCKIT_FETCH_SESSION, or, if neither was given one, if they ran at
+    the same time
+    """
+    if old.get('session') or new['session']:
+        return old.get('session') == new['session']
+    return old.get('finished', 0) >= new['started']
+
+
+def merge_reports(old, new):
+    """
+    Combines two FetchStats.report() results. A package that is in both
+    gets its statistics from new, and the wall time covers both runs
+    """
+    packages = OrderedDict(old.get('packages', {}))
+    packages.update(new['packages'])
+    started = min(old.get('started', new['started']), new['started'])
+    finished = max(old.get('finished', new['finished']), new['finished'])
+    return OrderedDict([
+        ('session', new['session']),
+        ('started', started),
+        ('finished', finished),
+        ('wall_seconds', finished - started),
+        ('packages', packages),
+    ])
+
+
+# The statistics for the current run of buckit
+fetch_stats = FetchStats()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+from helpers import BuckitException
+
+
+class GarbageCollectTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache_root = tmp.name
+
+    def make_partial(self, key, size, last_used):
+        partial_path = cache.get_partial_path(self.cache_root, key)
+        with open(partial_path, 'wb') as fout:
+            fout.write(b'x' * size)
+        cache.write_journal(partial_path, {'url': key, 'bytes': size})
+        for path in (partial_path, partial_path + '.journal'):
+            os.utime(path, (last_used, last_used))
+        return partial_path
+
+    def make_tree(self, key, size, last_used):
+        tree = os.path.join(self.cache_root, 'tree')
+        os.makedirs(tree)
+        with open(os.path.join(tree, 'file'), 'wb') as fout:
+            fout.write(b'x' * size)
+        store_path = cache.publish(self.cache_root, tree, key)
+        cache.touch(store_path, last_used=last_used)
+        return store_path
+
+    def make_dir(self, path, size, last_used):
+        path = os.path.join(self.cache_root, path)
+        os.makedirs(path)
+        with open(os.path.join(path, 'file'), 'wb') as fout:
+            fout.write(b'x' * size)
+        cache.touch(path, last_used=last_used)
+        return path
+
+    def test_evicts_least_recently_used(self):
+        newest = self.make_tree('sha256-newest', 1000, last_used=300)
+        oldest = self.make_tree('sha256-oldest', 1000, last_used=100)
+        middle = self.make_tree('sha256-middle', 1000, last_used=200)
+        mirror = self.make_dir(
+            os.path.join(cache.GIT_MIRRORS_DIR, 'repo.git'), 1000,
+            last_used=250
+        )
+        # A tree that an older version of buckit stored at its index path
+        legacy = self.make_dir(
+            cache.INDEX_PREFIX + 'legacy-1.0', 1000, last_used=150
+        )
+        indexes = {}
+        for name, store_path in (('newest', newest), ('oldest', oldest)):
+            indexes[name] = cache.get_index_path(self.cache_root, name, '1')
+            cache.link_index(indexes[name], store_path)
+
+        self.assertEqual(
+            (3, 3000, 2000), cache.garbage_collect(self.cache_root, 2000)
+        )
+        for path in (oldest, legacy, middle):
+            self.assertFalse(os.path.exists(path), path)
+            self.assertFalse(os.path.exists(path + '.meta'), path)
+        for path in (newest, mirror):
+            self.assertTrue(os.path.isdir(path), path)
+        # Indexes of evicted trees are removed too
+        self.assertFalse(os.path.lexists(indexes['oldest']))
+        self.assertEqual(newest, cache.lookup(
+            self.cache_root, indexes['newest']
+        ))
+
+    def test_use_updates_order(self):
+        first = self.make_tree('sha256-first', 1000, last_used=100)
+        second = self.make_tree('sha256-second', 1000, last_used=200)
+        cache.touch(first)
+        cache.garbage_collect(self.cache_root, 1000)
+        self.assertTrue(os.path.isdir(first))
+        self.assertFalse(os.path.exists(second))
+
+    def test_skips_entries_in_use(self):
+        in_use = self.make_tree('sha256-in-use', 1000, last_used=100)
+        unused = self.make_tree('sha256-unused', 1000, last_used=200)
+        newest = self.make_tree('sha256-newest', 1000, last_used=300)
+        # Fetchers hold a shared lock while they materialize an entry
+        with cache.entry_lock(in_use, shared=True):
+            self.assertEqual(
+                (1, 1000, 2000), cache.garbage_collect(self.cache_root, 2000)
+            )
+        self.assertTrue(os.path.isdir(in_use))
+        self.assertFalse(os.path.exists(unused))
+        self.assertTrue(os.path.isdir(newest))
+
+    def test_under_budget(self):
+        tree = self.make_tree('sha256-tree', 1000, last_used=100)
+        self.assertEqual(
+            (0, 0, 1000), cache.garbage_collect(self.cache_root, 1000)
+        )
+        self.assertTrue(os.path.isdir(tree))
+
+    def test_parse_size(self):
+        self.assertEqual(1024, cache.parse_size('1024'))
+        self.assertEqual(500 * 1024 ** 2, cache.parse_size('500M'))
+        self.assertEqual(20 * 1024 ** 3, cache.parse_size('20GiB'))
+        self.assertEqual(1536, cache.parse_size('1.5k'))
+        with self.assertRaisesRegex(BuckitException, 'Could not parse'):
+            cache.parse_size('lots')
+
+    def test_partials_count_toward_size(self):
+        old = self.make_partial('sha256-old', 1000, last_used=100)
+        locked = self.make_partial('sha256-locked', 1000, last_used=200)
+        tree = self.make_tree('sha256-tree', 1000, last_used=300)
+        new = self.make_partial('sha256-new', 1000, last_used=400)
+        # A journal whose download was never started
+        orphan = cache.get_partial_path(self.cache_root, 'sha256-orphan')
+        cache.write_journal(orphan, {'url': 'orphan', 'bytes': 0})
+        os.utime(orphan + '.journal', (50, 50))
+
+        with cache.entry_lock(locked, shared=False):
+            evicted, freed, total = cache.garbage_collect(
+                self.cache_root, 2500)
+
+        self.assertEqual(3, evicted)
+        for path in (orphan, old, tree):
+            self.assertFalse(os.path.exists(path))
+            self.assertFalse(os.path.exists(path + '.journal'))
+        for path in (locked, new):
+            self.assertTrue(os.path.exists(path))
+            self.assertTrue(os.path.exists(path + '.journal'))
+        self.assertEqual(
+            cache.read_partial_info(locked)['size'] +
+            cache.read_partial_info(new)['size'],
+            total)
+
+    def test_removes_lock_files(self):
+        tree = self.make_tree('sha256-tree', 1000, last_used=100)
+        partial = self.make_partial('sha256-partial', 1000, last_used=200)
+        with cache.populate_lock(tree, 'package'):
+            pass
+        with cache.entry_lock(tree, shared=True):
+            pass
+        with cache.entry_lock(partial, shared=False):
+            pass
+
+        cache.garbage_collect(self.cache_root, 0)
+
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.cache_root, cache.STORE_DIR))
+        )
+        self.assertEqual(
+            [], os.listdir(os.path.join(self.cache_root, cache.PARTIAL_DIR))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compiler
+from project_state import ProjectState
+
+
+class CachedDetectTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.root = self.tempdir.name
+        self.bin_dir = os.path.join(self.root, 'bin')
+        os.mkdir(self.bin_dir)
+        self.write_compiler('1.0')
+        patcher = mock.patch.dict(os.environ, {'PATH': self.bin_dir})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('CC', None)
+        os.environ.pop('CXX', None)
+        self.detected = []
+
+    def write_compiler(self, version, path=None):
+        path = path or os.path.join(self.bin_dir, 'cc')
+        with open(path, 'w') as fout:
+            fout.write('#!/bin/sh\necho "cc version {}"\n'.format(version))
+        os.chmod(path, stat.S_IRWXU)
+
+    def detect(self, command):
+        self.detected.append(command)
+        return '-std=gnu11'
+
+    def cached_detect(self):
+        # Each run of buckit loads the state from disk again
+        state = ProjectState(self.root)
+        result = compiler.cached_detect(state, 'c_standard', 'cc', self.detect)
+        state.save()
+        self.assertEqual('-std=gnu11', result)
+
+    def test_result_is_reused(self):
+        self.cached_detect()
+        self.cached_detect()
+        self.assertEqual(['cc'], self.detected)
+
+    def test_binary_change_invalidates(self):
+        self.cached_detect()
+        self.write_compiler('1.0 with a longer build string')
+        self.cached_detect()
+        self.assertEqual(['cc', 'cc'], self.detected)
+
+    def test_cc_change_invalidates(self):
+        self.cached_detect()
+        os.environ['CC'] = 'clang'
+        self.cached_detect()
+        os.environ['CXX'] = 'clang++'
+        self.cached_detect()
+        self.assertEqual(['cc', 'cc', 'cc'], self.detected)
+
+    def test_version_change_invalidates(self):
+        # Same binary on PATH, but a different compiler behind it, like a
+        # pyenv or ccache shim would do
+        real = os.path.join(self.root, 'real_cc')
+        self.write_compiler('1.0', real)
+        shim = os.path.join(self.bin_dir, 'cc')
+        with open(shim, 'w') as fout:
+            fout.write('#!/bin/sh\nexec {} "$@"\n'.format(real))
+        st = os.stat(shim)
+        self.cached_detect()
+        self.write_compiler('2.0', real)
+        os.utime(shim, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.cached_detect()
+        self.cached_detect()
+        self.assertEqual(['cc', 'cc'], self.detected)
+
+    def test_missing_binary_is_not_cached(self):
+        state = ProjectState(self.root)
+        result = compiler.cached_detect(
+            state, 'c_standard', 'missing-cc', self.detect
+        )
+        self.assertEqual('-std=gnu11', result)
+        self.assertIsNone(state.get('toolchain.c_standard.missing-cc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
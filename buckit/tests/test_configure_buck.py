@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# compiler has to be imported before configure_buck
+import compiler  # noqa: F401
+import configure_buck
+from constants import PACKAGE_JSON
+from helpers import BuckitException
+from project_state import ProjectState
+
+
+class UpdateConfigTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+
+    def test_writes_through_symlink(self):
+        target = os.path.join(self.root, 'shared.buckconfig')
+        with open(target, 'w') as fout:
+            fout.write('[project]\n  ignore = .git\n')
+        os.chmod(target, 0o664)
+        buckconfig = os.path.join(self.root, '.buckconfig')
+        os.symlink('shared.buckconfig', buckconfig)
+
+        configure_buck.update_config(
+            self.root, buckconfig, {'buckit': {'key': 'value'}})
+
+        self.assertTrue(os.path.islink(buckconfig))
+        self.assertEqual(0o664, stat.S_IMODE(os.stat(target).st_mode))
+        with open(target) as fin:
+            contents = fin.read()
+        self.assertIn('ignore = .git', contents)
+        self.assertIn('key = value', contents)
+        self.assertEqual(
+            ['._buckconfig.lock', '.buckconfig', 'shared.buckconfig'],
+            sorted(os.listdir(self.root)))
+
+
+class BuildDependencyGraphTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        env = mock.patch.dict(os.environ, {'npm_package_name': ''})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def add_package(self, name, deps):
+        directory = self.root
+        if name:
+            directory = os.path.join(self.root, 'node_modules', name)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, PACKAGE_JSON), 'w') as fout:
+            fout.write(json.dumps({
+                'name': name or 'root',
+                'dependencies': {dep: '1.0' for dep in deps},
+            }))
+
+    def build(self, package_name=''):
+        return configure_buck.build_dependency_graph(
+            self.root, 'node_modules', package_name
+        )
+
+    def test_shared_dependencies_are_read_once(self):
+        self.add_package('', ['a', 'b'])
+        self.add_package('a', ['c'])
+        self.add_package('b', ['c', 'missing'])
+        self.add_package('c', [])
+        read_package_json = configure_buck.read_package_json
+        with mock.patch.object(
+            configure_buck, 'read_package_json', side_effect=read_package_json
+        ) as read:
+            graph = self.build()
+        paths = [call[0][0] for call in read.call_args_list]
+        self.assertEqual(len(set(paths)), len(paths))
+        self.assertEqual(5, len(paths))
+
+        self.assertEqual({'a', 'b'}, graph.root_deps)
+        self.assertEqual(['a', 'b', 'c'], sorted(graph.paths))
+        self.assertEqual(
+            os.path.join(self.root, 'node_modules', 'c'), graph.paths['c']
+        )
+        self.assertEqual(['c', 'missing'], graph.dependencies['b'])
+        self.assertNotIn('missing', graph.jsons)
+
+    def test_graph_of_package(self):
+        self.add_package('', ['a'])
+        self.add_package('a', ['b'])
+        self.add_package('b', [])
+        graph = self.build('a')
+        self.assertEqual(['a', 'b'], sorted(graph.paths))
+        self.assertEqual(set(), graph.root_deps)
+
+    def test_graph_is_reused(self):
+        self.add_package('', ['a'])
+        self.add_package('a', [])
+        first = self.build()
+        with mock.patch.object(configure_buck, 'read_package_json') as read:
+            second = self.build()
+        self.assertFalse(read.called)
+        self.assertEqual(first.paths, second.paths)
+        self.assertEqual(first.root_deps, second.root_deps)
+
+    def test_cycle(self):
+        self.add_package('', ['a'])
+        self.add_package('a', ['b'])
+        self.add_package('b', ['c'])
+        self.add_package('c', ['a'])
+        with self.assertRaisesRegex(
+            BuckitException,
+            'Found a cycle when finding dependencies: a -> b -> c -> a'
+        ):
+            self.build()
+
+    def test_cycle_through_package(self):
+        self.add_package('a', ['b'])
+        self.add_package('b', ['a'])
+        with self.assertRaisesRegex(
+            BuckitException,
+            'Found a cycle when finding dependencies: a -> b -> a'
+        ):
+            self.build('a')
+
+
+class ConfigureAllPackagesTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        env = mock.patch.dict(os.environ, {'npm_package_name': ''})
+        env.start()
+        self.addCleanup(env.stop)
+        self.write_json(PACKAGE_JSON, {'name': 'root', 'dependencies': {
+            'a': '1.0', 'b': '1.0'}})
+        self.write_json('node_modules/a/package.json', {'name': 'a'})
+        self.write('yarn.lock', 'a@1.0\n')
+        self.assertTrue(self.configure())
+        self.assertFalse(self.configure())
+
+    def write(self, path, contents):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fout:
+            fout.write(contents)
+
+    def write_json(self, path, js):
+        self.write(path, json.dumps(js))
+
+    def read(self, path):
+        with open(os.path.join(self.root, path)) as fin:
+            return fin.read()
+
+    def configure(self):
+        """
+        Runs configure_buck_for_all_packages(), and returns whether it
+        wrote the configs instead of finding them up to date
+        """
+        with self.assertLogs(level='DEBUG') as logs:
+            configure_buck.configure_buck_for_all_packages(
+                self.root, 'node_modules'
+            )
+        return not any('is up to date' in line for line in logs.output)
+
+    def test_package_json_edited(self):
+        self.write_json('node_modules/a/package.json', {
+            'name': 'a', 'buckit': {'cell_name': 'cell_a'}})
+        self.assertTrue(self.configure())
+        self.assertIn('cell_a', self.read('.buckconfig'))
+        self.assertFalse(self.configure())
+
+    def test_package_json_created(self):
+        self.write_json('node_modules/b/package.json', {'name': 'b'})
+        self.assertTrue(self.configure())
+        self.assertIn('yarn|b', self.read('.buckconfig'))
+
+    def test_yarn_lock_edited(self):
+        self.write('yarn.lock', 'a@1.0\nb@1.0\n')
+        self.assertTrue(self.configure())
+
+    def test_output_edited(self):
+        self.write('.buckconfig', '')
+        self.assertTrue(self.configure())
+        self.assertIn('yarn|a', self.read('.buckconfig'))
+
+    def test_cell_created(self):
+        self.write('.buckconfig.local', self.read('.buckconfig.local').replace(
+            '[repository_aliases]\n',
+            '[repository_aliases]\nextra = third-party/extra\n'
+        ))
+        self.assertTrue(self.configure())
+        self.assertFalse(self.configure())
+        os.makedirs(os.path.join(self.root, 'third-party', 'extra'))
+        self.assertTrue(self.configure())
+        self.assertTrue(os.path.exists(os.path.join(
+            self.root, 'third-party', 'extra', '.buckconfig.local'
+        )))
+
+    def test_context_changed(self):
+        with mock.patch.dict(os.environ, {'npm_package_name': 'b'}):
+            self.assertTrue(self.configure())
+        self.assertTrue(self.configure())
+
+    def test_edited_while_reading(self):
+        read_package_json = configure_buck.read_package_json
+        package_json = os.path.join(
+            self.root, 'node_modules', 'a', 'package.json'
+        )
+        self.write_json('node_modules/a/package.json', {
+            'name': 'a', 'buckit': {'cell_name': 'old'}})
+
+        def read_and_edit(json_path):
+            js = read_package_json(json_path)
+            if json_path == package_json:
+                self.write_json('node_modules/a/package.json', {
+                    'name': 'a', 'buckit': {'cell_name': 'newer'}})
+            return js
+
+        with mock.patch.object(
+            configure_buck, 'read_package_json', side_effect=read_and_edit
+        ):
+            self.assertTrue(self.configure())
+        self.assertTrue(self.configure())
+        self.assertIn('newer', self.read('.buckconfig'))
+
+    def test_concurrent_saves(self):
+        first = ProjectState(self.root)
+        second = ProjectState(self.root)
+        first.set('first', 1, {})
+        second.set('second', 2, {})
+        second.remove('graph')
+        first.save()
+        second.save()
+        state = ProjectState(self.root)
+        self.assertEqual(1, state.get('first'))
+        self.assertEqual(2, state.get('second'))
+        self.assertIsNone(state.get('graph'))
+        self.assertIsNotNone(state.data.get('configs'))
+
+
+if __name__ == '__main__':
+    unittest.main()
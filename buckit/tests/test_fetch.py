@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# compiler has to be imported before configure_buck, which fetch uses
+import compiler  # noqa: F401
+import cache
+import fetch
+import fetchers
+
+PYTHON_ARGS = {
+    'use_python2': False,
+    'python2_virtualenv': 'virtualenv',
+    'python2_virtualenv_root': 'venv2',
+    'use_python3': False,
+    'python3_virtualenv': 'virtualenv',
+    'python3_virtualenv_root': 'venv3',
+    'virtualenv_use_proxy_vars': False,
+    'force': False,
+}
+
+
+class ProjectTestCase(unittest.TestCase):
+    """
+    Sets up a project that depends on the tarball packages a, b and c
+    """
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        env = mock.patch.dict(os.environ, {
+            'HOME': os.path.join(self.root, 'home'),
+            'npm_package_name': '',
+            cache.MAX_SIZE_ENVVAR: '1G',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+        self.packages = ['a', 'b', 'c']
+        self.write_json(self.root, {
+            'name': 'root',
+            'dependencies': {name: '1.0' for name in self.packages},
+        })
+        for name in self.packages:
+            self.add_tarball_package(name)
+
+    def write_json(self, directory, js):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'package.json'), 'w') as fout:
+            fout.write(json.dumps(js))
+
+    def add_tarball_package(self, name):
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode='w:gz') as tar:
+            info = tarfile.TarInfo('{}/{}.txt'.format(name, name))
+            info.size = len(name)
+            tar.addfile(info, io.BytesIO(name.encode('utf-8')))
+        path = os.path.join(self.root, name + '.tar.gz')
+        with open(path, 'wb') as fout:
+            fout.write(tarball.getvalue())
+        self.write_json(os.path.join(self.root, 'node_modules', name), {
+            'name': name,
+            'scripts': {'postinstall': 'buckit fetch'},
+            'repository': {
+                'type': 'tarball',
+                'url': 'file://' + path,
+                'sha256': hashlib.sha256(tarball.getvalue()).hexdigest(),
+            },
+        })
+
+    def get_fetched_path(self, name):
+        return os.path.join(
+            self.root, 'node_modules', name, name, 'src', name + '.txt'
+        )
+
+    def assert_fetched(self, name):
+        path = self.get_fetched_path(name)
+        self.assertTrue(os.path.exists(path), path)
+
+
+class FetchAllPackagesTest(ProjectTestCase):
+
+    def test_fetches_concurrently(self):
+        # Every fetch waits for the others to start
+        barrier = threading.Barrier(len(self.packages), timeout=10)
+        run_fetcher = fetch.run_fetcher
+
+        def wait_and_run(*args):
+            barrier.wait()
+            run_fetcher(*args)
+
+        with mock.patch.object(fetch, 'run_fetcher', side_effect=wait_and_run):
+            self.assertEqual(0, fetch.fetch_all_packages(
+                self.root, 'node_modules', jobs=len(self.packages),
+                **PYTHON_ARGS
+            ))
+        for name in self.packages:
+            self.assert_fetched(name)
+
+    def test_only_fetched_packages(self):
+        self.write_json(os.path.join(self.root, 'node_modules', 'b'), {
+            'name': 'b',
+        })
+        self.assertEqual(0, fetch.fetch_all_packages(
+            self.root, 'node_modules', jobs=2, **PYTHON_ARGS
+        ))
+        self.assert_fetched('a')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, 'node_modules', 'b', 'b')
+        ))
+        self.assert_fetched('c')
+
+    def test_failure_does_not_stop_others(self):
+        os.remove(os.path.join(self.root, 'b.tar.gz'))
+        with self.assertLogs(level='ERROR') as logs, mock.patch.object(
+            fetchers.HttpTarballFetcher, 'RETRY_DELAY', 0
+        ):
+            self.assertEqual(1, fetch.fetch_all_packages(
+                self.root, 'node_modules', jobs=1, **PYTHON_ARGS
+            ))
+        self.assert_fetched('a')
+        self.assert_fetched('c')
+        self.assertFalse(os.path.exists(self.get_fetched_path('b')))
+        self.assertIn('Could not fetch 1 package(s): b', logs.output[-1])
+
+class GarbageCollectAfterFetchTest(ProjectTestCase):
+
+    def setUp(self):
+        super().setUp()
+        gc = mock.patch.object(
+            cache, 'garbage_collect', wraps=cache.garbage_collect
+        )
+        self.garbage_collect = gc.start()
+        self.addCleanup(gc.stop)
+
+    def test_fetch_all_packages(self):
+        self.assertEqual(0, fetch.fetch_all_packages(
+            self.root, 'node_modules', jobs=3, **PYTHON_ARGS
+        ))
+        for name in self.packages:
+            self.assert_fetched(name)
+        self.assertEqual(1, self.garbage_collect.call_count)
+
+    def test_fetch_package(self):
+        self.assertEqual(0, fetch.fetch_package(
+            self.root, 'node_modules', 'a', **PYTHON_ARGS
+        ))
+        self.assert_fetched('a')
+        self.assertEqual(1, self.garbage_collect.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
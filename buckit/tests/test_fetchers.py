@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import glob
+import hashlib
+import http.server
+import io
+import os
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# compiler has to be imported before configure_buck, which fetchers uses
+import compiler  # noqa: F401
+import cache
+import fetch
+import fetchers
+from helpers import BuckitException
+from mirror import LocalMirror
+from stats import fetch_stats
+
+# Nothing under .invalid resolves, so any network access fails
+REMOTE = 'https://example.invalid/'
+
+
+def git(*args, cwd):
+    return subprocess.check_output(
+        ['git', '-c', 'protocol.file.allow=always'] + list(args),
+        cwd=cwd,
+        stderr=subprocess.DEVNULL,
+    ).decode('utf-8').strip()
+
+
+class GitMirrorTest(unittest.TestCase):
+    """
+    Fetches a repository with nested submodules from a LocalMirror, with
+    every protocol but local files disabled
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        env = mock.patch.dict(os.environ, {
+            'HOME': os.path.join(self.tmp_dir, 'home'),
+            'GIT_ALLOW_PROTOCOL': 'file',
+            'GIT_AUTHOR_NAME': 'test',
+            'GIT_AUTHOR_EMAIL': 'test@example.com',
+            'GIT_COMMITTER_NAME': 'test',
+            'GIT_COMMITTER_EMAIL': 'test@example.com',
+        })
+        env.start()
+        self.addCleanup(env.stop)
+
+        self.mirror_dir = os.path.join(self.tmp_dir, 'mirror')
+        os.makedirs(os.path.join(self.mirror_dir, 'git', 'example.invalid'))
+        subsub = self.make_repo('subsub', [])
+        # A relative url, like in the superproject, and an absolute one
+        sub = self.make_repo('sub', [('subsub', subsub, REMOTE + 'subsub')])
+        self.make_repo('super', [('sub', sub, '../sub.git')])
+        self.commit = git('rev-parse', 'HEAD', cwd=self.repo_path('super'))
+
+    def repo_path(self, name):
+        return os.path.join(self.tmp_dir, 'repos', name)
+
+    def make_repo(self, name, submodules):
+        """
+        Makes a repository with a commit and the tag v1, and bundles it into
+        the mirror
+
+        Arguments:
+            submodules - A list of (path, repository to add, url to record)
+        """
+        path = self.repo_path(name)
+        os.makedirs(path)
+        git('init', '-q', cwd=path)
+        with open(os.path.join(path, name + '.txt'), 'w') as fout:
+            fout.write(name)
+        git('add', '.', cwd=path)
+        for submodule_path, repo, url in submodules:
+            git('submodule', 'add', '-q', repo, submodule_path, cwd=path)
+            git('config', '-f', '.gitmodules',
+                'submodule.{}.url'.format(submodule_path), url, cwd=path)
+            git('add', '.gitmodules', cwd=path)
+        git('commit', '-q', '-m', name, cwd=path)
+        git('tag', 'v1', cwd=path)
+        git('bundle', 'create', os.path.join(
+            self.mirror_dir, 'git', 'example.invalid', name + '.bundle'
+        ), '--all', cwd=path)
+        return path
+
+    def fetch(self, commit=None, tag=None):
+        fetcher = fetchers.GitFetcher(
+            'super', 'package.json', REMOTE + 'super.git', commit, tag,
+            mirror=LocalMirror(self.mirror_dir)
+        )
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(out_dir, exist_ok=True)
+        destination = os.path.join(out_dir, 'src')
+        fetcher.populate_cache(destination, use_proxy=False)
+        return destination
+
+    def assert_checked_out(self, destination):
+        for path in ['super.txt', 'sub/sub.txt', 'sub/subsub/subsub.txt']:
+            self.assertTrue(
+                os.path.exists(os.path.join(destination, path)), path
+            )
+        self.assertEqual(
+            REMOTE + 'sub.git',
+            git('remote', 'get-url', 'origin',
+                cwd=os.path.join(destination, 'sub'))
+        )
+
+    def test_commit_with_submodules(self):
+        self.assert_checked_out(self.fetch(commit=self.commit))
+
+    def test_tag_with_submodules(self):
+        self.assert_checked_out(self.fetch(tag='v1'))
+
+    def test_content_key_covers_submodules(self):
+        fetcher = fetchers.GitFetcher(
+            'super', 'package.json', REMOTE + 'super.git', self.commit, None
+        )
+        destination = self.fetch(commit=self.commit)
+        key = fetcher.content_key(destination)
+        tree_hash = git('rev-parse', 'HEAD^{tree}', cwd=destination)
+        self.assertRegex(
+            key, '^git-commit-{}-[0-9a-f]{{64}}$'.format(self.commit)
+        )
+        # Which refs were fetched does not matter
+        shutil.rmtree(destination)
+        self.assertEqual(key, fetcher.content_key(self.fetch(tag='v1')))
+
+        # A nested submodule at another commit does not change the tree
+        subsub = os.path.join(destination, 'sub', 'subsub')
+        git('commit', '-q', '--allow-empty', '-m', 'change', cwd=subsub)
+        self.assertEqual(
+            tree_hash, git('rev-parse', 'HEAD^{tree}', cwd=destination)
+        )
+        self.assertNotEqual(key, fetcher.content_key(destination))
+
+    def test_content_key_covers_commit(self):
+        # A revert has the same tree as the commit before it
+        repo = self.repo_path('super')
+        git('revert', '--no-edit', 'HEAD', cwd=repo)
+        git('revert', '--no-edit', 'HEAD', cwd=repo)
+        reverted = git('rev-parse', 'HEAD', cwd=repo)
+        self.assertEqual(
+            git('rev-parse', 'HEAD^{tree}', cwd=repo),
+            git('rev-parse', self.commit + '^{tree}', cwd=repo)
+        )
+        git('bundle', 'create', os.path.join(
+            self.mirror_dir, 'git', 'example.invalid', 'super.bundle'
+        ), '--all', cwd=repo)
+
+        keys = set()
+        for commit in (self.commit, reverted):
+            destination = self.fetch(commit=commit)
+            self.assertEqual(commit, git('rev-parse', 'HEAD', cwd=destination))
+            fetcher = fetchers.GitFetcher(
+                'super', 'package.json', REMOTE + 'super.git', commit, None
+            )
+            keys.add(fetcher.content_key(destination))
+            shutil.rmtree(destination)
+        self.assertEqual(2, len(keys))
+
+    def test_missing_submodule(self):
+        os.remove(os.path.join(
+            self.mirror_dir, 'git', 'example.invalid', 'subsub.bundle'
+        ))
+        with self.assertRaisesRegex(
+            BuckitException,
+            r'Submodule subsub \(.*/subsub\) of .*/sub.git is not in the'
+        ):
+            self.fetch(commit=self.commit)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves server.files, honoring `Range: bytes=<start>-` like most servers
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.ranges.append(self.headers.get('Range'))
+        time.sleep(self.server.delay)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        start = int(match.group(1)) if match else 0
+        if start >= len(content):
+            self.send_error(416)
+            return
+        self.send_response(206 if match else 200)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        if self.server.stalls:
+            # Send the headers, but never any data
+            self.server.stalls -= 1
+            self.wfile.flush()
+            self.server.unstall.wait(10)
+            return
+        self.wfile.write(content[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ResumableDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        env = mock.patch.dict(
+            os.environ, {'HOME': os.path.join(self.tmp_dir, 'home')}
+        )
+        env.start()
+        self.addCleanup(env.stop)
+
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), RangeRequestHandler
+        )
+        self.server.files = {}
+        self.server.requests = []
+        self.server.ranges = []
+        self.server.delay = 0
+        self.server.stalls = 0
+        self.server.unstall = threading.Event()
+        self.addCleanup(self.server.unstall.set)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode='w:gz') as tar:
+            info = tarfile.TarInfo('package/hello.txt')
+            info.size = 5
+            tar.addfile(info, io.BytesIO(b'hello'))
+        self.tarball = tarball.getvalue()
+        self.server.files['/package.tar.gz'] = self.tarball
+        self.url = 'http://127.0.0.1:{}/package.tar.gz'.format(
+            self.server.server_port
+        )
+        self.fetcher = fetchers.HttpTarballFetcher(
+            'package', 'package.json', self.url,
+            hashlib.sha256(self.tarball).hexdigest()
+        )
+        self.fetcher.RETRY_DELAY = 0
+        self.partial_path = cache.get_partial_path(
+            cache.get_cache_root(), self.fetcher.content_key()
+        )
+
+    def save_partial(self, data):
+        with open(self.partial_path, 'wb') as fout:
+            fout.write(data)
+        cache.write_journal(
+            self.partial_path, {'url': self.url, 'bytes': len(data)}
+        )
+
+    def fetch(self):
+        out_dir = os.path.join(self.tmp_dir, 'out')
+        os.makedirs(out_dir, exist_ok=True)
+        destination = os.path.join(out_dir, 'src')
+        self.fetcher.populate_cache(destination, use_proxy=False)
+        return destination
+
+    def assert_no_partial(self):
+        for path in (self.partial_path, self.partial_path + '.journal'):
+            self.assertFalse(os.path.exists(path), path)
+
+    def test_resume_partial(self):
+        self.save_partial(self.tarball[:10])
+        destination = self.fetch()
+        with open(os.path.join(destination, 'hello.txt')) as fin:
+            self.assertEqual('hello', fin.read())
+        self.assert_no_partial()
+
+    def test_resume_complete(self):
+        # The last run was interrupted after saving the whole file, so the
+        # server answers our range request with a 416
+        self.save_partial(self.tarball)
+        destination = self.fetch()
+        with open(os.path.join(destination, 'hello.txt')) as fin:
+            self.assertEqual('hello', fin.read())
+        self.assert_no_partial()
+
+    def test_stalled_response(self):
+        self.save_partial(self.tarball[:10])
+        self.server.stalls = 1
+        self.fetcher.DOWNLOAD_TIMEOUT = 0.2
+        start = time.monotonic()
+        destination = self.fetch()
+        # The server gives up on the stalled response after 10 seconds
+        self.assertLess(time.monotonic() - start, 5)
+        with open(os.path.join(destination, 'hello.txt')) as fin:
+            self.assertEqual('hello', fin.read())
+        # Both attempts continue after what the journal says was saved
+        self.assertEqual(['bytes=10-', 'bytes=10-'], self.server.ranges)
+        self.assert_no_partial()
+
+    def test_stalled_too_often(self):
+        self.save_partial(self.tarball[:10])
+        self.server.stalls = 1
+        self.fetcher.DOWNLOAD_TIMEOUT = 0.2
+        self.fetcher.DOWNLOAD_ATTEMPTS = 1
+        with self.assertRaises(socket.timeout):
+            self.fetch()
+        # The saved data is kept for the next run
+        self.assertEqual(
+            {'url': self.url, 'bytes': 10},
+            cache.read_journal(self.partial_path)
+        )
+        self.fetch()
+        self.assertEqual(['bytes=10-', 'bytes=10-'], self.server.ranges)
+        self.assert_no_partial()
+
+    def test_timeout_from_environment(self):
+        with mock.patch.dict(
+            os.environ, {fetchers.DOWNLOAD_TIMEOUT_ENVVAR: '2.5'}
+        ):
+            self.assertEqual(2.5, self.fetcher.get_download_timeout())
+
+    def test_non_retryable_error(self):
+        self.save_partial(self.tarball[:10])
+        del self.server.files['/package.tar.gz']
+        with self.assertRaisesRegex(BuckitException, 'Could not download'):
+            self.fetch()
+        self.assert_no_partial()
+
+    def test_already_published(self):
+        store_path = cache.get_store_path(
+            cache.get_cache_root(), self.fetcher.content_key()
+        )
+        os.makedirs(store_path)
+        destination = self.fetch()
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual([], self.server.requests)
+
+    def test_same_content_downloaded_once(self):
+        # Two packages with the same tarball, fetched at the same time
+        self.server.delay = 0.2
+        other = fetchers.HttpTarballFetcher(
+            'other', 'package.json', self.url, self.fetcher.sha256
+        )
+        other.RETRY_DELAY = 0
+        destinations = [
+            os.path.join(self.tmp_dir, name) for name in ('package', 'other')
+        ]
+        threads = [
+            threading.Thread(
+                target=fetcher.fetch,
+                args=(self.tmp_dir, destination, False)
+            ) for fetcher, destination in zip(
+                (self.fetcher, other), destinations
+            )
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(['/package.tar.gz'], self.server.requests)
+        for destination in destinations:
+            with open(os.path.join(destination, 'src', 'hello.txt')) as fin:
+                self.assertEqual('hello', fin.read())
+        packages = fetch_stats.report()['packages']
+        self.assertEqual(
+            ['hit', 'miss'],
+            sorted(packages[name]['cache'] for name in ('package', 'other'))
+        )
+
+
+class PipFetcherTest(unittest.TestCase):
+    """
+    Fetches pip packages with a fake pip that installs metadata for
+    whatever it is asked to install
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        open(os.path.join(self.root, '.buckconfig'), 'w').close()
+        self.version = '1.0'
+        self.commands = []
+        for prefix, python in (('py2', 'python2.7'), ('py3', 'python3.6')):
+            venv = os.path.join(self.root, 'venv-' + prefix)
+            os.makedirs(os.path.join(venv, 'bin'))
+            open(os.path.join(venv, 'bin', 'activate'), 'w').close()
+            os.makedirs(os.path.join(venv, 'lib', python, 'site-packages'))
+        run = mock.patch.object(
+            fetchers, 'run_in_virtualenv', side_effect=self.fake_pip
+        )
+        run.start()
+        self.addCleanup(run.stop)
+
+    def fake_pip(self, python_settings, command, env):
+        self.commands.append((python_settings.virtualenv_root, command))
+        args = shlex.split(command)
+        self.assertEqual(['pip', 'install', '-I'], args[:3])
+        site_packages = fetchers.find_site_packages(
+            python_settings.virtualenv_root
+        )[0]
+        installed = []
+        for package in args[3:]:
+            name = re.split('[=<>]', package)[0]
+            for stale in glob.glob(
+                os.path.join(site_packages, name + '-*.dist-info')
+            ):
+                shutil.rmtree(stale)
+            metadata = os.path.join(
+                site_packages, '{}-{}.dist-info'.format(name, self.version)
+            )
+            os.makedirs(metadata)
+            with open(os.path.join(metadata, 'METADATA'), 'w') as fout:
+                fout.write('Name: {}\nVersion: {}\n\n'.format(
+                    name, self.version
+                ))
+            with open(os.path.join(metadata, 'RECORD'), 'w') as fout:
+                fout.write('{}/__init__.py,,\n'.format(name))
+                fout.write('../../../bin/{},,\n'.format(name))
+            installed.append('{}-{}'.format(name, self.version))
+        return 'Successfully installed {}\n'.format(' '.join(installed))
+
+    def make_fetcher(self, name, py2=False):
+        settings = fetch.get_python_settings(
+            self.root, py2, 'virtualenv', 'venv-py2', True, 'virtualenv',
+            'venv-py3'
+        )
+        destination = os.path.join(self.root, 'node_modules', name, name)
+        fetcher = fetchers.PipFetcher(
+            name, 'package.json', name if py2 else '', '', name, '==1.0',
+            'main', [], settings
+        )
+        return fetcher, destination
+
+    def read_buckfile(self, destination):
+        with open(os.path.join(destination, 'BUCK')) as fin:
+            return fin.read()
+
+    def test_one_pip_run_per_virtualenv(self):
+        to_fetch = [
+            self.make_fetcher('foo', py2=True),
+            self.make_fetcher('bar'),
+            self.make_fetcher('baz', py2=True),
+        ]
+        fetchers.batch_fetch_pip_packages(to_fetch, use_proxy=False)
+        self.assertEqual([
+            (os.path.join(self.root, 'venv-py2'), "pip install -I foo baz"),
+            (
+                os.path.join(self.root, 'venv-py3'),
+                "pip install -I foo==1.0 bar==1.0 baz==1.0"
+            ),
+        ], sorted(self.commands))
+        for fetcher, destination in to_fetch:
+            name = fetcher.package_name
+            buckfile = self.read_buckfile(destination)
+            self.assertIn(
+                'r"{0}/__init__.py": r"py3/lib/python3.6/site-packages/'
+                '{0}/__init__.py"'.format(name), buckfile
+            )
+            self.assertIn('main=r"bin/{}"'.format(name), buckfile)
+            self.assertEqual(
+                name != 'bar', 'py2/lib/python2.7/site-packages' in buckfile
+            )
+            self.assertTrue(os.path.islink(os.path.join(destination, 'py3')))
+
+    def test_unchanged_package_is_not_regenerated(self):
+        fetcher, destination = self.make_fetcher('foo')
+        fetcher.fetch(self.root, destination, use_proxy=False)
+        with open(os.path.join(self.root, '.buckconfig')) as fin:
+            self.assertIn('node_modules/foo/foo/py3', fin.read())
+
+        fetcher, destination = self.make_fetcher('foo')
+        with mock.patch.object(fetchers, 'update_config') as update_config, \
+                mock.patch('builtins.open', wraps=open) as opened:
+            fetcher.fetch(self.root, destination, use_proxy=False)
+        self.assertFalse(update_config.called)
+        buckfile = os.path.join(destination, 'BUCK')
+        self.assertNotIn(
+            mock.call(buckfile, 'w'), opened.call_args_list
+        )
+
+        # A new version is a change, even if the same files are installed
+        self.version = '2.0'
+        fetcher, destination = self.make_fetcher('foo')
+        with mock.patch.object(fetchers, 'update_config') as update_config:
+            fetcher.fetch(self.root, destination, use_proxy=False)
+        self.assertTrue(update_config.called)
+
+
+class InstalledMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.site_packages = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.site_packages)
+
+    def add_metadata(self, entry, version, files):
+        path = os.path.join(self.site_packages, entry)
+        os.makedirs(path)
+        with open(os.path.join(path, 'METADATA'), 'w') as fout:
+            fout.write('Name: foo-bar\nVersion: {}\n\n'.format(version))
+        with open(os.path.join(path, 'RECORD'), 'w') as fout:
+            fout.write(''.join(f + ',,\n' for f in files))
+        return path
+
+    def test_parse_installed_versions(self):
+        self.assertEqual(
+            {'foo-bar': '2.0', 'six': '1.11.0'},
+            fetchers.parse_installed_versions(
+                'Collecting foo-bar==2.0\n'
+                'Successfully installed foo-bar-2.0 six-1.11.0\n'
+            )
+        )
+
+    def test_stale_metadata(self):
+        self.add_metadata('foo_bar-1.0.dist-info', '1.0', ['foo/old.py'])
+        new = self.add_metadata(
+            'foo_bar-2.0.dist-info', '2.0', ['foo/new.py']
+        )
+        self.add_metadata('foo_barbaz-2.0.dist-info', '2.0', [])
+        site_packages = [self.site_packages]
+
+        self.assertEqual(
+            new,
+            fetchers.find_installed_metadata(site_packages, 'Foo.Bar', '2.0')
+        )
+        self.assertEqual(
+            (self.site_packages, ['foo/new.py']),
+            fetchers.read_installed_files(site_packages, 'foo-bar', '2.0')
+        )
+        self.assertIsNone(
+            fetchers.find_installed_metadata(site_packages, 'foo-bar', '3.0')
+        )
+        with self.assertRaisesRegex(BuckitException, 'several installs'):
+            fetchers.find_installed_metadata(site_packages, 'foo-bar')
+
+    def test_version_from_metadata(self):
+        # The version in the directory name is not always normalized like
+        # the one pip reports
+        path = self.add_metadata('foo_bar.egg-info', '1.0.0', [])
+        self.assertEqual(
+            path,
+            fetchers.find_installed_metadata(
+                [self.site_packages], 'foo-bar', '1.0.0'
+            )
+        )
+        self.assertEqual(
+            '1.0.0',
+            fetchers.read_installed_version([self.site_packages], 'foo-bar')
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
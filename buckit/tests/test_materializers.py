@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import errno
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import materializers
+
+
+def fail_with(error):
+    def fail(*args):
+        raise OSError(error, os.strerror(error))
+    return fail
+
+
+class MaterializeTreeTest(unittest.TestCase):
+    def setUp(self):
+        # Reflinks are only tried on Linux
+        system = mock.patch.object(
+            materializers.platform, 'system', return_value='Linux'
+        )
+        system.start()
+        self.addCleanup(system.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.src = os.path.join(tmp.name, 'src')
+        self.dst = os.path.join(tmp.name, 'dst')
+        os.makedirs(os.path.join(self.src, 'dir'))
+        self.write('read_only', 'read only', 0o444)
+        self.write('dir/read_only', 'nested', 0o444)
+        self.write('writable', 'writable', 0o644)
+        os.symlink('read_only', os.path.join(self.src, 'link'))
+
+    def write(self, path, contents, mode):
+        path = os.path.join(self.src, path)
+        with open(path, 'w') as fout:
+            fout.write(contents)
+        os.chmod(path, mode)
+
+    def assert_copied(self):
+        for path, contents in (
+            ('read_only', 'read only'),
+            ('dir/read_only', 'nested'),
+            ('writable', 'writable'),
+            ('link', 'read only'),
+        ):
+            with open(os.path.join(self.dst, path)) as fin:
+                self.assertEqual(contents, fin.read())
+        self.assertEqual(
+            'read_only', os.readlink(os.path.join(self.dst, 'link'))
+        )
+
+    def is_hardlink(self, path):
+        return os.path.samefile(
+            os.path.join(self.src, path), os.path.join(self.dst, path)
+        )
+
+    def test_falls_back_to_hardlink_and_copy(self):
+        with mock.patch.object(
+            materializers.fcntl, 'ioctl',
+            side_effect=fail_with(errno.EOPNOTSUPP)
+        ) as ioctl:
+            report = materializers.materialize_tree(self.src, self.dst)
+        self.assert_copied()
+        # Reflinks are not tried again once they are known not to work
+        self.assertEqual(1, ioctl.call_count)
+        self.assertEqual({'hardlink': 2, 'copy': 1}, dict(report))
+
+    def test_only_read_only_files_are_hardlinked(self):
+        report = materializers.materialize_tree(
+            self.src, self.dst, [
+                materializers.HardlinkMaterializer(),
+                materializers.CopyMaterializer(),
+            ]
+        )
+        self.assert_copied()
+        self.assertEqual({'hardlink': 2, 'copy': 1}, dict(report))
+        self.assertTrue(self.is_hardlink('read_only'))
+        self.assertTrue(self.is_hardlink('dir/read_only'))
+        self.assertFalse(self.is_hardlink('writable'))
+        # Copies can be modified without touching the cache
+        mode = os.stat(os.path.join(self.dst, 'writable')).st_mode
+        self.assertTrue(mode & stat.S_IWUSR)
+
+    def test_falls_back_to_copy(self):
+        with mock.patch.object(
+            materializers.fcntl, 'ioctl', side_effect=fail_with(errno.EXDEV)
+        ), mock.patch.object(
+            materializers.os, 'link', side_effect=fail_with(errno.EXDEV)
+        ) as link:
+            report = materializers.materialize_tree(self.src, self.dst)
+        self.assert_copied()
+        self.assertEqual(1, link.call_count)
+        self.assertEqual({'copy': 3}, dict(report))
+        for path in ('read_only', 'dir/read_only', 'writable'):
+            self.assertFalse(self.is_hardlink(path))
+            mode = os.stat(os.path.join(self.dst, path)).st_mode
+            self.assertTrue(mode & stat.S_IWUSR)
+
+    def test_reflink(self):
+        def clone(dst_fd, request, src_fd):
+            self.assertEqual(materializers.FICLONE, request)
+            os.write(dst_fd, os.read(src_fd, 1024))
+
+        with mock.patch.object(
+            materializers.fcntl, 'ioctl', side_effect=clone
+        ):
+            report = materializers.materialize_tree(self.src, self.dst)
+        self.assert_copied()
+        self.assertEqual({'reflink': 3}, dict(report))
+        # Clones are private to the checkout, so they are writable
+        mode = os.stat(os.path.join(self.dst, 'read_only')).st_mode
+        self.assertTrue(mode & stat.S_IWUSR)
+
+    def test_unexpected_error(self):
+        with mock.patch.object(
+            materializers.fcntl, 'ioctl', side_effect=fail_with(errno.EIO)
+        ):
+            with self.assertRaisesRegex(shutil.Error, 'Input/output error'):
+                materializers.materialize_tree(self.src, self.dst)
+
+    def test_nothing_works(self):
+        with self.assertRaisesRegex(shutil.Error, 'No materializer could'):
+            materializers.materialize_tree(self.src, self.dst, [
+                materializers.HardlinkMaterializer(),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# compiler has to be imported before configure_buck, which fetch uses
+import compiler  # noqa: F401
+import buckit
+import fetch
+import stats
+
+
+class WriteReportTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'report.json')
+        env = mock.patch.dict(os.environ, {stats.SESSION_ENVVAR: ''})
+        env.start()
+        self.addCleanup(env.stop)
+
+    def run_fetch(self, package):
+        fetch_stats = stats.FetchStats()
+        fetch_stats.record(package, type='tarball')
+        return fetch_stats
+
+    def read_packages(self):
+        with open(self.path) as fin:
+            return sorted(json.load(fin)['packages'])
+
+    def test_concurrent_runs(self):
+        runs = [self.run_fetch('package{}'.format(i)) for i in range(20)]
+        threads = [
+            threading.Thread(target=run.write_report, args=(self.path,))
+            for run in runs
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(
+            sorted('package{}'.format(i) for i in range(20)),
+            self.read_packages()
+        )
+
+    def test_earlier_run_is_replaced(self):
+        self.run_fetch('old').write_report(self.path)
+        self.run_fetch('new').write_report(self.path)
+        self.assertEqual(['new'], self.read_packages())
+
+    def test_same_session(self):
+        with mock.patch.dict(os.environ, {stats.SESSION_ENVVAR: 'install'}):
+            self.run_fetch('first').write_report(self.path)
+            self.run_fetch('second').write_report(self.path)
+        self.assertEqual(['first', 'second'], self.read_packages())
+        with mock.patch.dict(os.environ, {stats.SESSION_ENVVAR: 'other'}):
+            self.run_fetch('third').write_report(self.path)
+        self.assertEqual(['third'], self.read_packages())
+
+    def test_failed_fetch_is_reported(self):
+        def fetch_package(package, **kwargs):
+            stats.fetch_stats.record(package, error='broken')
+            raise RuntimeError('broken')
+
+        with mock.patch.object(
+            fetch, 'fetch_package', side_effect=fetch_package
+        ), mock.patch.object(stats.fetch_stats, 'packages', {}):
+            with self.assertRaises(RuntimeError):
+                buckit.main([
+                    'fetch', '--package', 'package', '--report', self.path
+                ])
+        with open(self.path) as fin:
+            report = json.load(fin)
+        self.assertEqual('broken', report['packages']['package']['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright 2016-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import os
+import subprocess
+import sys
+import unittest
+
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# compiler has to be imported before configure_buck, which use_system uses
+import compiler  # noqa: F401
+import use_system
+
+PACKAGES = ['openssl-devel', 'zlib-devel', 'zstd']
+
+
+class GetInstalledPackagesTest(unittest.TestCase):
+    def query(self, system, stdout):
+        """
+        Runs get_installed_packages(PACKAGES) on system, with the package
+        manager printing stdout
+
+        Returns:
+            A tuple of (installed packages, the command that was run)
+        """
+        with mock.patch.object(
+            use_system, 'get_current_system', return_value=(system, '7.4')
+        ), mock.patch.object(
+            use_system.subprocess, 'run',
+            return_value=subprocess.CompletedProcess(
+                [], 1, stdout.encode('utf-8')
+            )
+        ) as run:
+            installed = use_system.get_installed_packages(PACKAGES)
+        if not run.called:
+            return installed, None
+        self.assertEqual(1, run.call_count)
+        return installed, run.call_args[0][0]
+
+    def test_rpm(self):
+        installed, cmd = self.query(
+            'centos',
+            'openssl-devel\n'
+            'package zlib-devel is not installed\n'
+            'zstd\n'
+        )
+        self.assertEqual({'openssl-devel', 'zstd'}, installed)
+        self.assertEqual(
+            ['rpm', '-q', '--queryformat', '%{NAME}\n'] + PACKAGES, cmd
+        )
+
+    def test_dpkg_query(self):
+        installed, cmd = self.query(
+            'ubuntu',
+            'openssl-devel install ok installed\n'
+            'zlib-devel deinstall ok config-files\n'
+            'zstd unknown ok not-installed\n'
+        )
+        self.assertEqual({'openssl-devel'}, installed)
+        self.assertEqual(
+            ['dpkg-query', '-W', '-f', '${Package} ${Status}\n'] + PACKAGES,
+            cmd
+        )
+
+    def test_brew(self):
+        installed, cmd = self.query(
+            'darwin', 'zlib-devel 1.2.11\nzstd 1.3.4 1.3.5\n'
+        )
+        self.assertEqual({'zlib-devel', 'zstd'}, installed)
+        self.assertEqual(['brew', 'list', '--versions'] + PACKAGES, cmd)
+
+    def test_unknown_system(self):
+        self.assertEqual((set(), None), self.query('plan9', ''))
+
+    def test_missing_package_manager(self):
+        with mock.patch.object(
+            use_system, 'get_current_system', return_value=('centos', '7')
+        ), mock.patch.object(
+            use_system.subprocess, 'run', side_effect=FileNotFoundError()
+        ):
+            self.assertEqual(
+                set(), use_system.get_installed_packages(PACKAGES)
+            )
+
+    def test_only_missing_packages_are_installed(self):
+        with mock.patch.object(
+            use_system, 'get_current_system', return_value=('ubuntu', '16.04')
+        ), mock.patch.object(
+            use_system, 'get_installed_packages', return_value={'zstd'}
+        ), mock.patch.object(use_system, 'readable_check_call') as install:
+            use_system.install_system_packages(PACKAGES)
+        install.assert_called_once_with(
+            ['sudo', 'apt', 'install', '-y', 'openssl-devel', 'zlib-devel'],
+            action='installing system packages'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
+import functools
 import logging
 import os
 import platform
@@ -38,8 +39,39 @@ def get_for_current_system(options, default=None):
     if not isinstance(options, dict):
         return options
 
+    system, version_str = get_current_system()
+    system_selection = options.get(system, None)
+    if system_selection is None:
+        return options.get('default', default)
+
+    if not isinstance(system_selection, dict):
+        return system_selection
+
+    # Take a very non-strict version check. We will check as many components
+    # of the version as are common in both versions. e.g. if '7' is in the
+    # map, and our version is '7.1.3', then we've found a match. We make sure
+    # to sort the keys in descending order, first, to make sure that we
+    # handle sub versions properly
+    version = version_str.split('.')
+    keys = sorted(system_selection.keys(), reverse=True)
+    for key in keys:
+        found_version = key.split('.')
+        if all((x == y for x, y in zip(found_version, version))):
+            return system_selection[key]
+    return system_selection.get('default', default)
+
+
+@functools.lru_cache(maxsize=None)
+def get_current_system():
+    """
+    Detects the current platform. This does not change while buckit runs, so
+    it is only done once
+
+    Returns:
+        A tuple of (lowercased system or linux distribution name, version)
+    """
     system = platform.system()
-    version = None
+    version_str = ''
     if system == 'Linux':
         # This is going to be removed in 3.7, but it's a bit of a pain to get
         # distro() installed
@@ -62,33 +94,70 @@ def get_for_current_system(options, default=None):
         version_str = platform.win32_ver()[1]
     elif system == 'Darwin':
         version_str = platform.mac_ver()[0]
+    return system.lower(), version_str
 
-    system = system.lower()
-    system_selection = options.get(system, None)
-    if system_selection is None:
-        return options.get('default', default)
 
-    if not isinstance(system_selection, dict):
-        return system_selection
+def get_installed_packages(packages):
+    """
+    Finds which of packages are already installed, with a single query of
+    the system's package database
 
-    # Take a very non-strict version check. We will check as many components
-    # of the version as are common in both versions. e.g. if '7' is in the
-    # map, and our version is '7.1.3', then we've found a match. We make sure
-    # to sort the keys in descending order, first, to make sure that we
-    # handle sub versions properly
-    version = version_str.split('.')
-    keys = sorted(system_selection.keys(), reverse=True)
-    for key in keys:
-        found_version = key.split('.')
-        if all((x == y for x, y in zip(found_version, version))):
-            return system_selection[key]
-    return system_selection.get('default', default)
+    Returns:
+        The set of installed packages. Empty if the package database could
+        not be queried on this system
+    """
+    if not packages:
+        return set()
+
+    def parse_name(line):
+        # e.g. "zlib-devel" from rpm, or "zlib 1.2.11" from brew
+        parts = line.split()
+        return parts[0] if parts else None
+
+    def parse_dpkg(line):
+        # e.g. "zlib1g-dev install ok installed"
+        parts = line.split()
+        if len(parts) > 1 and parts[-1] == 'installed':
+            return parts[0]
+        return None
+
+    queries = {
+        'darwin': (['brew', 'list', '--versions'], parse_name),
+        'centos': (['rpm', '-q', '--queryformat', '%{NAME}\n'], parse_name),
+        'ubuntu': (
+            ['dpkg-query', '-W', '-f', '${Package} ${Status}\n'], parse_dpkg
+        ),
+    }
+    query = get_for_current_system(queries, None)
+    if not query:
+        return set()
+    cmd, parse = query
+    cmd = cmd + sorted(packages)
+    logging.debug("Running %s", ' '.join(cmd))
+    try:
+        # These exit non-zero if any package is missing, so ignore the code
+        proc = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+    except OSError as e:
+        logging.debug("Could not query installed packages: %s", e)
+        return set()
+    installed = set(
+        parse(line) for line in proc.stdout.decode('utf-8').splitlines()
+    )
+    return installed & set(packages)
 
 
 def install_system_packages(packages):
     if not packages:
         return
 
+    installed = get_installed_packages(packages)
+    packages = sorted(set(packages) - installed)
+    if not packages:
+        logging.info("All system packages are already installed")
+        return
+
     logging.info("Installing system packages: %s", packages)
     commands = {
         # TODO: Seems that brew can sometimes return 1 when all packages are
@@ -113,7 +182,7 @@ def install_system_packages(packages):
         except subprocess.CalledProcessError as e:
             error = '{} failed with code {}'.format(
                 '\n'.join(cmd), e.returncode)
-            errors += error
+            errors.append(error)
             logging.debug(error)
     else:
         logging.warning(
@@ -124,13 +193,14 @@ def install_system_packages(packages):
 def get_system_packages(project_root, node_modules, only_required):
     paths, root_pkgs, jsons = find_package_paths(project_root, node_modules)
     system_packages = set()
+    # The parsed json is shared, so copy anything that gets modified
     for js in jsons.values():
-        all_pkgs = js.get('buckit', {}).get('required_system_packages', {})
-        pkgs = get_for_current_system(all_pkgs, [])
+        buckit = js.get('buckit', {})
+        all_pkgs = dict(buckit.get('required_system_packages', {}))
+        system_packages.update(get_for_current_system(all_pkgs, []))
         if not only_required:
-            all_pkgs.update(js.get('buckit', {}).get('system_packages', {}))
-            pkgs += get_for_current_system(all_pkgs, [])
-        system_packages |= set(pkgs)
+            all_pkgs.update(buckit.get('system_packages', {}))
+            system_packages.update(get_for_current_system(all_pkgs, []))
     return system_packages
 
 
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+'''
+The CRC32C that btrfs uses to checksum send-stream commands.
+
+Unlike the usual CRC32C (e.g. in iSCSI), btrfs neither inverts the initial
+value nor the result, so `btrfs_crc32c(data, crc)` with `crc=0` is the
+checksum of `data`, and passing the checksum of a prefix as `crc`
+continues it with the rest of the data.
+
+If the `crc32c` module is installed, we use its native implementation.
+Otherwise, we fall back to a pure-Python, table-driven implementation,
+which is orders of magnitude slower.
+'''
+import struct
+
+try:
+    import crc32c as _native_crc32c
+except ImportError:  # pragma: no cover
+    _native_crc32c = None
+
+_CRC32C_POLY = 0x82F63B78  # Castagnoli, bit-reflected
+_MASK = 0xFFFFFFFF
+_UINT32 = struct.Struct('<I')
+
+
+def _make_tables():
+    '''
+    Returns the 4 tables for "slicing-by-4": `tables[k][b]` is the CRC of
+    the byte `b` followed by `k` zero bytes.
+    '''
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ _CRC32C_POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    tables = [table]
+    for _ in range(3):
+        tables.append([(c >> 8) ^ table[c & 0xFF] for c in tables[-1]])
+    return tables
+
+
+_TABLES = _make_tables()
+
+
+def table_crc32c(data: bytes, crc: int=0) -> int:
+    'Pure-Python `btrfs_crc32c`, it consumes 4 bytes per table lookup round.'
+    t0, t1, t2, t3 = _TABLES
+    view = memoryview(data).cast('B')
+    aligned = len(view) & ~3
+    for word, in _UINT32.iter_unpack(view[:aligned]):
+        crc ^= word
+        crc = (
+            t3[crc & 0xFF] ^ t2[(crc >> 8) & 0xFF] ^
+            t1[(crc >> 16) & 0xFF] ^ t0[crc >> 24]
+        )
+    for byte in view[aligned:]:
+        crc = t0[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc
+
+
+def native_crc32c(data: bytes, crc: int=0) -> int:  # pragma: no cover
+    # `crc32c.crc32c` inverts both its starting value and its result.
+    return _native_crc32c.crc32c(data, crc ^ _MASK) ^ _MASK
+
+
+btrfs_crc32c = table_crc32c if _native_crc32c is None else native_crc32c
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+'''
+Usage:
+
+  python3 -m btrfs_diff.examples.benchmark_parse_send_stream sendstream
+
+Reports the throughput of `parse_send_stream` in each of its modes, notably
+with and without CRC32C verification.  The send-stream is read into memory
+first, so that only parsing is measured, not I/O.  To benchmark on the
+"demo send-streams" from our tests:
+
+  python3 -m btrfs_diff.examples.benchmark_parse_send_stream \\
+    <(python3 -m btrfs_diff.tests.print_gold_demo_sendstreams create_ops)
+
+'''
+import argparse
+import io
+import sys
+import time
+
+from .. import checksum
+from ..parse_send_stream import parse_send_stream
+
+MODES = {
+    'default': {},
+    'data_as_views': {'data_as_views': True},
+    'skip_data': {'skip_data': True},
+    'verify_crc': {'verify_crc': True},
+    'verify_crc+skip_data': {'verify_crc': True, 'skip_data': True},
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--min-seconds', type=float, default=1.0,
+        help='Parse the send-stream repeatedly for at least this long in '
+            'each mode, to get a stable measurement.',
+    )
+    parser.add_argument(
+        '--mode', choices=MODES.keys(), action='append',
+        help='Only benchmark these modes. Repeat to select several. '
+            'Defaults to all modes.',
+    )
+    parser.add_argument(
+        'sendstream', type=argparse.FileType('br'),
+        help='A file containing the output of `btrfs send`.',
+    )
+    args = parser.parse_args(argv[1:])
+
+    sendstream = args.sendstream.read()
+    print(
+        f'{len(sendstream)} bytes, CRC32C implementation: '
+        f'{checksum.btrfs_crc32c.__name__}'
+    )
+    for mode in (args.mode or MODES.keys()):
+        runs = 0
+        start = time.monotonic()
+        while True:
+            for _ in parse_send_stream(io.BytesIO(sendstream), **MODES[mode]):
+                pass
+            runs += 1
+            elapsed = time.monotonic() - start
+            if elapsed >= args.min_seconds:
+                break
+        print(
+            f'{mode:>20}: {runs * len(sendstream) / elapsed / 2 ** 20:10.2f}'
+            f' MiB/s over {runs} runs'
+        )
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -5,7 +5,7 @@ Usage:
     alias demo_sendstream='python3 -m btrfs_diff.tests.gold_demo_sendstreams'
     demo_sendstream create_ops | python3 -m btrfs_diff.examples.dump_sendstream
 
-Reads a send-stream from stdin, prints the Python parse to stdout. This
+Reads send-streams from stdin, prints the Python parse to stdout. This
 output is only meant for human consumption -- but it would be easy to
 instead serialize each item to something parseable like JSON.
 
@@ -16,7 +16,7 @@ bugs, and is backed by through test coverage.  Read the heading of
 '''
 import sys
 
-from ..parse_send_stream import parse_send_stream
+from ..parse_send_stream import parse_send_streams
 
 
 def main(argv):
@@ -24,8 +24,10 @@ def main(argv):
         print(__doc__, file=sys.stderr)
         return 1
 
-    for item in parse_send_stream(sys.stdin.buffer):
-        print(item)
+    for subvol_item, items in parse_send_streams(sys.stdin.buffer):
+        print(subvol_item)
+        for item in items:
+            print(item)
 
 
 if __name__ == '__main__':
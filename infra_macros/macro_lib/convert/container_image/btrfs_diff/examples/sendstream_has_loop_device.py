@@ -5,15 +5,16 @@ Usage:
     python3 -m btrfs_diff.examples.sendstream_has_loop_device < sendstream ||
         echo No loop or loop-control
 
-Reads a send-stream from stdin, prints to stdout the major & minor of the
+Reads send-streams from stdin, prints to stdout the major & minor of the
 first loop or loop-control device found, and returns 0.
 
 Returns 2 if no loops exist, 1 on usage or data errors.
 '''
+import itertools
 import os
 import sys
 
-from ..parse_send_stream import parse_send_stream
+from ..parse_send_stream import parse_send_streams
 from ..send_stream import SendStreamItems
 
 
@@ -21,7 +22,11 @@ def main(argv):
     if len(argv) != 1:
         print(__doc__, file=sys.stderr)
         return 1
-    for item in parse_send_stream(sys.stdin.buffer):
+    for item in itertools.chain.from_iterable(
+        items for _, items in parse_send_streams(
+            sys.stdin.buffer, skip_data=True,
+        )
+    ):
         if isinstance(item, SendStreamItems.mknod) and (
             os.major(item.dev) == 7 or item.dev == os.makedev(10, 237)
         ):
@@ -10,7 +10,11 @@ tool's notation for filesystem metadata.
 
 A few things to try:
 
- - Pass `/dev/fd/0` for stdin,
+ - Pass `-` for stdin, e.g. to read several subvolumes from a pipe:
+
+     btrfs send parent child | python3 -m \
+       btrfs_diff.examples.sendstreams_to_json_subvolumes - | jq -C . | less -R
+
  - Run this on the "demo send-streams" from our tests via:
 
      alias demo_sendstream='python3 -m btrfs_diff.tests.gold_demo_sendstreams'
@@ -41,7 +45,7 @@ from ..inode_utils import (
     erase_mode_and_owner, erase_selinux_xattr, erase_utimes_in_range,
     SELinuxXAttrStats,
 )
-from ..parse_send_stream import parse_send_stream
+from ..parse_send_stream import parse_send_streams
 from ..rendered_tree import emit_non_unique_traversal_ids
 from ..subvolume_set import SubvolumeSet, SubvolumeSetMutator
 
@@ -101,18 +105,23 @@ def main(argv):
     )
     parser.add_argument(
         'sendstream', type=argparse.FileType('br'), nargs='+',
-        help='A file containing the output of `btrfs send`. Note that '
-            'send-stream order matters, since we will try to apply them '
-            'to our in-memory filesystem from left to right.',
+        help='A file containing the output of `btrfs send`, or `-` for '
+            'stdin. A file may contain several concatenated send-streams. '
+            'Note that send-stream order matters, since we will try to '
+            'apply them to our in-memory filesystem from left to right.',
     )
     args = parser.parse_args(argv[1:])
 
     subvols = SubvolumeSet.new()
     for sendstream_in in args.sendstream:
-        parsed = parse_send_stream(sendstream_in)
-        mutator = SubvolumeSetMutator.new(subvols, next(parsed))
-        for i in parsed:
-            mutator.apply_item(i)
+        # The output only shows the extents of files, not their contents, so
+        # don't hold on to the data of every write.
+        for subvol_item, items in parse_send_streams(
+            sendstream_in, skip_data=True,
+        ):
+            mutator = SubvolumeSetMutator.new(subvols, subvol_item)
+            for i in items:
+                mutator.apply_item(i)
 
     # Check that our send-streams completely specified the subvolumes.
     if not args.no_check_complete:
@@ -1,28 +1,72 @@
 #!/usr/bin/env python3
 'Parses the btrfs send-stream binary format. Only version 1 is supported.'
 import enum
+import itertools
 import os
 import struct
 import uuid
 
-from io import BytesIO
-from typing import NamedTuple, Iterable
+from typing import Iterator, List, NamedTuple, Iterable, Optional, Tuple
 
+from .checksum import btrfs_crc32c
 from .send_stream import SendStreamItem, SendStreamItems
 
 BTRFS_SEND_STREAM_MAGIC = b'btrfs-stream\0'
 
 
+# Precompiled, since the parser decodes these for every command & attribute.
+_COMMAND_HEADER = struct.Struct('<IHI')
+_ATTRIBUTE_HEADER = struct.Struct('<HH')
+_UINT64 = struct.Struct('<Q')
+_TIME = struct.Struct('<QI')
+# The CRC of a command is computed with its `crc` field set to 0.
+_CRC_OFFSET = _COMMAND_HEADER.size - 4
+_ZERO_CRC = bytes(4)
+
+
+def _struct_unpack(st: struct.Struct, infile):
+    b = infile.read(st.size)
+    if len(b) != st.size:
+        raise RuntimeError(f'Not enough bytes {b} for format {st.format}')
+    return st.unpack(b)
+
+
 def file_unpack(fmt, infile):
-    size = struct.calcsize(fmt)
-    b = infile.read(size)
-    if len(b) != size:
-        raise RuntimeError(f'Not enough bytes {b} for format {fmt}')
-    return struct.unpack(fmt, b)
+    return _struct_unpack(struct.Struct(fmt), infile)
+
+
+def _read_exactly(infile, size: int) -> bytes:
+    'Like `read`, but only comes up short at EOF, even for raw pipes.'
+    data = infile.read(size)
+    if len(data) == size or not data:
+        return data  # The common case, no copies
+    chunks = [data]
+    remaining = size - len(data)
+    while remaining:
+        data = infile.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+
+def _readinto_exactly(infile, view: memoryview) -> int:
+    'Like `readinto`, but only comes up short at EOF, even for pipes.'
+    total = 0
+    while total < len(view):
+        n = infile.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
 
 
 def check_magic(infile) -> None:
-    magic = infile.read(len(BTRFS_SEND_STREAM_MAGIC))
+    _check_magic(infile.read(len(BTRFS_SEND_STREAM_MAGIC)))
+
+
+def _check_magic(magic: bytes) -> None:
     if magic != BTRFS_SEND_STREAM_MAGIC:
         raise RuntimeError(f'Magic {magic}, not "{BTRFS_SEND_STREAM_MAGIC}"')
 
@@ -73,7 +117,7 @@ class CommandHeader(NamedTuple):
 
     @staticmethod
     def from_file(infile) -> 'CommandHeader':
-        length, kind, crc = file_unpack('<IHI', infile)
+        length, kind, crc = _struct_unpack(_COMMAND_HEADER, infile)
         return CommandHeader(kind=CommandKind(kind), length=length, crc=crc)
 
 
@@ -119,21 +163,81 @@ class AttributeHeader(NamedTuple):
 
     @staticmethod
     def from_file(infile) -> 'AttributeHeader':
-        kind, length = file_unpack('<HH', infile)
+        kind, length = _struct_unpack(_ATTRIBUTE_HEADER, infile)
         return AttributeHeader(kind=AttributeKind(kind), length=length)
 
 
+# The converters take `bytes` or a `memoryview`, and return a value that
+# does not reference the input buffer, since the parser reuses it.
 def conv_uuid(s: bytes) -> str:
-    return str(uuid.UUID(bytes=s)).encode()  # All our other strings are bytes
+    # All our other strings are bytes
+    return str(uuid.UUID(bytes=bytes(s))).encode()
 
 
 def conv_uint64(s: bytes) -> int:
-    i, = struct.unpack('<Q', s)
+    i, = _UINT64.unpack(s)
     return i
 
 
 def conv_time(s: bytes) -> float:
-    return struct.unpack('<QI', s)
+    return _TIME.unpack(s)
+
+
+def conv_bytes(s: bytes) -> bytes:
+    return bytes(s)
+
+
+def conv_path(s: bytes) -> bytes:
+    return os.path.normpath(bytes(s))
+
+
+_ATTRIBUTE_CONVERTERS = {
+    AttributeKind.UUID: conv_uuid,
+    AttributeKind.CTRANSID: conv_uint64,
+    AttributeKind.INO: conv_uint64,
+    AttributeKind.SIZE: conv_uint64,
+    AttributeKind.MODE: conv_uint64,
+    AttributeKind.UID: conv_uint64,
+    AttributeKind.GID: conv_uint64,
+    AttributeKind.RDEV: conv_uint64,
+    AttributeKind.CTIME: conv_time,
+    AttributeKind.MTIME: conv_time,
+    AttributeKind.ATIME: conv_time,
+    AttributeKind.XATTR_NAME: conv_bytes,
+    AttributeKind.XATTR_DATA: conv_bytes,
+    AttributeKind.PATH: conv_path,
+    AttributeKind.PATH_TO: conv_path,
+    # NB This is NOT normalized since we don't want to normalize symlinks
+    AttributeKind.PATH_LINK: conv_bytes,
+    AttributeKind.FILE_OFFSET: conv_uint64,
+    AttributeKind.DATA: conv_bytes,
+    AttributeKind.CLONE_UUID: conv_uuid,
+    AttributeKind.CLONE_CTRANSID: conv_uint64,
+    AttributeKind.CLONE_PATH: conv_path,
+    AttributeKind.CLONE_OFFSET: conv_uint64,
+    AttributeKind.CLONE_LEN: conv_uint64,
+}
+
+
+def _make_attribute_table(**kind_name_to_conv):
+    '''
+    Maps the on-disk attribute kind to `(AttributeKind, converter)`, so that
+    the parser does a single dict lookup per attribute.  Keyword arguments
+    override the converters of the named kinds.
+    '''
+    return {
+        kind.value: (kind, kind_name_to_conv.get(kind.name, conv))
+            for kind, conv in _ATTRIBUTE_CONVERTERS.items()
+    }
+
+
+_ATTRIBUTES = _make_attribute_table()
+# `DATA` stays a read-only view of the command's buffer instead of a copy.
+_ATTRIBUTES_DATA_AS_VIEWS = _make_attribute_table(DATA=lambda s: s)
+# Only the length of `DATA` is kept, see `skip_data`.
+_ATTRIBUTES_SKIP_DATA = _make_attribute_table(DATA=len)
+
+_COMMAND_KINDS = {kind.value: kind for kind in CommandKind}
 
 
 def read_attribute(infile):
@@ -141,74 +245,134 @@ def read_attribute(infile):
     attr_data = infile.read(attr_header.length)
     if len(attr_data) != attr_header.length:
         raise RuntimeError(f'{attr_header} got {len(attr_data)} bytes')
+    return attr_header.kind, _ATTRIBUTE_CONVERTERS[attr_header.kind](attr_data)
 
-    if attr_header.kind == AttributeKind.UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.INO:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.SIZE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.MODE:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.UID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.GID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.RDEV:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.MTIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.ATIME:
-        return attr_header.kind, conv_time(attr_data)
-    elif attr_header.kind == AttributeKind.XATTR_NAME:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.XATTR_DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_TO:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.PATH_LINK:
-        # NB This is NOT normalized since we don't want to normalize symlinks
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.FILE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.DATA:
-        return attr_header.kind, attr_data
-    elif attr_header.kind == AttributeKind.CLONE_UUID:
-        return attr_header.kind, conv_uuid(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_CTRANSID:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_PATH:
-        return attr_header.kind, os.path.normpath(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_OFFSET:
-        return attr_header.kind, conv_uint64(attr_data)
-    elif attr_header.kind == AttributeKind.CLONE_LEN:
-        return attr_header.kind, conv_uint64(attr_data)
-
-    raise RuntimeError(f'Fix me: unhandled {attr_header}')  # pragma: no cover
-
-
-def read_command(infile):
-    cmd_header = CommandHeader.from_file(infile)
-
-    s = infile.read(cmd_header.length)
-    if len(s) != cmd_header.length:
-        raise RuntimeError(f'{cmd_header} got {len(s)} bytes')
-    # Future: pull in the `crc32c` module and check the CRC.
-
-    attr_bytes = BytesIO(s)
+
+def _parse_attributes(cmd_header: CommandHeader, body: memoryview, attributes):
     kind_to_attr = {}
-    while attr_bytes.tell() != len(s):
-        kind, attr = read_attribute(attr_bytes)
+    offset = 0
+    end = len(body)
+    while offset != end:
+        if end - offset < _ATTRIBUTE_HEADER.size:
+            raise RuntimeError(
+                f'Not enough bytes {bytes(body[offset:])} for format '
+                f'{_ATTRIBUTE_HEADER.format} in {cmd_header}'
+            )
+        raw_kind, length = _ATTRIBUTE_HEADER.unpack_from(body, offset)
+        offset += _ATTRIBUTE_HEADER.size
+        attr_data = body[offset:offset + length]
+        offset += length
+        entry = attributes.get(raw_kind)
+        if entry is None:
+            raise RuntimeError(f'Unknown attribute {raw_kind} in {cmd_header}')
+        kind, conv = entry
+        if len(attr_data) != length:
+            attr_header = AttributeHeader(kind=kind, length=length)
+            raise RuntimeError(
+                f'{attr_header} got {len(attr_data)} bytes in {cmd_header}'
+            )
         if kind in kind_to_attr:
             raise RuntimeError(f'{kind} occurred twice in {cmd_header}')
-        kind_to_attr[kind] = attr
-
+        kind_to_attr[kind] = conv(attr_data)
+    return kind_to_attr
+
+
+class _CommandReader:
+    '''
+    Reads commands from a binary file object, decoding them in place over a
+    `memoryview`.  Normally, each command is read into the same buffer,
+    which is only grown as needed.  With `data_as_views`, each command gets
+    its own immutable buffer instead, and the `data` of `write` items is a
+    `memoryview` of it, which avoids copying file contents.  With
+    `skip_data`, WRITE commands become length-only `update_extent` items.
+    With `verify_crc`, the CRC32C of each command is checked.
+    '''
+
+    def __init__(
+        self, infile, *, data_as_views: bool=False, skip_data: bool=False,
+        verify_crc: bool=False,
+    ):
+        if data_as_views and skip_data:
+            raise RuntimeError('Cannot have both data_as_views and skip_data')
+        self._infile = infile
+        self._header = bytearray(_COMMAND_HEADER.size)
+        self._buf = bytearray()
+        self._data_as_views = data_as_views
+        self._skip_data = skip_data
+        self._verify_crc = verify_crc
+        if data_as_views:
+            self._attributes = _ATTRIBUTES_DATA_AS_VIEWS
+        elif skip_data:
+            self._attributes = _ATTRIBUTES_SKIP_DATA
+        else:
+            self._attributes = _ATTRIBUTES
+
+    def _read_header(self) -> CommandHeader:
+        n = _readinto_exactly(self._infile, memoryview(self._header))
+        if n != len(self._header):
+            raise RuntimeError(
+                f'Not enough bytes {bytes(self._header[:n])} for format '
+                f'{_COMMAND_HEADER.format}'
+            )
+        length, raw_kind, crc = _COMMAND_HEADER.unpack(self._header)
+        kind = _COMMAND_KINDS.get(raw_kind)
+        if kind is None:
+            raise RuntimeError(f'Unknown command {raw_kind}')
+        return CommandHeader(kind=kind, length=length, crc=crc)
+
+    def _read_body(self, cmd_header: CommandHeader) -> memoryview:
+        length = cmd_header.length
+        if self._data_as_views:
+            # The views may outlive the next read, so they need their own
+            # buffer.  It is `bytes` so that they hash like `bytes`.
+            body = memoryview(_read_exactly(self._infile, length))
+            n = len(body)
+        else:
+            if len(self._buf) < length:
+                # Replace rather than resize, since the old buffer may
+                # still be exported as a `memoryview`.
+                self._buf = bytearray(length)
+            body = memoryview(self._buf)[:length]
+            n = _readinto_exactly(self._infile, body)
+        if n != length:
+            raise RuntimeError(f'{cmd_header} got {n} bytes')
+        return body
+
+    def _check_crc(self, cmd_header: CommandHeader, body: memoryview):
+        crc = btrfs_crc32c(memoryview(self._header)[:_CRC_OFFSET])
+        crc = btrfs_crc32c(body, btrfs_crc32c(_ZERO_CRC, crc))
+        if crc != cmd_header.crc:
+            raise RuntimeError(f'{cmd_header} has bad CRC32C {crc}')
+
+    def read(self) -> Optional[SendStreamItem]:
+        'Returns the next item, or None for the END command.'
+        cmd_header = self._read_header()
+        body = self._read_body(cmd_header)
+        if self._verify_crc:
+            self._check_crc(cmd_header, body)
+        kind_to_attr = _parse_attributes(cmd_header, body, self._attributes)
+        if self._skip_data and cmd_header.kind == CommandKind.WRITE:
+            # `DATA` was converted to its length, this is what
+            # `btrfs send --no-data` would have emitted.
+            return SendStreamItems.update_extent(
+                path=kind_to_attr[AttributeKind.PATH],
+                offset=kind_to_attr[AttributeKind.FILE_OFFSET],
+                len=kind_to_attr[AttributeKind.DATA],
+            )
+        return _make_item(cmd_header, kind_to_attr)
+
+
+def read_command(
+    infile, *, data_as_views: bool=False, skip_data: bool=False,
+    verify_crc: bool=False,
+):
+    return _CommandReader(
+        infile, data_as_views=data_as_views, skip_data=skip_data,
+        verify_crc=verify_crc,
+    ).read()
+
+
+def _make_item(cmd_header: CommandHeader, kind_to_attr):
     if cmd_header.kind == CommandKind.SUBVOL:
         return SendStreamItems.subvol(
             path=kind_to_attr[AttributeKind.PATH],
@@ -319,11 +483,92 @@ def read_command(infile):
     raise AssertionError(f'Fix me: unhandled {cmd_header}')  # pragma: no cover
 
 
-def parse_send_stream(infile) -> Iterable[SendStreamItem]:
+def parse_send_stream(
+    infile, *, data_as_views: bool=False, skip_data: bool=False,
+    verify_crc: bool=False,
+) -> Iterable[SendStreamItem]:
+    '''
+    Yields the items of a send-stream read from the binary file object
+    `infile`.  Pass `data_as_views=True` to get the `data` of `write` items
+    as read-only `memoryview`s, instead of as `bytes` copies.  These compare
+    and hash like `bytes`.
+
+    Pass `skip_data=True` if you only need metadata, e.g. to build a
+    `SubvolumeSet`.  Each WRITE then becomes an `update_extent` with just
+    the length of its data, as if the stream came from `btrfs send
+    --no-data`, so parsing uses constant memory regardless of the amount
+    of file data.
+
+    Pass `verify_crc=True` to check the CRC32C of every command as it is
+    parsed, e.g. for streams that were cached or copied between hosts.
+    See `checksum.py` for the cost of this.
+    '''
     check_magic(infile)
     check_version(infile)
+    reader = _CommandReader(
+        infile, data_as_views=data_as_views, skip_data=skip_data,
+        verify_crc=verify_crc,
+    )
     while True:
-        cmd = read_command(infile)
+        cmd = reader.read()
         if cmd is None:
             return
         yield cmd
+
+
+def _parse_concatenated_send_streams(infile, **kwargs):
+    'Yields the items of all the send-streams in `infile`, without ENDs.'
+    check_magic(infile)
+    reader = _CommandReader(infile, **kwargs)
+    while True:
+        check_version(infile)
+        while True:
+            item = reader.read()
+            if item is None:
+                break
+            yield item
+        # After an END, there is either EOF, or the next send-stream.
+        magic = infile.read(len(BTRFS_SEND_STREAM_MAGIC))
+        if not magic:
+            return
+        _check_magic(magic)
+
+
+def _items_until_next_subvol(
+    items: Iterator[SendStreamItem], next_subvol_item: List[SendStreamItem],
+) -> Iterator[SendStreamItem]:
+    for item in items:
+        if item.sets_subvol_name:
+            next_subvol_item.append(item)
+            return
+        yield item
+
+
+def parse_send_streams(
+    infile, **kwargs,
+) -> Iterator[Tuple[SendStreamItem, Iterator[SendStreamItem]]]:
+    '''
+    Parses one or more send-streams from `infile`, reading it incrementally,
+    so it may be a pipe, as in `btrfs send a b c | ...`.  Handles both
+    concatenated send-streams, and streams carrying several subvolumes.
+
+    Yields a `(subvol_item, items)` pair per subvolume, where `subvol_item`
+    is its `subvol` or `snapshot` item, and `items` iterates over the rest
+    of its items.  Like with `itertools.groupby`, advancing to the next
+    subvolume consumes the previous `items`.
+
+    Takes the same keyword arguments as `parse_send_stream`.
+    '''
+    items = _parse_concatenated_send_streams(infile, **kwargs)
+    next_subvol_item = list(itertools.islice(items, 1))
+    while next_subvol_item:
+        subvol_item, = next_subvol_item
+        if not subvol_item.sets_subvol_name:
+            raise RuntimeError(
+                f'Expected subvol or snapshot, got {subvol_item}'
+            )
+        next_subvol_item = []
+        subvol_items = _items_until_next_subvol(items, next_subvol_item)
+        yield subvol_item, subvol_items
+        for _ in subvol_items:  # In case the caller did not consume them
+            pass
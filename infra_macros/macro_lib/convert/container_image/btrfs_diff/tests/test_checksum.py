@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+import os
+import unittest
+
+from ..checksum import btrfs_crc32c, table_crc32c
+
+
+class ChecksumTestCase(unittest.TestCase):
+
+    def test_known_value(self):
+        # The standard CRC32C check value, with the inversions that btrfs
+        # omits done by hand.
+        self.assertEqual(
+            0xE3069283, table_crc32c(b'123456789', 0xFFFFFFFF) ^ 0xFFFFFFFF,
+        )
+        self.assertEqual(0, table_crc32c(b''))
+        self.assertEqual(0, table_crc32c(bytes(7)))
+
+    def test_continuation(self):
+        data = os.urandom(1001)
+        for split in [0, 1, 3, 4, 500, 1001]:
+            self.assertEqual(
+                table_crc32c(data),
+                table_crc32c(data[split:], table_crc32c(data[:split])),
+            )
+
+    def test_matches_default_implementation(self):
+        for length in [0, 1, 2, 3, 4, 5, 8, 31, 4097]:
+            data = os.urandom(length)
+            self.assertEqual(table_crc32c(data), btrfs_crc32c(data))
+            self.assertEqual(
+                table_crc32c(memoryview(data), 0x12345678),
+                btrfs_crc32c(memoryview(data), 0x12345678),
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,7 @@ This test only validates the binary send-stream parser. We rely on the fact
 that `test_parse_dump.py` already sanity-checks the gold data.
 '''
 import io
+import itertools
 import struct
 import unittest
 
@@ -12,17 +13,39 @@ from typing import Tuple
 from .demo_sendstreams import gold_demo_sendstreams
 from .demo_sendstreams_expected import get_filtered_and_expected_items
 
+from ..send_stream import SendStreamItems
 from ..parse_send_stream import (
     AttributeKind, check_magic, check_version, CommandKind, file_unpack,
-    parse_send_stream, read_attribute, read_command,
+    parse_send_stream, parse_send_streams, read_attribute, read_command,
 )
 
 # `unittest`'s output shortening makes tests much harder to debug.
 unittest.util._MAX_LENGTH = 10e4
 
 
-def _parse_stream_bytes(s: bytes) -> io.BytesIO:
-    return parse_send_stream(io.BytesIO(s))
+def _parse_stream_bytes(s: bytes, **kwargs) -> io.BytesIO:
+    return parse_send_stream(io.BytesIO(s), **kwargs)
+
+
+class _TrickleIO(io.RawIOBase):
+    'Like a pipe, returns at most 1 byte per read.'
+
+    def __init__(self, s: bytes):
+        self._infile = io.BytesIO(s)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._infile.readinto(memoryview(b)[:1])
+
+
+def _cmd(kind: CommandKind, *attrs: Tuple[AttributeKind, bytes]) -> bytes:
+    body = b''.join(
+        struct.pack('<HH', kind.value, len(data)) + data
+            for kind, data in attrs
+    )
+    return struct.pack('<IHI', len(body), kind.value, 0) + body
 
 
 class ParseSendStreamTestCase(unittest.TestCase):
@@ -43,6 +66,152 @@ class ParseSendStreamTestCase(unittest.TestCase):
         )
         self.assertEqual(filtered_items, expected_items)
 
+    def test_data_as_views(self):
+        stream_dict = gold_demo_sendstreams()
+        items = []
+        view_items = []
+        for name in ['create_ops', 'mutate_ops']:
+            s = stream_dict[name]['sendstream']
+            items.extend(_parse_stream_bytes(s))
+            view_items.extend(_parse_stream_bytes(s, data_as_views=True))
+        # The views stay valid after the whole stream is parsed.
+        self.assertEqual(items, view_items)
+        writes = [
+            (i, vi) for i, vi in zip(items, view_items)
+                if isinstance(i, SendStreamItems.write)
+        ]
+        self.assertTrue(writes)
+        for item, view_item in writes:
+            self.assertIsInstance(item.data, bytes)
+            self.assertIsInstance(view_item.data, memoryview)
+            self.assertTrue(view_item.data.readonly)
+            self.assertEqual(hash(item.data), hash(view_item.data))
+
+    def test_skip_data(self):
+        stream_dict = gold_demo_sendstreams()
+        for name in ['create_ops', 'mutate_ops']:
+            s = stream_dict[name]['sendstream']
+            expected_items = [
+                SendStreamItems.update_extent(
+                    path=i.path, offset=i.offset, len=len(i.data),
+                ) if isinstance(i, SendStreamItems.write) else i
+                    for i in _parse_stream_bytes(s)
+            ]
+            self.assertEqual(
+                expected_items, list(_parse_stream_bytes(s, skip_data=True)),
+            )
+        self.assertEqual(
+            SendStreamItems.update_extent(path=b'a', offset=7, len=3),
+            read_command(io.BytesIO(_cmd(
+                CommandKind.WRITE,
+                (AttributeKind.DATA, b'xyz'),
+                (AttributeKind.PATH, b'a'),
+                (AttributeKind.FILE_OFFSET, struct.pack('<Q', 7)),
+            )), skip_data=True),
+        )
+        with self.assertRaisesRegex(RuntimeError, 'Cannot have both'):
+            read_command(io.BytesIO(), data_as_views=True, skip_data=True)
+
+    def test_verify_crc(self):
+        stream_dict = gold_demo_sendstreams()
+        for name in ['create_ops', 'mutate_ops']:
+            s = stream_dict[name]['sendstream']
+            self.assertEqual(
+                list(_parse_stream_bytes(s)),
+                list(_parse_stream_bytes(s, verify_crc=True)),
+            )
+        # Flip the last byte of the first command (`subvol` or `snapshot`),
+        # which is part of its UUID or transid.
+        s = bytearray(stream_dict['create_ops']['sendstream'])
+        cmd_len, = struct.unpack('<I', s[17:21])
+        s[17 + 10 + cmd_len - 1] ^= 1
+        self.assertEqual(
+            CommandKind.SUBVOL.value, struct.unpack('<H', s[21:23])[0],
+        )
+        next(_parse_stream_bytes(bytes(s)))  # Not checked by default
+        with self.assertRaisesRegex(RuntimeError, 'has bad CRC32C'):
+            next(_parse_stream_bytes(bytes(s), verify_crc=True))
+
+    def test_parse_send_streams(self):
+        stream_dict = gold_demo_sendstreams()
+        create_ops = stream_dict['create_ops']['sendstream']
+        mutate_ops = stream_dict['mutate_ops']['sendstream']
+
+        def groups(s: bytes, consume=True, **kwargs):
+            for subvol_item, items in parse_send_streams(
+                io.BufferedReader(_TrickleIO(s), 1), **kwargs,
+            ):
+                yield [subvol_item, *(items if consume else [])]
+
+        # Concatenated send-streams, read from a pipe-like file
+        self.assertEqual([
+            list(_parse_stream_bytes(create_ops)),
+            list(_parse_stream_bytes(mutate_ops)),
+        ], list(groups(create_ops + mutate_ops)))
+        self.assertEqual(
+            [list(_parse_stream_bytes(mutate_ops, skip_data=True))],
+            list(groups(mutate_ops, skip_data=True)),
+        )
+
+        # Like `btrfs send a b`: 1 stream header & END, 2 subvolumes.
+        create_items = list(_parse_stream_bytes(create_ops))
+        mutate_items = list(_parse_stream_bytes(mutate_ops))
+        end = _cmd(CommandKind.END)
+        self.assertEqual(
+            [create_items, mutate_items],
+            list(groups(create_ops[:-len(end)] + mutate_ops[17:])),
+        )
+
+        # The caller need not consume the items of each subvolume.
+        self.assertEqual(
+            [create_items[:1], mutate_items[:1]],
+            list(groups(create_ops + mutate_ops, consume=False)),
+        )
+
+        self.assertEqual([], list(groups(create_ops[:17] + end)))
+
+        with self.assertRaisesRegex(RuntimeError, 'Magic b\'\', not '):
+            list(groups(b''))
+        with self.assertRaisesRegex(RuntimeError, 'Magic b\'x\', not '):
+            list(groups(create_ops + b'x'))
+        with self.assertRaisesRegex(RuntimeError, 'Expected subvol or snap'):
+            list(groups(create_ops[:17] + _cmd(
+                CommandKind.MKDIR, (AttributeKind.PATH, b'a'),
+            )))
+
+    def test_buffer_reuse(self):
+        # The 2nd command is longer than the 1st, and the 3rd reuses the
+        # grown buffer.  None of the items may alias the buffer.
+        s = b''.join([
+            _cmd(CommandKind.MKFILE, (AttributeKind.PATH, b'a')),
+            _cmd(
+                CommandKind.WRITE,
+                (AttributeKind.PATH, b'a'),
+                (AttributeKind.FILE_OFFSET, struct.pack('<Q', 0)),
+                (AttributeKind.DATA, b'x' * 100),
+            ),
+            _cmd(
+                CommandKind.WRITE,
+                (AttributeKind.PATH, b'a'),
+                (AttributeKind.FILE_OFFSET, struct.pack('<Q', 100)),
+                (AttributeKind.DATA, b'y'),
+            ),
+            _cmd(CommandKind.END),
+        ])
+        for infile, data_as_views in itertools.product(
+            [lambda: io.BytesIO(s), lambda: _TrickleIO(s)], [False, True],
+        ):
+            infile = infile()
+            self.assertEqual([
+                SendStreamItems.mkfile(path=b'a'),
+                SendStreamItems.write(path=b'a', offset=0, data=b'x' * 100),
+                SendStreamItems.write(path=b'a', offset=100, data=b'y'),
+            ], [
+                read_command(infile, data_as_views=data_as_views)
+                    for _ in range(3)
+            ])
+            self.assertIsNone(read_command(infile))
+
     def test_errors(self):
         with self.assertRaisesRegex(RuntimeError, "Magic b'xxx', not "):
             check_magic(io.BytesIO(b'xxx'))
@@ -81,6 +250,37 @@ class ParseSendStreamTestCase(unittest.TestCase):
                 b'dog',
             )))
 
+        with self.assertRaisesRegex(RuntimeError, 'Unknown command 99'):
+            read_command(io.BytesIO(struct.pack('<IHI', 0, 99, 0)))
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes'):
+            read_command(io.BytesIO(b'abc'))
+
+        with self.assertRaisesRegex(RuntimeError, 'Unknown attribute 12 '):
+            read_command(io.BytesIO(struct.pack(
+                '<IHIHH', 4, CommandKind.MKFILE.value, 0, 12, 0,
+            )))
+        with self.assertRaisesRegex(RuntimeError, 'Not enough bytes .* in '):
+            read_command(io.BytesIO(struct.pack(
+                '<IHIH', 2, CommandKind.MKFILE.value, 0, 15,
+            )))
+        with self.assertRaisesRegex(RuntimeError, 'AttributeH.* got 1 bytes'):
+            read_command(io.BytesIO(struct.pack(
+                '<IHIHHs', 5, CommandKind.MKFILE.value, 0,
+                AttributeKind.PATH.value,
+                3,  # length excluding this header -- error: only 1 byte
+                b'c',
+            )))
+        with self.assertRaisesRegex(RuntimeError, 'CommandHead.* got 0 bytes'):
+            read_command(io.BytesIO(cmd_header_2_attrs), data_as_views=True)
+        for data_as_views in [False, True]:
+            with self.assertRaisesRegex(
+                RuntimeError, 'CommandHead.* got 3 bytes',
+            ):
+                read_command(
+                    _TrickleIO(cmd_header_2_attrs + b'abc'),
+                    data_as_views=data_as_views,
+                )
+
 
 if __name__ == '__main__':
     unittest.main()